@@ -1,6 +1,7 @@
 import dbus
 
 import logging
+import os
 
 DBUS_OM_IFACE = "org.freedesktop.DBus.ObjectManager"
 DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
@@ -50,6 +51,39 @@ def find_adapter(bus):
     return None
 
 
+ADAPTER_CACHE_PATH = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+                                  "rowflo", "ble_adapter")
+
+
+def cached_adapter(path=ADAPTER_CACHE_PATH):
+    """
+    Returns the adapter object path remembered from the last run, None if there is none
+    """
+    try:
+        with open(path) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+
+def remember_adapter(adapter, path=ADAPTER_CACHE_PATH):
+    if adapter == cached_adapter(path):
+        return
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(adapter)
+    except OSError as e:
+        logger.warning("could not remember the adapter path: %s", e)
+
+
+def forget_adapter(path=ADAPTER_CACHE_PATH):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 class Application(dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
@@ -58,6 +92,9 @@ class Application(dbus.service.Object):
     def __init__(self, bus):
         self.path = "/"
         self.services = []
+        # GetManagedObjects reply, built on the first call and kept until a service changes
+        self._managed_objects = None
+        self.managed_objects_stats = {"calls": 0, "builds": 0}
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_path(self):
@@ -65,12 +102,14 @@ class Application(dbus.service.Object):
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self.invalidate()
 
-    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
-    def GetManagedObjects(self):
-        response = {}
-        logger.info("GetManagedObjects")
+    def invalidate(self):
+        self._managed_objects = None
 
+    def build_managed_objects(self):
+        response = {}
         for service in self.services:
             response[service.get_path()] = service.get_properties()
             chrcs = service.get_characteristics()
@@ -79,9 +118,18 @@ class Application(dbus.service.Object):
                 descs = chrc.get_descriptors()
                 for desc in descs:
                     response[desc.get_path()] = desc.get_properties()
-
         return response
 
+    @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
+    def GetManagedObjects(self):
+        logger.info("GetManagedObjects")
+        self.managed_objects_stats["calls"] += 1
+        if self._managed_objects is None:
+            self._managed_objects = self.build_managed_objects()
+            self.managed_objects_stats["builds"] += 1
+
+        return self._managed_objects
+
 
 class Service(dbus.service.Object):
     """
@@ -96,6 +144,7 @@ class Service(dbus.service.Object):
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.application = None
         dbus.service.Object.__init__(self, bus, self.path)
 
     def get_properties(self):
@@ -114,6 +163,12 @@ class Service(dbus.service.Object):
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        self.invalidate()
+
+    def invalidate(self):
+        # the object tree of the application is out of date
+        if self.application is not None:
+            self.application.invalidate()
 
     def get_characteristic_paths(self):
         result = []
@@ -161,6 +216,7 @@ class Characteristic(dbus.service.Object):
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self.service.invalidate()
 
     def get_descriptor_paths(self):
         result = []
@@ -198,6 +254,11 @@ class Characteristic(dbus.service.Object):
         logger.info("Default StopNotify called, returning error")
         raise NotSupportedException()
 
+    @dbus.service.method(GATT_CHRC_IFACE, in_signature="a{sv}", out_signature="hq")
+    def AcquireNotify(self, options):
+        logger.info("Default AcquireNotify called, returning error")
+        raise NotSupportedException()
+
     @dbus.service.signal(DBUS_PROP_IFACE, signature="sa{sv}as")
     def PropertiesChanged(self, interface, changed, invalidated):
         pass
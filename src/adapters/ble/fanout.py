@@ -0,0 +1,187 @@
+import errno
+import logging
+import socket
+import time
+
+import dbus
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+'''
+Fan out of one notification payload to every subscriber of a characteristic.
+
+BlueZ reaches a notifying characteristic in two ways and both can be active at once (a phone on one
+and a watch on the other, or a central coming back on a fresh link):
+    StartNotify     the value goes out as a PropertiesChanged signal (SignalSink)
+    AcquireNotify   BlueZ hands over a socket, the value is written to it (SocketSink)
+The characteristic encodes the payload once per scheduler tick and Fanout.send() passes the same
+bytes to every sink. Each sink keeps its own counters.
+
+Backpressure: the sockets are non blocking. A write that would block means that subscriber is
+behind; only the newest payload is kept for it and written once the socket is writable again,
+the ones it skipped are counted as dropped. A slow central never stalls the main loop or the
+other subscribers. A socket that is closed or fails is removed.
+'''
+
+GATT_CHRC_IFACE = "org.bluez.GattCharacteristic1"
+DEFAULT_MTU = 23
+
+
+class SignalSink(object):
+    name = 'dbus-signal'
+
+    def __init__(self, characteristic):
+        self.characteristic = characteristic
+        self.stats = {'sent': 0, 'dropped': 0, 'bytes': 0, 'since': time.time()}
+
+    def send(self, payload, value):
+        self.characteristic.PropertiesChanged(GATT_CHRC_IFACE, {'Value': value}, [])
+        self.stats['sent'] += 1
+        self.stats['bytes'] += len(payload)
+        return True
+
+    def close(self):
+        pass
+
+
+class SocketSink(object):
+    def __init__(self, sock, device=None, mtu=DEFAULT_MTU, on_closed=None):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.device = device
+        self.name = str(device) if device else 'socket-%d' % sock.fileno()
+        self.mtu = mtu
+        self.closed = False
+        self.pending = None  # newest payload not written yet because the socket was full
+        self._out_watch = None
+        self._on_closed = on_closed
+        self.stats = {'sent': 0, 'dropped': 0, 'blocked': 0, 'bytes': 0, 'mtu': mtu, 'since': time.time()}
+        # BlueZ closes its end when the central unsubscribes or disconnects
+        self._watch = GLib.io_add_watch(sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                        GLib.IO_HUP | GLib.IO_ERR, self._on_hangup)
+
+    def send(self, payload, value):
+        if self.closed:
+            return False
+        if len(payload) > self.mtu - 3:
+            payload = payload[:self.mtu - 3]  # what fits in one ATT notification
+        if self.pending is not None:
+            # still waiting for room, the newer payload replaces the one waiting
+            self.pending = payload
+            self.stats['dropped'] += 1
+            return False
+        return self._write(payload)
+
+    def _write(self, payload):
+        try:
+            self.sock.send(payload)
+        except BlockingIOError:
+            self.pending = payload
+            self.stats['blocked'] += 1
+            if self._out_watch is None:
+                self._out_watch = GLib.io_add_watch(self.sock.fileno(), GLib.PRIORITY_DEFAULT,
+                                                    GLib.IO_OUT, self._on_writable)
+            return False
+        except OSError as e:
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET, errno.ENOTCONN):
+                logger.error("notify socket %s failed: %s", self.name, e)
+            self.close()
+            return False
+        self.stats['sent'] += 1
+        self.stats['bytes'] += len(payload)
+        return True
+
+    def _on_writable(self, fd, condition):
+        self._out_watch = None
+        payload = self.pending
+        self.pending = None
+        if payload is not None and not self.closed:
+            self._write(payload)  # arms a new watch if it is still full
+        return False
+
+    def _on_hangup(self, fd, condition):
+        self._watch = None
+        self.close()
+        return False
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for watch in (self._watch, self._out_watch):
+            if watch is not None:
+                GLib.source_remove(watch)
+        self._watch = None
+        self._out_watch = None
+        self.sock.close()
+        logger.info("notify subscriber %s gone", self.name)
+        if self._on_closed:
+            self._on_closed(self)
+
+
+class Fanout(object):
+    '''
+    The subscribers of one characteristic. on_empty is called when the last one leaves.
+    '''
+
+    def __init__(self, characteristic, on_empty=None):
+        self.characteristic = characteristic
+        self.sinks = []
+        self._on_empty = on_empty
+        self.signal_sink = None
+        self.departed = {'sent': 0, 'dropped': 0}
+
+    def __bool__(self):
+        return bool(self.sinks)
+
+    def add(self, sink):
+        self.sinks.append(sink)
+        logger.info("notify subscriber %s added (%d now)", sink.name, len(self.sinks))
+
+    def remove(self, sink):
+        if sink in self.sinks:
+            self.sinks.remove(sink)
+            self.departed['sent'] += sink.stats['sent']
+            self.departed['dropped'] += sink.stats['dropped']
+            if not self.sinks and self._on_empty:
+                self._on_empty()
+
+    def start_signal(self):
+        if self.signal_sink is None:
+            self.signal_sink = SignalSink(self.characteristic)
+            self.add(self.signal_sink)
+
+    def stop_signal(self):
+        if self.signal_sink is not None:
+            sink = self.signal_sink
+            self.signal_sink = None
+            self.remove(sink)
+
+    def acquire(self, options):
+        # AcquireNotify: one end of a seqpacket pair goes to BlueZ, we write to the other
+        ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        mtu = int(options.get('mtu', DEFAULT_MTU))
+        self.add(SocketSink(ours, options.get('device'), mtu, on_closed=self.remove))
+        fd = dbus.types.UnixFd(theirs.fileno())  # dbus keeps its own duplicate
+        theirs.close()
+        return fd, dbus.UInt16(mtu)
+
+    def send(self, payload):
+        # payload: bytes built once for this tick; the D-Bus value is wrapped once as well.
+        # True when at least one sink wrote it
+        value = dbus.ByteArray(payload)
+        sent = False
+        for sink in tuple(self.sinks):
+            sent = sink.send(payload, value) or sent
+        return sent
+
+    def close(self):
+        for sink in tuple(self.sinks):
+            sink.close()
+        self.sinks = []
+
+    def stats(self):
+        return {'subscribers': len(self.sinks),
+                'sinks': {sink.name: dict(sink.stats) for sink in self.sinks},
+                'departed': dict(self.departed)}
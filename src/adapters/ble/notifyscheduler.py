@@ -0,0 +1,135 @@
+import logging
+import time
+
+from gi.repository import GLib
+
+logger = logging.getLogger(__name__)
+
+'''
+One scheduler for every notifying characteristic of the GATT server.
+
+Instead of a fixed GLib timer per characteristic (200ms rower data, 1000ms heart rate) that fires
+whether or not anything changed, the characteristics subscribe here in StartNotify and leave in
+StopNotify. New values from the S4 side call changed(); the scheduler then arms one timer for the
+earliest characteristic that may send again and sends all that are due in that one wakeup. A
+characteristic never sends more often than its minimum interval, by default the connection
+interval (one notification per connection event is all the link can carry anyway). The interval is
+read from the controller where debugfs allows it; --ble-notify-interval sets it for a central that
+is known to connect faster or slower. With nothing subscribed or nothing changed there is no timer
+at all.
+
+A notifying characteristic needs:
+    notify_update()   build the value and send it if it differs from the last one, return True
+                      when something was sent
+    min_interval_ms   optional, own lower bound between two notifications
+'''
+
+DEFAULT_CONNECTION_INTERVAL_MS = 50.0  # pacing when the controller's interval cannot be read (40 x 1.25ms)
+CONNECTION_INTERVAL_PATH = '/sys/kernel/debug/bluetooth/%s/conn_max_interval'
+
+
+def connection_interval_ms(hci='hci0'):
+    # BlueZ does not expose the interval of a connection over D-Bus; the upper bound the controller
+    # accepts (debugfs, root only) is what a central ends up with in practice
+    try:
+        with open(CONNECTION_INTERVAL_PATH % hci) as f:
+            return int(f.read().strip()) * 1.25
+    except (OSError, ValueError):
+        return DEFAULT_CONNECTION_INTERVAL_MS
+
+
+class NotifyScheduler(object):
+    def __init__(self, min_interval_ms=None):
+        if min_interval_ms is None:
+            min_interval_ms = connection_interval_ms()
+        self.min_interval = min_interval_ms / 1000.0
+        self._subscribed = []
+        self._dirty = set()
+        self._last_sent = {}
+        self._source = None
+        self._due = None
+        self.stats = {'changes': 0, 'wakeups': 0, 'sent': 0, 'unchanged': 0}
+        logger.info("BLE notify minimum interval %.1f ms", min_interval_ms)
+
+    def interval(self, chrc):
+        own = getattr(chrc, 'min_interval_ms', None)
+        return max(self.min_interval, own / 1000.0) if own else self.min_interval
+
+    def subscribe(self, chrc):
+        if chrc not in self._subscribed:
+            self._subscribed.append(chrc)
+            self._last_sent.pop(chrc, None)
+        # the new subscriber gets the current value right away
+        self._dirty.add(chrc)
+        self._arm()
+
+    def unsubscribe(self, chrc):
+        if chrc in self._subscribed:
+            self._subscribed.remove(chrc)
+        self._dirty.discard(chrc)
+        self._last_sent.pop(chrc, None)
+        if not self._subscribed:
+            self._cancel()
+
+    def is_idle(self):
+        return self._source is None
+
+    def changed(self):
+        # new values arrived from the S4 side
+        if not self._subscribed:
+            return
+        self.stats['changes'] += 1
+        self._dirty.update(self._subscribed)
+        self._arm()
+
+    def _next_due(self):
+        due = None
+        for chrc in self._dirty:
+            last = self._last_sent.get(chrc)
+            at = last + self.interval(chrc) if last is not None else 0.0
+            if due is None or at < due:
+                due = at
+        return due
+
+    def _arm(self):
+        due = self._next_due()
+        if due is None:
+            return
+        if self._source is not None:
+            if self._due <= due:
+                return  # the pending wakeup comes first and re-arms for the rest
+            GLib.source_remove(self._source)
+        self._due = due
+        delay = max(0, int((due - time.monotonic()) * 1000))
+        self._source = GLib.timeout_add(delay, self._wakeup)
+
+    def close(self):
+        # the BLE worker ends: no more wakeups on the main context
+        self._cancel()
+        self._subscribed = []
+        self._dirty.clear()
+        self._last_sent.clear()
+
+    def _cancel(self):
+        if self._source is not None:
+            GLib.source_remove(self._source)
+            self._source = None
+            self._due = None
+
+    def _wakeup(self):
+        self._source = None
+        self._due = None
+        self.stats['wakeups'] += 1
+        now = time.monotonic()
+        for chrc in list(self._dirty):
+            last = self._last_sent.get(chrc)
+            if last is not None and now - last < self.interval(chrc):
+                continue
+            self._dirty.discard(chrc)
+            if chrc.notify_update():
+                self._last_sent[chrc] = now
+                self.stats['sent'] += 1
+            else:
+                self.stats['unchanged'] += 1
+        self._arm()
+        return False
@@ -0,0 +1,62 @@
+import struct
+
+'''
+Encoder for the WaterRower BLE rower data notification (20 bytes).
+
+Layout, little endian:
+    0x2C 0x0B        flags (stroke rate & count, total distance, instantaneous pace, power,
+                     expended energy, heart rate, elapsed time)
+    stroke_rate      uint8
+    total_strokes    uint16
+    total_distance_m uint24 (packed as uint16 + uint8)
+    instantaneous pace uint16
+    watts            uint16
+    total_kcal       uint16
+    total_kcal_hour  uint16
+    total_kcal_min   uint8
+    heart_rate       uint8
+    elapsedtime      uint16
+'''
+
+ROWER_DATA = struct.Struct('<BBBHHBHHHHBBH')
+ROWER_DATA_FLAGS = (0x2C, 0x0B)
+
+
+def pack_rower_data(buffer, values):
+    distance = values['total_distance_m']
+    ROWER_DATA.pack_into(buffer, 0,
+                         ROWER_DATA_FLAGS[0], ROWER_DATA_FLAGS[1],
+                         values['stroke_rate'] & 0xff,
+                         values['total_strokes'] & 0xffff,
+                         distance & 0xffff,
+                         (distance >> 16) & 0xff,
+                         values['instantaneous pace'] & 0xffff,
+                         values['watts'] & 0xffff,
+                         values['total_kcal'] & 0xffff,
+                         values['total_kcal_hour'] & 0xffff,
+                         values['total_kcal_min'] & 0xff,
+                         values['heart_rate'] & 0xff,
+                         values['elapsedtime'] & 0xffff)
+
+
+class RowerDataEncoder(object):
+    '''
+    Packs the values into one reused buffer and only hands out a new payload when the bytes differ
+    from the last one handed out.
+    '''
+
+    def __init__(self):
+        self._buffer = bytearray(ROWER_DATA.size)
+        self.payload = None
+        self.encoded = 0
+        self.changed = 0
+
+    def encode(self, values):
+        # returns the new payload (bytes) or None when nothing changed on the wire
+        pack_rower_data(self._buffer, values)
+        self.encoded += 1
+        if self.payload is not None and self._buffer == self.payload:
+            return None
+        self.payload = bytes(self._buffer)
+        self.changed += 1
+        return self.payload
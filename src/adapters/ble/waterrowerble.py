@@ -9,20 +9,27 @@ global_advertisement = None
 
 
 import logging
-from queue import Empty
 import signal
 import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
-import struct
 
+from ..metrics import latency
+from ..metrics import registry
+from ..metrics.startup import StartupTimer
+from .rowerdata import RowerDataEncoder
+from .notifyscheduler import NotifyScheduler
+from .fanout import Fanout
 from .ble import (
     Advertisement,
     Characteristic,
     Service,
     Application,
     find_adapter,
+    cached_adapter,
+    remember_adapter,
+    forget_adapter,
     Descriptor,
     Agent,
 )
@@ -90,33 +97,6 @@ def register_app_error_cb(error):
 def request_reset_ble():
     out_q_reset.put("reset_ble")
 
-def Convert_Waterrower_raw_to_byte():
-
-    WRBytearray = []
-    #print("Ble Values: {0}".format(WaterrowerValuesRaw))
-    #todo refactor this part with the correct struct.pack e.g. 2 bytes use "H" instand of bitshifiting ?
-    #print(WaterrowerValuesRaw)
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['stroke_rate'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_strokes'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_strokes'] & 0xff00) >> 8))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_distance_m'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_distance_m'] & 0xff00) >> 8))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_distance_m'] & 0xff0000) >> 16))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['instantaneous pace'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['instantaneous pace'] & 0xff00) >> 8))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['watts'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['watts'] & 0xff00) >> 8))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal'] & 0xff00) >> 8))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal_hour'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal_hour'] & 0xff00) >> 8))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal_min'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['heart_rate'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['elapsedtime'] & 0xff)))
-    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['elapsedtime'] & 0xff00) >> 8))
-    return WRBytearray
-
-
 class DeviceInformation(Service):
     DEVICE_INFORMATION_UUID = '180A'
 
@@ -285,7 +265,6 @@ class FitnessMachineFeature(Characteristic):
 
 class RowerData(Characteristic):
     ROWING_UUID = '2ad1'
-    last_values = {}
 
     def __init__(self, bus, index, service):
         Characteristic.__init__(
@@ -295,46 +274,75 @@ class RowerData(Characteristic):
             service)
         self.notifying = False
         self.iter = 0
+        self.encoder = RowerDataEncoder()
+        self.fanout = Fanout(self, on_empty=self._unsubscribed)
+        notifying_characteristics.append(self)
+
+    def get_properties(self):
+        properties = Characteristic.get_properties(self)
+        # tells BlueZ it may hand each subscriber a socket through AcquireNotify
+        properties[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(False)
+        return properties
+
+    def notify_update(self):
+        global pending_trace
+        if WaterrowerValuesRaw is None:
+            return False
+        payload = self.encoder.encode(WaterrowerValuesRaw)
+        trace = pending_trace
+        pending_trace = None
+        if payload is None:
+            # nothing new to notify, the trace is not followed to the end
+            if trace is not None:
+                latency.tracer.discard(trace)
+            return False
+        # encoded once, the same bytes go to every subscriber
+        sent = self.fanout.send(payload)
+        if trace is not None:
+            if sent:
+                trace['notified'] = latency.stamp()
+                latency.tracer.record(trace)
+            else:
+                # no sink took it (all behind or gone), nothing was notified
+                latency.tracer.discard(trace)
+        return sent
+
+    def _subscribed(self):
+        self.notifying = True
+        # the encoder forgets the last payload so the new subscriber gets the current values
+        self.encoder.payload = None
+        notify_scheduler.subscribe(self)
 
-    def Waterrower_cb(self):
-        Waterrower_byte_values = Convert_Waterrower_raw_to_byte()
-        if self.last_values != Waterrower_byte_values:
-            self.last_values = Waterrower_byte_values 
-            value = [dbus.Byte(0x2C), dbus.Byte(0x0B),
-                dbus.Byte(Waterrower_byte_values[0]), dbus.Byte(Waterrower_byte_values[1]), dbus.Byte(Waterrower_byte_values[2]),
-                dbus.Byte(Waterrower_byte_values[3]), dbus.Byte(Waterrower_byte_values[4]), dbus.Byte(Waterrower_byte_values[5]),
-                dbus.Byte(Waterrower_byte_values[6]), dbus.Byte(Waterrower_byte_values[7]),
-                dbus.Byte(Waterrower_byte_values[8]), dbus.Byte(Waterrower_byte_values[9]),
-                dbus.Byte(Waterrower_byte_values[10]), dbus.Byte(Waterrower_byte_values[11]),dbus.Byte(Waterrower_byte_values[12]),dbus.Byte(Waterrower_byte_values[13]),dbus.Byte(Waterrower_byte_values[14]),
-                dbus.Byte(Waterrower_byte_values[15]),
-                dbus.Byte(Waterrower_byte_values[16]), dbus.Byte(Waterrower_byte_values[17]),
-                ]
-            self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
-        return self.notifying
-
-    def _update_Waterrower_cb_value(self):
-        print('Update Waterrower Rower Data')
-
-        if not self.notifying:
-            return
-
-        GLib.timeout_add(200, self.Waterrower_cb)
+    def _unsubscribed(self):
+        global pending_trace
+        self.notifying = False
+        notify_scheduler.unsubscribe(self)
+        if pending_trace is not None:
+            # no notification will stamp it, a later subscriber must not get it as its own
+            latency.tracer.discard(pending_trace)
+            pending_trace = None
 
     def StartNotify(self):
-        if self.notifying:
+        if self.fanout.signal_sink is not None:
             print('Already notifying, nothing to do')
             return
 
-        self.notifying = True
-        self._update_Waterrower_cb_value()
+        print('Start Rower Data Notify')
+        self.fanout.start_signal()
+        self._subscribed()
 
     def StopNotify(self):
-        if not self.notifying:
+        if self.fanout.signal_sink is None:
             print('Not notifying, nothing to do')
             return
 
-        self.notifying = False
-        self._update_Waterrower_cb_value()
+        self.fanout.stop_signal()
+
+    def AcquireNotify(self, options):
+        print('Acquire Rower Data Notify')
+        fd, mtu = self.fanout.acquire(options)
+        self._subscribed()
+        return fd, mtu
 
 
 ###### todo: function needed to get all the date from waterrower
@@ -386,6 +394,7 @@ class HeartRate(Service):
 class HeartRateMeasurement(Characteristic):
     HEART_RATE_MEASUREMENT = '2a37'
     last_hr = 0
+    min_interval_ms = 1000  # a strap sends about once a second, so do we
 
     def __init__(self, bus, index, service):
         Characteristic.__init__(
@@ -394,40 +403,54 @@ class HeartRateMeasurement(Characteristic):
             ['notify'],
             service)
         self.notifying = False
+        self.fanout = Fanout(self, on_empty=self._unsubscribed)
+        notifying_characteristics.append(self)
+
+    def get_properties(self):
+        properties = Characteristic.get_properties(self)
+        properties[GATT_CHRC_IFACE]['NotifyAcquired'] = dbus.Boolean(False)
+        return properties
 
-    def Waterrower_cb(self):
+    def notify_update(self):
+        if WaterrowerValuesRaw is None:
+            return False
         hr = WaterrowerValuesRaw['heart_rate'];
         if self.last_hr != hr:
             self.last_hr = hr
             print("new ble hr: %d" % self.last_hr)
-            value = [dbus.Byte(0),dbus.Byte(self.last_hr & 0xff)]
+            return self.fanout.send(bytes((0, self.last_hr & 0xff)))
+        return False
 
-            self.PropertiesChanged(GATT_CHRC_IFACE, { 'Value': value }, [])
-        return self.notifying
-
-    def _update_Waterrower_cb_value(self):
-        print('Update Waterrower HR Data')
-
-        if not self.notifying:
-            return
+    def _subscribed(self):
+        self.notifying = True
+        self.last_hr = None
+        notify_scheduler.subscribe(self)
 
-        GLib.timeout_add(1000, self.Waterrower_cb)
+    def _unsubscribed(self):
+        self.notifying = False
+        notify_scheduler.unsubscribe(self)
 
     def StartNotify(self):
-        if self.notifying:
+        if self.fanout.signal_sink is not None:
             print('Already notifying, nothing to do')
             return
 
         print('Start HR Notify')
-        self.notifying = True
-        self._update_Waterrower_cb_value()
+        self.fanout.start_signal()
+        self._subscribed()
         
     def StopNotify(self):
-        if not self.notifying:
+        if self.fanout.signal_sink is None:
             print('Not notifying, nothing to do')
             return
 
-        self.notifying = False
+        self.fanout.stop_signal()
+
+    def AcquireNotify(self, options):
+        print('Acquire HR Notify')
+        fd, mtu = self.fanout.acquire(options)
+        self._subscribed()
+        return fd, mtu
 
 
 class FTMPAdvertisement(Advertisement):
@@ -461,53 +484,127 @@ def sigint_handler(sig, frame):
 
 AGENT_PATH = "/com/inonoob/agent"
 
+WaterrowerValuesRaw = None
 WaterrowerValuesRaw_polled = None
+notify_scheduler = None  # NotifyScheduler, created in main before the characteristics
+notifying_characteristics = []  # characteristics with a Fanout, for notify_stats
+pending_trace = None  # latency trace of the values waiting for the next rower data notification
 
 def Waterrower_poll():
     global WaterrowerValuesRaw
     global WaterrowerValuesRaw_polled
+    global pending_trace
 
     if ble_in_q_value:
         WaterrowerValuesRaw = ble_in_q_value.pop()
-        for keys in WaterrowerValuesRaw:
-            WaterrowerValuesRaw[keys] = int(WaterrowerValuesRaw[keys])
+        trace = None
+        if isinstance(WaterrowerValuesRaw, tuple):
+            # S4 side sends (values, trace)
+            WaterrowerValuesRaw, trace = WaterrowerValuesRaw
+        # the S4 side shares one read only snapshot, the BLE side keeps its own int copy
+        WaterrowerValuesRaw = {key: int(value) for key, value in WaterrowerValuesRaw.items()}
 
         if WaterrowerValuesRaw_polled != WaterrowerValuesRaw:
             WaterrowerValuesRaw_polled = WaterrowerValuesRaw
             print("rower", WaterrowerValuesRaw_polled)
+            notify_scheduler.changed()
+            # only followed while a rower data notification is coming, otherwise there is no
+            # 'notified' stamp for it and it would only hold the place of a later trace
+            if trace is not None and pending_trace is None and rower_data_notifying():
+                trace['polled'] = latency.stamp()
+                pending_trace = trace
+
+    return True
+
+
+def rower_data_notifying():
+    return any(isinstance(chrc, RowerData) and chrc.notifying for chrc in notifying_characteristics)
+
+
+def notify_stats():
+    # scheduler counters plus the per subscriber counters of every notifying characteristic
+    stats = {'scheduler': dict(notify_scheduler.stats) if notify_scheduler else {}}
+    for chrc in notifying_characteristics:
+        stats[chrc.uuid] = chrc.fanout.stats()
+    return stats
 
+
+def log_notify_stats():
+    for name, entry in notify_stats().items():
+        logger.info("notify %s: %s", name, entry)
+
+
+def Waterrower_ready(fd, condition):
+    # ble_in_q became readable: new values were published on the S4 side
+    Waterrower_poll()
     return True
 
 
-def main(out_q,ble_in_q): #out_q
+def release(registered, app, advertisement, agent):
+    # gives the advertisement, the GATT application and their object paths back, so a restarted
+    # BLE worker can register them again on the same bus connection, and takes its GLib sources off
+    # the default main context
+    if 'source' in registered:
+        GLib.source_remove(registered.pop('source'))
+    if notify_scheduler is not None:
+        notify_scheduler.close()
+    for manager, method, obj in (('ad_manager', 'UnregisterAdvertisement', advertisement),
+                                 ('service_manager', 'UnregisterApplication', app)):
+        if manager in registered:
+            try:
+                getattr(registered[manager], method)(obj.get_path())
+            except dbus.exceptions.DBusException as e:
+                logger.warning("%s failed: %s", method, e)
+    objects = [advertisement, agent, app]
+    for service in app.services:
+        objects.append(service)
+        for chrc in service.get_characteristics():
+            objects.append(chrc)
+            objects.extend(chrc.get_descriptors())
+    for chrc in notifying_characteristics:
+        chrc.fanout.close()
+    del notifying_characteristics[:]
+    for obj in objects:
+        try:
+            obj.remove_from_connection()
+        except Exception as e:
+            logger.debug("could not remove %s: %s", obj, e)
+
+
+STARTUP_PHASES = ("bus", "adapter", "objects", "agent", "power", "advertisement", "application")
+startup_timer = None  # StartupTimer of the last start, the breakdown is logged once advertising
+
+
+def main(out_q,ble_in_q, notify_interval_ms=None): #out_q
+    # notify_interval_ms: minimum time between two notifications, None for the connection interval
     global mainloop
     global out_q_reset
     global ble_in_q_value
+    global startup_timer
     out_q_reset = out_q
     ble_in_q_value = ble_in_q
+    startup = startup_timer = StartupTimer("ble", expected=STARTUP_PHASES)
 
+    startup.begin("bus")
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
 
     # get the system bus
     bus = dbus.SystemBus()
-    # get the ble controller
-    adapter = find_adapter(bus)
+    startup.end("bus")
+
+    # get the ble controller; the full object walk of find_adapter only when nothing is cached
+    startup.begin("adapter")
+    adapter = cached_adapter()
+    cached = adapter is not None
+    if not cached:
+        adapter = find_adapter(bus)
+    startup.end("adapter", "cached" if cached else "lookup")
 
     if not adapter:
         logger.critical("GattManager1 interface not found")
         return
 
-    adapter_obj = bus.get_object(BLUEZ_SERVICE_NAME, adapter)
-
-    adapter_props = dbus.Interface(adapter_obj, "org.freedesktop.DBus.Properties")
-
-    # powered property on the controller to on
-    adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1))
-
-    # Get manager objs
-    service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
-    ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
-
+    startup.begin("objects")
     global global_advertisement
     global_advertisement = FTMPAdvertisement(bus, 0)
     advertisement = global_advertisement
@@ -516,37 +613,119 @@ def main(out_q,ble_in_q): #out_q
 
     agent = Agent(bus, AGENT_PATH)
 
+    global notify_scheduler
+    notify_scheduler = NotifyScheduler(notify_interval_ms)
+    registry.register('ble', lambda: registry.Labelled('characteristic', notify_stats()))
+
     app = Application(bus)
     app.add_service(DeviceInformation(bus, 1))
     app.add_service(FTMservice(bus, 2))
     app.add_service(HeartRate(bus,3))
 
-    GLib.timeout_add(100, Waterrower_poll)
+    # what release() has to give back when this worker ends
+    registered = {}
+    if hasattr(ble_in_q, 'set_listener'):
+        # single loop: the S4 runs on this main loop and hands values over directly
+        ble_in_q.set_listener(Waterrower_poll)
+    elif hasattr(ble_in_q, 'fileno'):
+        # push based: wake up only when the S4 side published new values
+        registered['source'] = GLib.io_add_watch(ble_in_q.fileno(), GLib.PRIORITY_DEFAULT, GLib.IO_IN,
+                                                 Waterrower_ready)
+    else:
+        registered['source'] = GLib.timeout_add(100, Waterrower_poll)
 
     mainloop = MainLoop()
+    startup.end("objects")
 
+    # all registrations below are asynchronous: they go out together and the replies come back
+    # once mainloop runs. Only advertisement and application wait for the adapter to be powered.
     agent_manager = dbus.Interface(obj, "org.bluez.AgentManager1")
-    agent_manager.RegisterAgent(AGENT_PATH, "NoInputNoOutput") # register the bluetooth agent with no input and output which should avoid asking for pairing 
-
-    ad_manager.RegisterAdvertisement(
-        advertisement.get_path(),
-        {},
-        reply_handler=register_ad_cb,
-        error_handler=register_ad_error_cb,
-    )
-
-    logger.info("Registering GATT application...")
-
-    service_manager.RegisterApplication(
-        app.get_path(),
-        {},
-        reply_handler=register_app_cb,
-        error_handler=[register_app_error_cb],
-    )
-
-    agent_manager.RequestDefaultAgent(AGENT_PATH)
 
-    mainloop.run()
+    def agent_default_cb():
+        startup.end("agent")
+
+    def agent_registered_cb():
+        agent_manager.RequestDefaultAgent(AGENT_PATH, reply_handler=agent_default_cb,
+                                          error_handler=agent_error_cb)
+
+    def agent_error_cb(error):
+        # pairing prompts are a nuisance, not a reason to stop
+        logger.error("Failed to register agent: " + str(error))
+        startup.end("agent", "failed")
+
+    startup.begin("agent")
+    agent_manager.RegisterAgent(AGENT_PATH, "NoInputNoOutput", # register the bluetooth agent with no input and output which should avoid asking for pairing 
+                                reply_handler=agent_registered_cb, error_handler=agent_error_cb)
+
+    def setup_adapter(adapter, cached):
+        # no Introspect round trip for the adapter, so every call below that dbus-python cannot
+        # guess (variants, empty dicts) carries its signature
+        adapter_obj = bus.get_object(BLUEZ_SERVICE_NAME, adapter, introspect=False)
+        adapter_props = dbus.Interface(adapter_obj, "org.freedesktop.DBus.Properties")
+
+        # Get manager objs
+        service_manager = dbus.Interface(adapter_obj, GATT_MANAGER_IFACE)
+        ad_manager = dbus.Interface(adapter_obj, LE_ADVERTISING_MANAGER_IFACE)
+
+        def ad_registered_cb():
+            startup.end("advertisement")
+            register_ad_cb()
+
+        def app_registered_cb():
+            startup.end("application")
+            register_app_cb()
+
+        def powered_cb():
+            startup.end("power")
+            remember_adapter(adapter)
+            registered['ad_manager'] = ad_manager
+            registered['service_manager'] = service_manager
+
+            startup.begin("advertisement")
+            ad_manager.RegisterAdvertisement(
+                advertisement.get_path(),
+                dbus.Dictionary({}, signature='sv'),
+                signature='oa{sv}',
+                reply_handler=ad_registered_cb,
+                error_handler=register_ad_error_cb,
+            )
+
+            logger.info("Registering GATT application...")
+
+            startup.begin("application")
+            service_manager.RegisterApplication(
+                app.get_path(),
+                dbus.Dictionary({}, signature='sv'),
+                signature='oa{sv}',
+                reply_handler=app_registered_cb,
+                error_handler=register_app_error_cb,
+            )
+
+        def power_error_cb(error):
+            if cached:
+                # the adapter went away or got renamed since the last run
+                logger.warning("cached adapter %s not usable (%s), looking it up", adapter, error)
+                forget_adapter()
+                startup.begin("adapter")
+                found = find_adapter(bus)
+                startup.end("adapter", "lookup after stale cache")
+                if found:
+                    setup_adapter(found, False)
+                    return
+            logger.critical("Failed to power the adapter: " + str(error))
+            mainloop.quit()
+
+        # powered property on the controller to on
+        startup.begin("power")
+        adapter_props.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(1, variant_level=1),
+                          signature='ssv', reply_handler=powered_cb, error_handler=power_error_cb)
+
+    setup_adapter(adapter, cached)
+
+    try:
+        mainloop.run()
+    finally:
+        release(registered, app, advertisement, agent)
     # ad_manager.UnregisterAdvertisement(advertisement)
     # dbus.service.Object.remove_from_connection(advertisement)
 
@@ -0,0 +1,118 @@
+import os
+import threading
+
+'''
+Latest-value handoff between the S4 thread and the BLE main loop.
+
+Works like the deque(maxlen=1) it replaces (append / pop / truth test) but also has a file
+descriptor that becomes readable when a new value is published, so the consumer can sleep in its
+main loop (GLib.io_add_watch) instead of polling on a timer. Only the newest value is kept; a
+value that is overwritten before the consumer woke up is simply skipped.
+'''
+
+
+class ValueChannel(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._item = None
+        self._has_item = False
+        self._signalled = False
+        if hasattr(os, 'eventfd'):
+            self._read_fd = self._write_fd = os.eventfd(0, os.EFD_NONBLOCK | os.EFD_CLOEXEC)
+        else:
+            self._read_fd, self._write_fd = os.pipe()
+            os.set_blocking(self._read_fd, False)
+            os.set_blocking(self._write_fd, False)
+        self.published = 0
+        self.taken = 0
+
+    def fileno(self):
+        return self._read_fd
+
+    def append(self, item):
+        with self._lock:
+            self._item = item
+            self._has_item = True
+            self.published += 1
+            if not self._signalled:
+                self._signalled = True
+                self._signal()
+
+    def pop(self):
+        with self._lock:
+            if not self._has_item:
+                raise IndexError('pop from an empty ValueChannel')
+            item = self._item
+            self._item = None
+            self._has_item = False
+            self.taken += 1
+            if self._signalled:
+                self._signalled = False
+                self._drain()
+            return item
+
+    def __len__(self):
+        return 1 if self._has_item else 0
+
+    def _signal(self):
+        if self._read_fd == self._write_fd:
+            os.eventfd_write(self._write_fd, 1)
+        else:
+            os.write(self._write_fd, b'\x01')
+
+    def _drain(self):
+        try:
+            if self._read_fd == self._write_fd:
+                os.eventfd_read(self._read_fd)
+            else:
+                while os.read(self._read_fd, 64):
+                    pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        os.close(self._read_fd)
+        if self._write_fd != self._read_fd:
+            os.close(self._write_fd)
+
+
+class LocalValue(object):
+    '''
+    Same thread counterpart of ValueChannel for the single main loop mode (--single-loop): the S4
+    and the BLE side run on one GLib loop, so append() hands the value straight to the listener
+    instead of waking up another thread.
+    '''
+
+    def __init__(self):
+        self._item = None
+        self._has_item = False
+        self._listener = None
+        self.published = 0
+        self.taken = 0
+
+    def set_listener(self, listener):
+        self._listener = listener
+        if self._has_item:
+            listener()
+
+    def append(self, item):
+        self._item = item
+        self._has_item = True
+        self.published += 1
+        if self._listener is not None:
+            self._listener()
+
+    def pop(self):
+        if not self._has_item:
+            raise IndexError('pop from an empty LocalValue')
+        item = self._item
+        self._item = None
+        self._has_item = False
+        self.taken += 1
+        return item
+
+    def __len__(self):
+        return 1 if self._has_item else 0
+
+    def close(self):
+        self._listener = None
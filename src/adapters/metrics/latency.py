@@ -0,0 +1,97 @@
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+'''
+End to end latency of a value, from the S4 serial packet to the BLE notification.
+
+A trace is a small dict of wall clock timestamps in ms, one per stage the value went through:
+    serial   -> event decoded from the serial port (the event 'at')
+    logger   -> DataLogger applied the event to WRValues
+    queued   -> values handed to the BLE thread
+    polled   -> BLE main loop picked them up
+    notified -> rower data notification sent
+Every finished trace is fed to the tracer, which keeps a histogram per hop and one for the whole
+path. report() gives p50/p95/p99 on demand. A trace whose values were never notified (no
+subscriber, nothing new to send) is discarded and only counted as unsent.
+'''
+
+TRACE_POINTS = ('serial', 'logger', 'queued', 'polled', 'notified')
+SAMPLE_WINDOW = 1024  # newest samples kept per histogram for the percentiles
+PERCENTILES = (50, 95, 99)
+
+
+def stamp():
+    return time.time() * 1000
+
+
+class LatencyHistogram(object):
+    def __init__(self, window=SAMPLE_WINDOW):
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, ms):
+        with self._lock:
+            self._samples.append(ms)
+            self.count += 1
+            if ms > self.max:
+                self.max = ms
+
+    def summary(self):
+        with self._lock:
+            samples = sorted(self._samples)
+            count = self.count
+            worst = self.max
+        result = {'count': count, 'max': worst}
+        for p in PERCENTILES:
+            if samples:
+                # nearest rank
+                index = min(len(samples) - 1, max(0, int(round(p / 100.0 * len(samples))) - 1))
+                result['p%d' % p] = samples[index]
+            else:
+                result['p%d' % p] = None
+        return result
+
+
+class LatencyTracer(object):
+    def __init__(self, points=TRACE_POINTS):
+        self.points = points
+        self.stages = ['%s->%s' % (a, b) for a, b in zip(points, points[1:])] + ['total']
+        self._histograms = {stage: LatencyHistogram() for stage in self.stages}
+        self.unsent = 0
+
+    def record(self, trace):
+        present = [(point, trace[point]) for point in self.points if trace.get(point) is not None]
+        if len(present) < 2:
+            return
+        for (a, start), (b, end) in zip(present, present[1:]):
+            stage = '%s->%s' % (a, b)
+            histogram = self._histograms.get(stage)
+            if histogram is None:
+                # a point was skipped, the hop still gets its own histogram
+                histogram = self._histograms.setdefault(stage, LatencyHistogram())
+            histogram.add(end - start)
+        self._histograms['total'].add(present[-1][1] - present[0][1])
+
+    def discard(self, trace):
+        self.unsent += 1
+
+    def report(self):
+        return {stage: histogram.summary() for stage, histogram in self._histograms.items()}
+
+    def log_report(self, log=logger):
+        for stage, summary in self.report().items():
+            if not summary['count']:
+                continue
+            log.info("latency %-18s n=%-6d p50=%7.1fms p95=%7.1fms p99=%7.1fms max=%7.1fms",
+                     stage, summary['count'], summary['p50'], summary['p95'], summary['p99'], summary['max'])
+        if self.unsent:
+            log.info("latency %d traces not notified", self.unsent)
+
+
+tracer = LatencyTracer()
@@ -0,0 +1,93 @@
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+'''
+Named sources of counters for the /metrics page of the live server.
+
+A worker registers a callable returning a dict of its counters (nested dicts are fine) under a
+name; registering the same name again, e.g. after a restart of the worker, replaces the old one.
+collect() calls every source, prometheus() renders the numbers in the Prometheus text format,
+every metric family as one group under its TYPE line:
+    # TYPE rowflo_s4_capture_reads untyped
+    rowflo_s4_capture_reads 1234
+    # TYPE rowflo_s4_poll_polls untyped
+    rowflo_s4_poll_polls{address="055"} 812
+    rowflo_s4_poll_polls{address="140"} 809
+The keys of a Labelled dict (register addresses, devices, ...) become the value of its label. Any
+other key that is not a plain name (a latency stage) becomes a label 'key'. Strings are left out,
+booleans are 0 / 1.
+'''
+
+PREFIX = 'rowflo'
+NAME_PART = re.compile(r'^[a-zA-Z_][a-zA-Z0-9_]*$')
+UNSAFE = re.compile(r'[^a-zA-Z0-9_]')
+
+_sources = {}  # name -> callable
+
+
+class Labelled(dict):
+    # a dict of like entries, its keys are the values of the label
+    def __init__(self, label, entries):
+        dict.__init__(self, entries)
+        self.label = label
+
+
+def register(name, source):
+    _sources[name] = source
+
+
+def unregister(name):
+    _sources.pop(name, None)
+
+
+def collect():
+    result = {}
+    for name, source in list(_sources.items()):
+        try:
+            result[name] = source()
+        except Exception as e:
+            # counters of another thread may change while read, the next scrape gets them
+            logger.debug("metrics source %s failed: %s", name, e)
+    return result
+
+
+def flatten(value, name, labels, out):
+    if isinstance(value, bool):
+        out.append((name, labels, int(value)))
+    elif isinstance(value, (int, float)):
+        out.append((name, labels, value))
+    elif isinstance(value, Labelled):
+        for key, item in value.items():
+            flatten(item, name, labels + ((value.label, str(key)),), out)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            key = str(key)
+            if NAME_PART.match(key):
+                flatten(item, name + '_' + key, labels, out)
+            else:
+                label = 'key' if not labels else 'key%d' % (len(labels) + 1)
+                flatten(item, name, labels + ((label, key),), out)
+
+
+def prometheus(metrics=None):
+    samples = []
+    for source, value in (collect() if metrics is None else metrics).items():
+        flatten(value, PREFIX + '_' + UNSAFE.sub('_', source), (), samples)
+    # the lines of a metric family have to be one group under its TYPE line; the sources do not
+    # tell counters from gauges, so the families are untyped
+    families = {}
+    for name, labels, value in samples:
+        families.setdefault(name, []).append((labels, value))
+    lines = []
+    for name, entries in families.items():
+        lines.append('# TYPE %s untyped' % name)
+        for labels, value in entries:
+            if labels:
+                text = ','.join('%s="%s"' % (label, key.replace('\\', '\\\\').replace('"', '\\"'))
+                                for label, key in labels)
+                lines.append('%s{%s} %s' % (name, text, value))
+            else:
+                lines.append('%s %s' % (name, value))
+    return '\n'.join(lines) + '\n'
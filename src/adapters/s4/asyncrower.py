@@ -0,0 +1,156 @@
+import asyncio
+import logging
+
+import serial
+
+from . import waterrowerinterface
+from .waterrowerinterface import RowerBase, build_event, scan_port, INFLIGHT_WINDOW, REQUEST_GAP, \
+    USB_REQUEST, EXIT_REQUEST
+
+logger = logging.getLogger(__name__)
+
+'''
+Asyncio front end for the S4, an alternative to the two daemon threads of Rower.
+
+The port is opened non blocking and its file descriptor is watched with loop.add_reader, so a read
+only happens when the kernel has bytes for us and takes all of them. The poll requests are a
+coroutine on the same loop, and so is everything the callbacks do (DataLogger update, publishing):
+one thread, no locks handed around, no thread switch between the serial read and the snapshot.
+
+Same callback API and statistics as Rower (both are RowerBase). A transport without a file
+descriptor (a replayed capture) is read by a small polling coroutine instead.
+'''
+
+READ_POLL_INTERVAL = 0.01   # seconds between reads of a transport without a file descriptor
+RECONNECT_WAIT = 5          # seconds between looks for the S4 while it is not plugged in
+
+
+class AsyncRower(RowerBase):
+    def __init__(self, options=None, inflight_window=INFLIGHT_WINDOW, device=None):
+        RowerBase.__init__(self, options, inflight_window, device)
+        self._loop = None
+        self._reader_fd = None
+        self._reader_task = None
+        self._request_task = None
+        self._reconnect_task = None
+        self._stopped = False
+
+    def is_connected(self):
+        return self._serial.isOpen() and self._request_task is not None and not self._request_task.done()
+
+    async def open(self):
+        # waits until the port is open, then starts reading and requesting on the running loop
+        self._loop = asyncio.get_running_loop()
+        self._stopped = False
+        await self._find_serial()
+        self._pipeline.clear()
+        self._framer.clear()
+        self._start_reading()
+        if self._request_task is None or self._request_task.done():
+            self._request_task = self._loop.create_task(self.start_requesting())
+        self.write(USB_REQUEST)
+        self.link_up()
+
+    async def _find_serial(self):
+        attempts = 0
+        while True:
+            if not self._demo:
+                path = scan_port(self.device)
+                if path is None:
+                    if attempts % 360 == 0:  # message every ~30 minutes
+                        logger.warning("port not found; retrying every %ds", RECONNECT_WAIT)
+                    attempts += 1
+                    await asyncio.sleep(RECONNECT_WAIT)
+                    continue
+                self._serial.port = path
+            try:
+                self._serial.timeout = 0  # reads return what is there instead of waiting
+                self._serial.open()
+                logger.info("serial open")
+                return
+            except serial.SerialException as e:
+                logger.error("serial open error %s, waiting", e)
+                self._serial.close()
+                await asyncio.sleep(RECONNECT_WAIT)
+
+    def _start_reading(self):
+        try:
+            fd = self._serial.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        if fd is not None:
+            self._reader_fd = fd
+            self._loop.add_reader(fd, self._on_readable)
+        else:
+            self._reader_task = self._loop.create_task(self._poll_reads())
+
+    def _stop_reading(self):
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            self._reader_task = None
+
+    def _on_readable(self):
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except Exception as e:
+            logger.error("could not read %s" % e)
+            self._reconnect()
+            return
+        if data:
+            self.handle_data(data)
+
+    async def _poll_reads(self):
+        while self._serial.isOpen():
+            data = self._serial.read(self._serial.in_waiting or 1)
+            if data:
+                self.handle_data(data)
+            else:
+                await asyncio.sleep(READ_POLL_INTERVAL)
+
+    async def start_requesting(self):
+        pipeline = self._pipeline
+        while not self._stopped:
+            if self._serial.isOpen():
+                address, wait = self.next_read()
+                if address is None:
+                    await asyncio.sleep(min(wait, 0.1))
+                    continue
+                self.request_address(address)
+                pipeline.sent(address)
+                await asyncio.sleep(REQUEST_GAP)
+            else:
+                await asyncio.sleep(0.1)
+
+    def _reconnect(self):
+        if self._stopped or (self._reconnect_task and not self._reconnect_task.done()):
+            return
+        self.link_lost("serial error")
+        self._stop_reading()
+        try:
+            self._serial.close()
+        except Exception:
+            pass
+        self._reconnect_task = self._loop.create_task(self.open())
+
+    def write(self, raw):
+        try:
+            self._serial.write(str.encode(raw.upper() + '\r\n'))
+        except Exception as e:
+            logger.error("could not write %s" % e)
+            self._reconnect()
+
+    def close(self):
+        self.notify_callbacks(build_event("exit"))
+        self._stopped = True
+        self._stop_reading()
+        for task in (self._request_task, self._reconnect_task):
+            if task is not None:
+                task.cancel()
+        if self._serial and self._serial.isOpen():
+            self.write(EXIT_REQUEST)
+            self._serial.close()
+        if isinstance(self._serial, waterrowerinterface.RecordingSerial):
+            self._serial.close_capture()
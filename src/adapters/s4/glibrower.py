@@ -0,0 +1,186 @@
+import logging
+
+import serial
+
+try:
+    from gi.repository import GLib
+except ImportError:
+    GLib = None
+
+from . import waterrowerinterface
+from .waterrowerinterface import RowerBase, build_event, scan_port, INFLIGHT_WINDOW, REQUEST_GAP, \
+    USB_REQUEST, EXIT_REQUEST
+
+logger = logging.getLogger(__name__)
+
+'''
+GLib front end for the S4, for running the whole pipeline on the BLE main loop.
+
+The port is opened non blocking and its file descriptor is watched with GLib.io_add_watch; the
+poll requests are a one shot GLib timer re-armed with whatever the scheduler says is the next due
+time. The DataLogger callbacks run in the watch callback, so a value goes from the serial read to
+the BLE characteristic without leaving the loop (see wrtobleant.start_glib and --single-loop).
+
+Nothing here blocks: while the S4 is not plugged in the port is looked for again every
+RECONNECT_WAIT seconds from a timer. A transport without a file descriptor (a replayed capture)
+is read from a short timer instead.
+'''
+
+READ_POLL_INTERVAL_MS = 10  # reads of a transport without a file descriptor
+RECONNECT_WAIT = 5          # seconds between looks for the S4 while it is not plugged in
+
+
+class GLibRower(RowerBase):
+    def __init__(self, options=None, inflight_window=INFLIGHT_WINDOW, device=None):
+        if GLib is None:
+            raise RuntimeError('GLibRower needs PyGObject (gi.repository.GLib)')
+        RowerBase.__init__(self, options, inflight_window, device)
+        self._watch = None
+        self._request_source = None
+        self._retry_source = None
+        self._reset_on_open = False
+        self._stopped = False
+
+    def is_connected(self):
+        return self._serial.isOpen() and self._watch is not None
+
+    def is_closed(self):
+        return self._stopped
+
+    def open(self, reset=False):
+        # returns right away; reset sends a reset request once the port is open
+        self._stopped = False
+        self._reset_on_open = self._reset_on_open or reset
+        if self._serial.isOpen():
+            self._stop_io()
+            self._serial.close()
+        if self._try_open():
+            self._started()
+        elif self._retry_source is None:
+            logger.warning("port not found; retrying every %ds", RECONNECT_WAIT)
+            self._retry_source = GLib.timeout_add_seconds(RECONNECT_WAIT, self._retry_open)
+
+    def _retry_open(self):
+        if not self._stopped and not self._try_open():
+            return True
+        self._retry_source = None
+        if not self._stopped:
+            self._started()
+        return False
+
+    def _try_open(self):
+        if not self._demo:
+            path = scan_port(self.device)
+            if path is None:
+                return False
+            self._serial.port = path
+        try:
+            self._serial.timeout = 0  # reads return what is there instead of waiting
+            self._serial.open()
+        except serial.SerialException as e:
+            logger.error("serial open error %s", e)
+            self._serial.close()
+            return False
+        logger.info("serial open")
+        return True
+
+    def _started(self):
+        self._pipeline.clear()
+        self._framer.clear()
+        try:
+            fd = self._serial.fileno()
+        except (AttributeError, OSError):
+            fd = None
+        if fd is not None:
+            self._watch = GLib.io_add_watch(fd, GLib.PRIORITY_DEFAULT,
+                                            GLib.IO_IN | GLib.IO_ERR | GLib.IO_HUP, self._on_readable)
+        else:
+            self._watch = GLib.timeout_add(READ_POLL_INTERVAL_MS, self._poll_reads)
+        self.write(USB_REQUEST)
+        self.link_up()
+        if self._reset_on_open:
+            self._reset_on_open = False
+            self.reset_request()
+        self._schedule_request(0)
+
+    def _stop_io(self):
+        for source in (self._watch, self._request_source):
+            if source is not None:
+                GLib.source_remove(source)
+        self._watch = None
+        self._request_source = None
+
+    def _on_readable(self, fd, condition):
+        if condition & (GLib.IO_ERR | GLib.IO_HUP):
+            logger.error("serial port closed by the device")
+            self._watch = None
+            self._reconnect()
+            return False
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except Exception as e:
+            logger.error("could not read %s" % e)
+            self._watch = None
+            self._reconnect()
+            return False
+        if data:
+            self.handle_data(data)
+        return True
+
+    def _poll_reads(self):
+        if not self._serial.isOpen():
+            self._watch = None
+            return False
+        data = self._serial.read(self._serial.in_waiting or 1)
+        if data:
+            self.handle_data(data)
+        return True
+
+    def _schedule_request(self, delay):
+        if self._request_source is None:
+            self._request_source = GLib.timeout_add(max(1, int(delay * 1000)), self._request_tick)
+
+    def _request_tick(self):
+        self._request_source = None
+        if self._stopped or not self._serial.isOpen():
+            return False
+        address, wait = self.next_read()
+        if address is None:
+            self._schedule_request(min(wait, 0.1))
+            return False
+        self.request_address(address)
+        self._pipeline.sent(address)
+        if self._serial.isOpen():
+            self._schedule_request(REQUEST_GAP)
+        return False
+
+    def _reconnect(self):
+        if self._stopped or self._retry_source is not None:
+            return
+        self.link_lost("serial error")
+        self._stop_io()
+        try:
+            self._serial.close()
+        except Exception:
+            pass
+        self.open()
+
+    def write(self, raw):
+        try:
+            self._serial.write(str.encode(raw.upper() + '\r\n'))
+        except Exception as e:
+            logger.error("could not write %s" % e)
+            self._reconnect()
+
+    def close(self):
+        self.notify_callbacks(build_event("exit"))
+        self._stopped = True
+        self._stop_io()
+        if self._retry_source is not None:
+            GLib.source_remove(self._retry_source)
+            self._retry_source = None
+        if self._serial and self._serial.isOpen():
+            self.write(EXIT_REQUEST)
+            self._serial.close()
+        if isinstance(self._serial, waterrowerinterface.RecordingSerial):
+            self._serial.close_capture()
@@ -0,0 +1,125 @@
+import asyncio
+import logging
+
+from . import asyncrower
+from . import waterrowerinterface
+from . import wrtobleant
+from ..metrics import registry
+
+logger = logging.getLogger(__name__)
+
+'''
+Hub mode: one process serving every S4 monitor plugged into the host.
+
+Every S4 found by waterrowerinterface.scan_ports gets its own AsyncRower and DataLogger, and all of
+them run on one asyncio event loop in one thread. A rower costs a file descriptor watch, a poll
+request coroutine and its share of the callbacks, no threads of its own, so the CPU follows the
+serial traffic and not the number of threads waking up. The ports are looked at again every
+SCAN_INTERVAL seconds, a monitor plugged in later joins; one that is unplugged keeps its
+DataLogger (stale values) and reconnects on its own, like a single rower does.
+
+A rower is known by its device id (the USB serial number, see scan_ports). Its values go to the
+outputs handed out for that id, e.g. the live server channel /rowers/<id>/. One GATT server holds
+one rower data service, so BLE serves one of the rowers: the device given with --hub-ble, otherwise
+the first one found. BLE commands (reset, heart rate) go to that rower only.
+
+stats() has the capture, link and snapshot counters per device, the 'hub' source of /metrics.
+'''
+
+SCAN_INTERVAL = 5          # seconds between looks for newly plugged in monitors
+REPLAY_DEVICE = 'replay'   # device id of a replayed capture (--s4-replay), there is no port to scan
+
+
+class HubRower(object):
+    def __init__(self, device, S4, datalogger, recorder, on_ble):
+        self.device = device
+        self.S4 = S4
+        self.datalogger = datalogger
+        self.recorder = recorder
+        self.on_ble = on_ble
+        self.task = None
+
+    def stats(self):
+        return {'ble': self.on_ble,
+                'capture': dict(self.S4.capture_stats),
+                'link': dict(self.S4.link_stats),
+                'snapshots': self.datalogger.get_snapshot_stats(),
+                'recorder': dict(self.recorder.stats) if self.recorder is not None else {}}
+
+
+class Hub(object):
+    def __init__(self, ble_out_q=None, options=None, state=None, outputs_for=None):
+        # outputs_for(device, on_ble): the DataLogger outputs of a rower besides the BLE queue
+        self.ble_out_q = ble_out_q
+        self.options = options
+        self.state = state if state is not None else {}
+        self.outputs_for = outputs_for or (lambda device, on_ble: ())
+        self.ble_device = getattr(options, 'hub_ble', None)
+        self.rowers = {}    # device id -> HubRower
+        self.primary = None
+
+    def discover(self):
+        # blocking (list_ports reads sysfs), run in an executor
+        if getattr(self.options, 's4_replay', None):
+            return [REPLAY_DEVICE]
+        return [device for path, device in waterrowerinterface.scan_ports()]
+
+    def add(self, device):
+        S4 = asyncrower.AsyncRower(self.options, device=None if device == REPLAY_DEVICE else device)
+        device_state = self.state.setdefault('devices', {}).setdefault(device, {})
+        on_ble = self.primary is None and self.ble_out_q is not None and \
+            (self.ble_device is None or self.ble_device == device)
+        recorder = wrtobleant.start_recorder(S4, self.options, device_state, device)
+        queues = (self.ble_out_q,) if on_ble else ()
+        datalogger = wrtobleant.DataLogger(
+            S4, outputs=wrtobleant.outputs_for(recorder, queues, self.outputs_for(device, on_ble)))
+        wrtobleant.resume(datalogger, device_state)
+        rower = HubRower(device, S4, datalogger, recorder, on_ble)
+        if on_ble:
+            self.primary = rower
+        self.rowers[device] = rower
+        rower.task = asyncio.get_running_loop().create_task(self._open(rower, device_state))
+        logger.info("S4 %s added to the hub%s", device, " (BLE)" if on_ble else "")
+
+    async def _open(self, rower, device_state):
+        await rower.S4.open()
+        if wrtobleant.first_start(device_state):
+            rower.S4.reset_request()
+        rower.datalogger.publish()
+
+    def stats(self):
+        return {device: rower.stats() for device, rower in list(self.rowers.items())}
+
+    async def run(self, in_q):
+        loop = asyncio.get_running_loop()
+        registry.register('hub', lambda: registry.Labelled('device', self.stats()))
+        next_scan = 0.0
+        try:
+            while True:
+                now = loop.time()
+                if now >= next_scan:
+                    next_scan = now + SCAN_INTERVAL
+                    for device in await loop.run_in_executor(None, self.discover):
+                        if device not in self.rowers:
+                            self.add(device)
+                # sleeps until a BLE command comes, the next scan or the external heart rate check
+                wait = min(wrtobleant.COMMAND_WAIT, max(next_scan - loop.time(), 0))
+                if in_q is not None:
+                    ResetRequest_ble = await wrtobleant.next_command(in_q, wait)
+                else:
+                    ResetRequest_ble = None
+                    await asyncio.sleep(wait)
+                if ResetRequest_ble and self.primary is not None:
+                    wrtobleant.handle_command(self.primary.S4, ResetRequest_ble, self.primary.datalogger)
+                for rower in list(self.rowers.values()):
+                    rower.datalogger.publish()
+        finally:
+            for rower in self.rowers.values():
+                if rower.task is not None:
+                    rower.task.cancel()
+                rower.S4.close()
+
+
+def main(in_q, ble_out_q, options=None, state=None, outputs_for=None):
+    hub = Hub(ble_out_q, options, state, outputs_for)
+    asyncio.run(hub.run(in_q))
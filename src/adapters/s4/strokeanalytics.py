@@ -0,0 +1,188 @@
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+'''
+Per stroke analytics over a rolling ring buffer of S4 samples.
+
+Every watts reading, pulse count (P packet, flywheel pulses in the last 25ms) and speed reading is
+written into fixed size NumPy arrays with its timestamp, which is a couple of index writes per event.
+The stroke boundaries sent by the S4 (SS start of the drive, SE end of the drive) only remember
+where in the ring they happened. When the next SS closes a stroke, the samples of that stroke are
+taken out of the ring in one go and the metrics are computed vectorized:
+    peak and mean power, drive and recovery time (and their ratio), pulses, mean speed
+The finished strokes go into a second ring, from which rolling averages over the last N strokes
+(ROLLING_WINDOWS) and a smoothed pace are computed. A standstill (idle()) starts the windows and the
+smoothed pace over: the watts after a pause are not averaged with the strokes before it.
+
+NumPy is optional; without it StrokeAnalytics is not available and the DataLogger keeps its plain
+4 stroke power average.
+'''
+
+SAMPLE_CAPACITY = 4096    # samples kept, ~60s of rowing at full pulse and poll rate
+STROKE_CAPACITY = 512     # finished strokes kept for the rolling windows
+ROLLING_WINDOWS = (4, 10, 30)
+PACE_SMOOTHING = 0.3      # weight of the newest stroke in the smoothed speed
+MAX_STROKE_MS = 10000     # a "stroke" longer than this spans a pause and is dropped
+
+SAMPLE_WATTS = 0
+SAMPLE_PULSE = 1
+SAMPLE_SPEED = 2
+
+STROKE_FIELDS = ('start_at', 'drive_ms', 'recovery_ms', 'peak_watts', 'mean_watts', 'pulses', 'speed_cmps')
+
+
+class SampleRing(object):
+    def __init__(self, capacity=SAMPLE_CAPACITY):
+        self.capacity = capacity
+        self.at = np.zeros(capacity, dtype=np.int64)
+        self.kind = np.zeros(capacity, dtype=np.int8)
+        self.value = np.zeros(capacity, dtype=np.float64)
+        self.count = 0  # samples written since the start, the position of the next one
+
+    def append(self, at, kind, value):
+        i = self.count % self.capacity
+        self.at[i] = at
+        self.kind[i] = kind
+        self.value[i] = value
+        self.count += 1
+
+    def since(self, position):
+        # samples from position (as returned by count) up to now, oldest first
+        n = min(self.count - position, self.capacity)
+        if n <= 0:
+            empty = np.zeros(0)
+            return empty, empty, empty
+        index = np.arange(self.count - n, self.count) % self.capacity
+        return self.at[index], self.kind[index], self.value[index]
+
+    def clear(self):
+        self.count = 0
+
+
+class StrokeAnalytics(object):
+    def __init__(self, windows=ROLLING_WINDOWS, sample_capacity=SAMPLE_CAPACITY,
+                 stroke_capacity=STROKE_CAPACITY):
+        if np is None:
+            raise RuntimeError('StrokeAnalytics needs numpy')
+        self.windows = tuple(windows)
+        self.samples = SampleRing(sample_capacity)
+        self.stroke_capacity = stroke_capacity
+        self.strokes = {field: np.zeros(stroke_capacity, dtype=np.float64) for field in STROKE_FIELDS}
+        self.stroke_count = 0
+        self.window_start = 0  # stroke_count at the last standstill, the windows begin there
+        self.last_stroke = None
+        self.smoothed_speed = 0.0
+        self._start_at = None
+        self._start_pos = 0
+        self._drive_end_at = None
+
+    def reset(self):
+        self.samples.clear()
+        self.stroke_count = 0
+        self.last_stroke = None
+        self.idle()
+
+    def idle(self):
+        # rower stopped: the stroke in progress is dropped and the rolling windows start over,
+        # the finished strokes stay in the ring for the stroke count
+        self._start_at = None
+        self._drive_end_at = None
+        self.window_start = self.stroke_count
+        self.smoothed_speed = 0.0
+
+    def on_event(self, event):
+        # returns True when the event finished a stroke
+        type = event['type']
+        if type == 'watts':
+            self.samples.append(event['at'], SAMPLE_WATTS, event['value'])
+        elif type == 'pulse':
+            try:
+                pulses = int(event['raw'][1:], 16)
+            except (TypeError, ValueError):
+                return False
+            self.samples.append(event['at'], SAMPLE_PULSE, pulses)
+        elif type == 'avg_distance_cmps':
+            self.samples.append(event['at'], SAMPLE_SPEED, event['value'])
+        elif type == 'stroke_end':
+            if self._start_at is not None:
+                self._drive_end_at = event['at']
+        elif type == 'stroke_start':
+            finished = False
+            if self._start_at is not None and self._drive_end_at is not None:
+                finished = self._finish_stroke(event['at'])
+            self._start_at = event['at']
+            self._start_pos = self.samples.count
+            self._drive_end_at = None
+            return finished
+        return False
+
+    def _finish_stroke(self, end_at):
+        start_at = self._start_at
+        if end_at - start_at > MAX_STROKE_MS:
+            return False
+        at, kind, value = self.samples.since(self._start_pos)
+        watts_mask = kind == SAMPLE_WATTS
+        watts = value[watts_mask]
+        drive_watts = value[watts_mask & (at <= self._drive_end_at)]
+        speed = value[kind == SAMPLE_SPEED]
+        stroke = {'start_at': start_at,
+                  'drive_ms': self._drive_end_at - start_at,
+                  'recovery_ms': end_at - self._drive_end_at,
+                  'peak_watts': float(drive_watts.max()) if drive_watts.size else
+                                (float(watts.max()) if watts.size else 0.0),
+                  'mean_watts': float(watts.mean()) if watts.size else 0.0,
+                  'pulses': float(value[kind == SAMPLE_PULSE].sum()),
+                  'speed_cmps': float(speed.mean()) if speed.size else 0.0}
+        i = self.stroke_count % self.stroke_capacity
+        for field in STROKE_FIELDS:
+            self.strokes[field][i] = stroke[field]
+        self.stroke_count += 1
+        if stroke['speed_cmps']:
+            if self.smoothed_speed:
+                self.smoothed_speed += PACE_SMOOTHING * (stroke['speed_cmps'] - self.smoothed_speed)
+            else:
+                self.smoothed_speed = stroke['speed_cmps']
+        stroke['ratio'] = stroke['recovery_ms'] / stroke['drive_ms'] if stroke['drive_ms'] else 0.0
+        self.last_stroke = stroke
+        return True
+
+    def window_strokes(self):
+        # finished strokes since the last standstill
+        return min(self.stroke_count - self.window_start, self.stroke_capacity)
+
+    def _last(self, field, n):
+        n = min(n, self.window_strokes())
+        index = np.arange(self.stroke_count - n, self.stroke_count) % self.stroke_capacity
+        return self.strokes[field][index]
+
+    def rolling_peak_watts(self, n):
+        if self.window_strokes() < n:
+            return None
+        return float(self._last('peak_watts', n).mean())
+
+    def rolling(self, n):
+        if not self.window_strokes():
+            return None
+        drive = self._last('drive_ms', n)
+        recovery = self._last('recovery_ms', n)
+        duration = drive + recovery
+        speed = self._last('speed_cmps', n)
+        speed = speed[speed > 0]
+        return {'strokes': int(drive.size),
+                'peak_watts': float(self._last('peak_watts', n).mean()),
+                'mean_watts': float(self._last('mean_watts', n).mean()),
+                'stroke_rate': float(60000.0 / duration.mean()) if duration.mean() else 0.0,
+                'ratio': float(np.nanmean(recovery / np.where(drive > 0, drive, np.nan))) if drive.any() else 0.0,
+                'pace_500m': float(500 * 100 / speed.mean()) if speed.size else 0.0}
+
+    def summary(self):
+        return {'strokes': self.stroke_count,
+                'last_stroke': self.last_stroke,
+                'pace_500m_smoothed': 500 * 100 / self.smoothed_speed if self.smoothed_speed else 0.0,
+                'rolling': {n: self.rolling(n) for n in self.windows}}
@@ -5,36 +5,57 @@
 #
 
 # -*- coding: utf-8 -*-
+import abc
 import threading
 import logging
+import os
+import re
+import struct
 
 import time
 import serial
-import serial.tools.list_ports
 
 logger = logging.getLogger(__name__)
 
-MEMORY_MAP = {'055': {'type': 'total_distance_m', 'size': 'double', 'base': 16},
-              '140': {'type': 'total_strokes', 'size': 'double', 'base': 16},
-              '088': {'type': 'watts', 'size': 'double', 'base': 16},
-              '08A': {'type': 'total_kcal', 'size': 'triple', 'base': 16},
-              '14A': {'type': 'avg_distance_cmps', 'size': 'double', 'base': 16},
-              '148': {'type': 'total_speed_cmps', 'size': 'double', 'base': 16},
-              '1E0': {'type': 'display_sec_dec', 'size': 'single', 'base': 10},
-              '1E1': {'type': 'display_sec', 'size': 'single', 'base': 10},
-              '1E2': {'type': 'display_min', 'size': 'single', 'base': 10},
-              '1E3': {'type': 'display_hr', 'size': 'single', 'base': 10},
+# 'refresh' is the target time in seconds between two reads of the address by the poll scheduler.
+# The metrics sent over BLE get the short intervals, the rest fill what is left of the link.
+MEMORY_MAP = {'055': {'type': 'total_distance_m', 'size': 'double', 'base': 16, 'refresh': 0.5},
+              '140': {'type': 'total_strokes', 'size': 'double', 'base': 16, 'refresh': 0.5},
+              '088': {'type': 'watts', 'size': 'double', 'base': 16, 'refresh': 0.1},
+              '08A': {'type': 'total_kcal', 'size': 'triple', 'base': 16, 'refresh': 1.0},
+              '14A': {'type': 'avg_distance_cmps', 'size': 'double', 'base': 16, 'refresh': 0.25},
+              '148': {'type': 'total_speed_cmps', 'size': 'double', 'base': 16, 'refresh': 2.0},
+              '1E0': {'type': 'display_sec_dec', 'size': 'single', 'base': 10, 'refresh': 5.0},
+              '1E1': {'type': 'display_sec', 'size': 'single', 'base': 10, 'refresh': 0.5},
+              '1E2': {'type': 'display_min', 'size': 'single', 'base': 10, 'refresh': 1.0},
+              '1E3': {'type': 'display_hr', 'size': 'single', 'base': 10, 'refresh': 10.0},
               # from zone math
-              '1A0': {'type': 'heart_rate', 'size': 'double', 'base': 16},
-              '1A6': {'type': '500mps', 'size': 'double', 'base': 16},
-              '1A9': {'type': 'stroke_rate', 'size': 'single', 'base': 16},
+              '1A0': {'type': 'heart_rate', 'size': 'double', 'base': 16, 'refresh': 1.0},
+              '1A6': {'type': '500mps', 'size': 'double', 'base': 16, 'refresh': 2.0},
+              '1A9': {'type': 'stroke_rate', 'size': 'single', 'base': 16, 'refresh': 0.25},
               # explore
-              '142': {'type': 'avg_time_stroke_whole', 'size': 'single', 'base': 16},
-              '143': {'type': 'avg_time_stroke_pull', 'size': 'single', 'base': 16},
+              '142': {'type': 'avg_time_stroke_whole', 'size': 'single', 'base': 16, 'refresh': 2.0},
+              '143': {'type': 'avg_time_stroke_pull', 'size': 'single', 'base': 16, 'refresh': 2.0},
               #other
               '0A9': {'type': 'tank_volume', 'size': 'single', 'base': 16, 'not_in_loop': True},
              }
 
+# Poll scheduler settings
+REQUEST_GAP = 0.025        # minimum time between two requests on the serial link
+BACKOFF_FACTOR = 1.5       # interval growth each time a register answers with an unchanged value
+BACKOFF_MAX_INTERVAL = 2.0  # registers never back off past this (unless their own refresh is longer)
+LATENCY_SMOOTHING = 0.2    # weight of the newest sample in the averaged reply latency
+MOVING_OFF_GAP = 1.0       # seconds without a pulse or stroke after which the next one is a restart
+
+# Request/reply pipeline settings
+INFLIGHT_WINDOW = 4        # memory reads allowed on the link without an answer
+REPLY_TIMEOUT = 0.3        # seconds before an unanswered read is sent again
+REPLY_RETRIES = 2          # resends before a read is counted as lost
+
+# Reconnect settings
+RECONNECT_POLL = 0.25      # seconds between two looks for the device node of the lost port
+RECONNECT_SCAN = 2.0       # seconds between two full port scans (the S4 may come back renamed)
+
 
 # ACH values = Ascii coded hexadecimal
 # REQUEST sent from PC to device
@@ -109,21 +130,47 @@ UNIT_MAP = {'meters': 1,
             'km': 3,
             'strokes': 4}
 
-SIZE_PARSE_MAP = {'single': lambda cmd: cmd[6:8],
-                  'double': lambda cmd: cmd[6:10],
-                  'triple': lambda cmd: cmd[6:12]}
+# end of the value field in an ID reply (IDx + 3 address chars + 2/4/6 ACH digits)
+SIZE_VALUE_END = {'single': 8,
+                  'double': 10,
+                  'triple': 12}
+
+# The S4 terminates every packet with \r\n. We frame on the \n and drop the \r so a stray
+# bare \n (seen after a USB hiccup) still gives a usable frame.
+FRAME_END = 0x0A
+FRAME_CR = 0x0D
+# Longest S4 packet is ~12 bytes; anything this long without a line end is noise
+MAX_PENDING_BYTES = 256
+
+
 
+def scan_ports():
+    # every S4 plugged in, as (port path, device id). The id is the USB serial number where there is
+    # one, so a rower keeps its id when its port is renumbered after a replug
+    import serial.tools.list_ports  # only needed when there is a port to look for
+    found = []
+    for port in serial.tools.list_ports.comports():
+        if "WR" in port.description:
+            found.append((port.device, getattr(port, 'serial_number', None) or os.path.basename(port.device)))
+    return found
 
 
-def find_port():
+def scan_port(device=None):
+    # one look at the serial ports, None when no S4 (or not the one with this device id) is plugged in
+    for path, id in scan_ports():
+        if device is None or id == device:
+            logger.info("port found: %s" % path)
+            return path
+    return None
+
+
+def find_port(device=None):
     attempts = 0
     while True:
         attempts += 1
-        ports = serial.tools.list_ports.comports()
-        for (i, (path, name, _)) in enumerate(ports):
-            if "WR" in name:
-                logger.info("port found: %s" % path)
-                return path
+        path = scan_port(device)
+        if path:
+            return path
 
         #print("port not found retrying in 5s")
         if ((attempts - 1) % 360) == 0: # message every ~30 minutes
@@ -132,78 +179,787 @@ def find_port():
         time.sleep(5)
 
 
+class PortWatcher(object):
+    '''
+    Waits for the S4 to come back after its port went away. With pyudev a tty add event wakes the
+    watcher right away. Without it the device node of the lost port is stat'ed every
+    RECONNECT_POLL seconds (cheap) and the list_ports scan runs every RECONNECT_SCAN seconds, or
+    as soon as the node is back.
+    '''
+
+    def __init__(self, last_port=None, device=None):
+        self.last_port = last_port
+        self.device = device
+        self._monitor = None
+        try:
+            import pyudev  # only needed once a port was lost
+        except ImportError:
+            return
+        try:
+            self._monitor = pyudev.Monitor.from_netlink(pyudev.Context())
+            self._monitor.filter_by('tty')
+            self._monitor.start()
+        except Exception as e:
+            logger.info("udev not usable (%s), polling for the port", e)
+            self._monitor = None
+
+    def wait(self, stop_event):
+        # returns the port path once the S4 is back, None when stop_event got set first
+        next_scan = 0
+        was_present = True
+        while not stop_event.is_set():
+            if self._monitor is not None:
+                device = self._monitor.poll(timeout=RECONNECT_SCAN)
+                if device is not None and device.action != 'add':
+                    continue
+            else:
+                present = bool(self.last_port) and os.path.exists(self.last_port)
+                appeared = present and not was_present
+                was_present = present
+                if time.monotonic() < next_scan and not appeared:
+                    stop_event.wait(RECONNECT_POLL)
+                    continue
+            next_scan = time.monotonic() + RECONNECT_SCAN
+            path = scan_port(self.device)
+            if path:
+                return path
+        return None
+
+    def close(self):
+        self._monitor = None
+
+
 def build_daemon(target):
     t = threading.Thread(target=target)
     t.daemon = True
     return t
 
 
+class S4Event(object):
+    '''
+    Event record handed to the registered callbacks. Slotted so the capture loop does not build a
+    dict per packet; item access (event['type']) is kept for the existing callbacks.
+    '''
+    __slots__ = ('type', 'value', 'raw', 'at')
+
+    def __init__(self, type, value=None, raw=None, at=None):
+        self.type = type
+        self.value = value
+        self.raw = raw
+        self.at = at
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except (AttributeError, TypeError):
+            raise KeyError(key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __repr__(self):
+        return "S4Event(type=%r, value=%r, raw=%r, at=%r)" % (self.type, self.value, self.raw, self.at)
+
+
+def now_ms():
+    return int(round(time.time() * 1000))
+
+
 def build_event(type, value=None, raw=None):
-    return {"type": type,
-            "value": value,
-            "raw": raw,
-            "at": int(round(time.time() * 1000))}
+    return S4Event(type, value, raw, now_ms())
 
 
 def is_live_thread(t):
     return t and t.is_alive()
 
 
-def read_reply(cmd):
-    address = cmd[3:6]
-    memory = MEMORY_MAP.get(address)
-    if memory:
-        size = memory['size']
-        value_fn = SIZE_PARSE_MAP.get(size, lambda cmd: None)
-        value = value_fn(cmd)
-        if value is None:
-            logger.error('unknown size: %s', size)
-        else:
-            return build_event(memory['type'], int(value, base=memory['base']), cmd)
-    else:
+class LineFramer(object):
+    '''
+    Incremental framer for the S4 byte stream. Raw chunks from the serial port are appended to one
+    reusable bytearray and every complete line is handed back without the line ending. A partial
+    packet at the end of a chunk stays in the buffer until the rest of it arrives.
+    '''
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        buf = self._buffer
+        buf += data
+        frames = []
+        start = 0
+        while True:
+            end = buf.find(FRAME_END, start)
+            if end < 0:
+                break
+            stop = end
+            if stop > start and buf[stop - 1] == FRAME_CR:
+                stop -= 1
+            if stop > start:
+                frames.append(bytes(buf[start:stop]))
+            start = end + 1
+        if start:
+            del buf[:start]
+        if len(buf) > MAX_PENDING_BYTES:
+            logger.warning("dropping %d bytes without line end", len(buf))
+            buf.clear()
+        return frames
+
+    def clear(self):
+        self._buffer.clear()
+
+
+# Precompiled decoder tables, built once from MEMORY_MAP. Frames are matched as raw bytes so the
+# hot path never decodes to str.
+# ID replies: address bytes -> (event type, end of the value field, base)
+REPLY_TABLE = {address.encode(): (memory['type'], SIZE_VALUE_END[memory['size']], memory['base'])
+               for address, memory in MEMORY_MAP.items()}
+# packets that are matched as a whole; None means "known, nothing to report"
+EXACT_TABLE = {STROKE_START_RESPONSE.encode(): 'stroke_start',
+               STROKE_END_RESPONSE.encode(): 'stroke_end',
+               OK_RESPONSE.encode(): None,
+               ERROR_RESPONSE.encode(): 'error'}
+READ_MEMORY_PREFIX = READ_MEMORY_RESPONSE.encode()
+MODEL_INFORMATION_PREFIX = MODEL_INFORMATION_RESPONSE.encode()
+PING_PREFIX = PING_RESPONSE.encode()
+BYTE_I = ord('I')
+BYTE_P = ord('P')
+
+
+def read_reply(cmd, at=None):
+    if isinstance(cmd, str):
+        cmd = cmd.encode()
+    entry = REPLY_TABLE.get(cmd[3:6])
+    if entry is None:
         logger.error('cannot read reply for %s', cmd)
+        return None
+    type, end, base = entry
+    return S4Event(type, int(cmd[6:end], base), cmd, now_ms() if at is None else at)
+
+
+def decode_frame(frame, at=None):
+    '''
+    Turn one framed S4 packet (bytes without line end) into an S4Event, or None for packets we do
+    not report. ``at`` lets the capture loop stamp a whole batch with one clock read.
+    '''
+    if not frame:
+        return None
+    if frame in EXACT_TABLE:
+        type = EXACT_TABLE[frame]
+        if type is None:
+            return None
+        return S4Event(type, None, frame, now_ms() if at is None else at)
+    first = frame[0]
+    if first == BYTE_I:
+        if frame.startswith(READ_MEMORY_PREFIX):
+            return read_reply(frame, at)
+        if frame.startswith(MODEL_INFORMATION_PREFIX):
+            return S4Event('model', None, frame, now_ms() if at is None else at)
+    elif first == BYTE_P:
+        if frame.startswith(PING_PREFIX):
+            return S4Event('ping', None, frame, now_ms() if at is None else at)
+        return S4Event('pulse', None, frame, now_ms() if at is None else at)
+    return None
 
 
 def event_from(line):
     try:
-        cmd = line.strip()  # to ensure no space are in front or at the back call the function strip()
-        cmd = cmd.decode('utf8')  # encode it to utf8 ro remove b'
-        if cmd == STROKE_START_RESPONSE:  # with is "SS" from the waterrower
-            return build_event(type='stroke_start', raw=cmd)  # Call the methode to create a dict with the name stroke_start and the row command used for it "SS"
-        elif cmd == STROKE_END_RESPONSE:  # with is "SE" from the waterrower
-            return build_event(type='stroke_end', raw=cmd)  # Call the methode to create a dict with the name stroke_end and the row command used for it "SE"
-        elif cmd == OK_RESPONSE:  # If waterrower responce "OK" do nothing
-            return None
-        elif cmd[:2] == MODEL_INFORMATION_RESPONSE:  # If MODEL information has been request, the model responce would be "IV"
-            return build_event(type='model', raw=cmd)  # Call the methode to create a dict with the model and the row command used for it "SE"
-        elif cmd[:2] == READ_MEMORY_RESPONSE:  # if after memory request the responce comes from the waterrower
-            return read_reply(cmd)  # proced to the function read_reply which strips away everything and keeps the value and create the event dict for that request
-        elif cmd[:4] == PING_RESPONSE:  # if Ping responce is recived which is all the time the rower is in standstill
-            return build_event(type='ping', raw=cmd)  # do nothing
-        elif cmd[:1] == PULSE_COUNT_RESPONSE:  # Pluse count count the amount of 25 teeth passed 25teeth passed = P1
-            return build_event(type='pulse', raw=cmd)  # do nothing
-        elif cmd == ERROR_RESPONSE:  # If Waterrower responce with an error
-            return build_event(type='error', raw=cmd)  # crate an event with the dict entry error and the raw command
-        elif cmd[:2] == STROKE_START_RESPONSE:  # Pluse count count the amount of 25 teeth passed 25teeth passed = P1
-            print(cmd)
-        else:
-            return None
+        return decode_frame(line.strip())
     except Exception as e:
         logger.error('could not build event for: %s %s', line, e)
 
 
-class Rower(object):
-    def __init__(self, options=None):
+class PollScheduler(object):
+    '''
+    Decides which memory address the request loop reads next. Every address in MEMORY_MAP has its
+    own 'refresh' interval; the address that is most overdue goes first. When a register answers with
+    the same value as last time its interval grows by BACKOFF_FACTOR (up to BACKOFF_MAX_INTERVAL), and
+    it drops back to the target as soon as the value changes or the rower moves off again after a
+    standstill. The pulses while rowing leave the backoff alone: a register that does not change with
+    the strokes stays backed off.
+    '''
+
+    def __init__(self, memory_map=MEMORY_MAP):
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._by_type = {}
+        self._backed_off = False
+        self._last_motion = float('-inf')
+        self._started = time.monotonic()
+        for address, memory in memory_map.items():
+            if 'not_in_loop' in memory:
+                continue
+            refresh = memory.get('refresh', 1.0)
+            entry = {'address': address,
+                     'type': memory['type'],
+                     'refresh': refresh,
+                     'interval': refresh,
+                     'due': 0.0,
+                     'value': None,
+                     'polls': 0,
+                     'replies': 0}
+            self._entries[address] = entry
+            self._by_type[memory['type']] = entry
+
+    def next_request(self, now=None, skip=()):
+        # returns (address, 0) when something is due or (None, seconds until the next one).
+        # Addresses in skip (reads still in flight) are left for later.
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            candidates = [e for e in self._entries.values() if e['address'] not in skip]
+            if not candidates:
+                return None, REQUEST_GAP
+            entry = min(candidates, key=lambda e: (e['due'], e['refresh']))
+            wait = entry['due'] - now
+            if wait > 0:
+                return None, wait
+            entry['due'] = now + entry['interval']
+            entry['polls'] += 1
+            return entry['address'], 0
+
+    def on_event(self, event):
+        entry = self._by_type.get(event.type)
+        if entry is None:
+            if event.type in ('pulse', 'stroke_start'):
+                now = time.monotonic()
+                moving_off = now - self._last_motion > MOVING_OFF_GAP
+                self._last_motion = now
+                if moving_off and self._backed_off:
+                    self.reset_backoff()
+            return
+        with self._lock:
+            entry['replies'] += 1
+            if event.value == entry['value']:
+                ceiling = max(entry['refresh'], BACKOFF_MAX_INTERVAL)
+                entry['interval'] = min(entry['interval'] * BACKOFF_FACTOR, ceiling)
+                if entry['interval'] > entry['refresh']:
+                    self._backed_off = True
+            else:
+                entry['value'] = event.value
+                entry['interval'] = entry['refresh']
+
+    def reset_backoff(self):
+        now = time.monotonic()
+        with self._lock:
+            for entry in self._entries.values():
+                if entry['interval'] > entry['refresh']:
+                    entry['interval'] = entry['refresh']
+                    entry['due'] = min(entry['due'], now + entry['refresh'])
+            self._backed_off = False
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self._started, 1e-6)
+        with self._lock:
+            return {address: {'type': entry['type'],
+                              'refresh': entry['refresh'],
+                              'interval': entry['interval'],
+                              'polls': entry['polls'],
+                              'replies': entry['replies'],
+                              'poll_rate': entry['polls'] / elapsed}
+                    for address, entry in self._entries.items()}
+
+
+class ReadPipeline(object):
+    '''
+    Keeps track of the memory reads that were sent and not answered yet. Up to ``window`` reads may
+    be outstanding at once; an ID reply is matched to its read by address. A read that is not answered
+    within ``timeout`` seconds is sent again up to ``retries`` times and then counted as lost.
+    Round trip time per address is measured from the write to the decoded reply.
+    '''
+
+    def __init__(self, window=INFLIGHT_WINDOW, timeout=REPLY_TIMEOUT, retries=REPLY_RETRIES,
+                 memory_map=MEMORY_MAP):
+        self.window = window
+        self.timeout = timeout
+        self.retries = retries
+        self._cond = threading.Condition()
+        self._inflight = {}  # address -> [sent at (monotonic), attempts]
+        self._address_by_type = {memory['type']: address for address, memory in memory_map.items()}
+        self._stats = {address: {'sent': 0,
+                                 'answered': 0,
+                                 'retries': 0,
+                                 'lost': 0,
+                                 'late': 0,
+                                 'latency_ms': None,
+                                 'avg_latency_ms': None,
+                                 'max_latency_ms': None}
+                       for address in memory_map}
+
+    def outstanding(self):
+        with self._cond:
+            return set(self._inflight)
+
+    def is_full(self):
+        with self._cond:
+            return len(self._inflight) >= self.window
+
+    def wait_for_slot(self, timeout):
+        with self._cond:
+            if len(self._inflight) >= self.window:
+                self._cond.wait(timeout)
+
+    def sent(self, address, now=None):
+        if now is None:
+            now = time.monotonic()
+        with self._cond:
+            inflight = self._inflight.get(address)
+            if inflight is None:
+                self._inflight[address] = [now, 1]
+            else:
+                inflight[0] = now
+                inflight[1] += 1
+                self._stats[address]['retries'] += 1
+            self._stats[address]['sent'] += 1
+
+    def expired(self, now=None):
+        # addresses to send again; reads that ran out of retries are dropped here
+        if now is None:
+            now = time.monotonic()
+        resend = []
+        with self._cond:
+            for address, (sent_at, attempts) in list(self._inflight.items()):
+                if now - sent_at < self.timeout:
+                    continue
+                if attempts > self.retries:
+                    del self._inflight[address]
+                    self._stats[address]['lost'] += 1
+                    logger.warning("no reply for %s after %d attempts", address, attempts)
+                    self._cond.notify()
+                else:
+                    resend.append(address)
+        return resend
+
+    def on_event(self, event, now=None):
+        address = self._address_by_type.get(event.type)
+        if address is None:
+            return
+        if now is None:
+            now = time.monotonic()
+        with self._cond:
+            inflight = self._inflight.pop(address, None)
+            stats = self._stats[address]
+            if inflight is None:
+                # answer to a read we already gave up on, or one we did not send
+                stats['late'] += 1
+                return
+            latency = (now - inflight[0]) * 1000
+            stats['answered'] += 1
+            stats['latency_ms'] = latency
+            if stats['avg_latency_ms'] is None:
+                stats['avg_latency_ms'] = latency
+                stats['max_latency_ms'] = latency
+            else:
+                stats['avg_latency_ms'] += LATENCY_SMOOTHING * (latency - stats['avg_latency_ms'])
+                stats['max_latency_ms'] = max(stats['max_latency_ms'], latency)
+            self._cond.notify()
+
+    def clear(self):
+        # after a reconnect nothing sent before is going to be answered
+        with self._cond:
+            self._inflight.clear()
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {address: dict(stats, in_flight=address in self._inflight)
+                    for address, stats in self._stats.items()}
+
+
+# Capture files: CAPTURE_MAGIC followed by records of CAPTURE_RECORD (milliseconds since the start
+# of the recording, direction, payload length) and the raw payload bytes.
+CAPTURE_MAGIC = b'S4CAP\x01'
+CAPTURE_RECORD = struct.Struct('<IBH')
+CAPTURE_RX = 0  # bytes received from the S4
+CAPTURE_TX = 1  # bytes written to the S4
+REPLAY_MAX_PENDING = 4096  # bytes released per read when replaying at max speed
+CAPTURE_FLUSH_INTERVAL = 1.0  # seconds between flushes of a recording to disk
+
+_capture_started = {}  # path -> start (monotonic) of the recording this process writes to it
+
+
+def read_capture(path):
+    '''
+    Yields (offset_ms, direction, data) for every record of a capture file.
+    '''
+    with open(path, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError('%s is not an S4 capture file' % path)
+        while True:
+            header = f.read(CAPTURE_RECORD.size)
+            if len(header) < CAPTURE_RECORD.size:
+                return
+            offset_ms, direction, length = CAPTURE_RECORD.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logger.warning('capture %s is truncated', path)
+                return
+            yield offset_ms, direction, data
+
+
+class CaptureWriter(object):
+    '''
+    Appends records to a capture file. The first writer of a path in this process starts a new
+    recording; a later one (the Rower of a restarted worker) goes on with it, its offsets counted
+    from the same start.
+    '''
+
+    def __init__(self, path):
+        path = os.path.abspath(path)
+        self._start = _capture_started.get(path)
+        if self._start is None:
+            self._file = open(path, 'wb')
+            self._file.write(CAPTURE_MAGIC)
+            self._start = _capture_started[path] = time.monotonic()
+        else:
+            self._file = open(path, 'ab')
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def append(self, direction, data):
+        if not data:
+            return
+        now = time.monotonic()
+        offset_ms = int((now - self._start) * 1000)
+        with self._lock:
+            if self._file.closed:
+                return
+            self._file.write(CAPTURE_RECORD.pack(offset_ms, direction, len(data)))
+            self._file.write(data)
+            if now - self._last_flush >= CAPTURE_FLUSH_INTERVAL:
+                self._file.flush()
+                self._last_flush = now
+
+    def flush(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+
+
+class RecordingSerial(serial.Serial):
+    '''
+    serial.Serial that also writes every chunk read from and written to the S4 into a capture file.
+    '''
+
+    def __init__(self, capture_path, *args, **kwargs):
+        self._capture = CaptureWriter(capture_path)
+        serial.Serial.__init__(self, *args, **kwargs)
+
+    def read(self, size=1):
+        data = serial.Serial.read(self, size)
+        self._capture.append(CAPTURE_RX, data)
+        return data
+
+    def write(self, data):
+        self._capture.append(CAPTURE_TX, data)
+        return serial.Serial.write(self, data)
+
+    def close(self):
+        # the port is closed and reopened on reconnect, the recording carries on
+        serial.Serial.close(self)
+        if getattr(self, '_capture', None):
+            self._capture.flush()
+
+    def close_capture(self):
+        self._capture.close()
+
+
+class ReplaySerial(object):
+    '''
+    Stand-in for serial.Serial that plays back the S4 side of a capture file. ``speed`` scales the
+    recorded timing (1 = real time, 4 = four times faster); 0 replays as fast as the reader can take
+    it. Writes are counted and dropped. When the capture is used up the port closes itself and
+    ``finished`` is set, unless ``loop`` is set. Like a port, read() waits for data unless
+    ``timeout`` is 0.
+    '''
+
+    def __init__(self, capture_path, speed=1.0, loop=False):
+        self.port = capture_path
+        self.baudrate = 19200
+        self.speed = speed
+        self.loop = loop
+        self.timeout = None
+        self.finished = threading.Event()
+        self.bytes_written = 0
+        self._chunks = [(offset_ms / 1000.0, data)
+                        for offset_ms, direction, data in read_capture(capture_path)
+                        if direction == CAPTURE_RX]
+        self._index = 0
+        self._pending = bytearray()
+        self._start = 0.0
+        self._open = False
+        self._wakeup = threading.Event()
+
+    def open(self):
+        self._index = 0
+        self._pending.clear()
+        self._start = time.monotonic()
+        self._open = True
+        self.finished.clear()
+        self._wakeup.clear()
+
+    def isOpen(self):
+        return self._open
+
+    @property
+    def is_open(self):
+        return self._open
+
+    def close(self):
+        self._open = False
+        self._wakeup.set()
+
+    def _release_due(self):
+        chunks = self._chunks
+        if self.speed:
+            now = (time.monotonic() - self._start) * self.speed
+            while self._index < len(chunks) and chunks[self._index][0] <= now:
+                self._pending += chunks[self._index][1]
+                self._index += 1
+        else:
+            while self._index < len(chunks) and len(self._pending) < REPLAY_MAX_PENDING:
+                self._pending += chunks[self._index][1]
+                self._index += 1
+
+    def _next_delay(self):
+        if not self.speed or self._index >= len(self._chunks):
+            return 0
+        due = self._start + self._chunks[self._index][0] / self.speed
+        return due - time.monotonic()
+
+    @property
+    def in_waiting(self):
+        self._release_due()
+        return len(self._pending)
+
+    def read(self, size=1):
+        self._release_due()
+        while not self._pending and self._open:
+            if self._index >= len(self._chunks):
+                # the capture is used up: start over or close the port
+                if self.loop and self._chunks:
+                    self._index = 0
+                    self._start = time.monotonic()
+                    self._release_due()
+                    continue
+                logger.info("replay of %s finished", self.port)
+                self.finished.set()
+                self._open = False
+                break
+            if self.timeout == 0:
+                break
+            delay = self._next_delay()
+            if delay > 0:
+                self._wakeup.wait(min(delay, 0.1))
+            self._release_due()
+        data = bytes(self._pending[:size])
+        del self._pending[:size]
+        return data
+
+    def write(self, data):
+        self.bytes_written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def reset_input_buffer(self):
+        self._pending.clear()
+
+
+def capture_path(path, device=None):
+    # the capture of one S4 of a hub: FILE.<device id>, every rower records to its own file
+    if device is None:
+        return path
+    return '%s.%s' % (path, re.sub(r'[^A-Za-z0-9_.-]', '_', str(device)))
+
+
+def build_transport(options=None, device=None):
+    '''
+    Serial transport for a Rower: a capture replay when options.s4_replay is set, a recording port
+    when options.s4_record is set (one file per device id when it is given), otherwise a plain
+    serial.Serial.
+    '''
+    replay = getattr(options, 's4_replay', None)
+    if replay:
+        return ReplaySerial(replay, speed=getattr(options, 'replay_speed', 1.0),
+                            loop=getattr(options, 'replay_loop', False))
+    record = getattr(options, 's4_record', None)
+    if record:
+        port = RecordingSerial(capture_path(record, device))
+    else:
+        port = serial.Serial()
+    port.baudrate = 19200
+    return port
+
+
+class RowerBase(abc.ABC):
+    '''
+    What every S4 front end shares: the transport, framing and decoding of the received bytes, the
+    poll scheduler and read pipeline, and the callback registry. Rower drives it from two daemon
+    threads, AsyncRower (asyncrower.py) from an asyncio event loop.
+    '''
+
+    def __init__(self, options=None, inflight_window=INFLIGHT_WINDOW, device=None):
+        # device: id (see scan_ports) of the S4 to open, None for the first one found
+        self.device = device
         self._callbacks = set()
+        self._typed_callbacks = {}  # event type -> tuple of callbacks that only want that type
+        self._framer = LineFramer()
+        self.capture_stats = {'reads': 0, 'bytes': 0, 'frames': 0, 'events': 0}
+        self._scheduler = PollScheduler()
+        self._pipeline = ReadPipeline(window=inflight_window)
+        self._serial = build_transport(options, device)
+        # a replayed capture has no port to look for
+        self._demo = isinstance(self._serial, ReplaySerial)
+        self._link_lock = threading.Lock()
+        self._lost_at = None
+        self.link_stats = {'state': 'closed', 'disconnects': 0, 'reconnects': 0,
+                           'last_downtime_ms': 0, 'downtime_ms': 0}
+
+    def link_lost(self, error):
+        # the port went away; returns False when that is already being handled
+        with self._link_lock:
+            if self._lost_at is not None:
+                return False
+            self._lost_at = time.monotonic()
+            self.link_stats['state'] = 'reconnecting'
+            self.link_stats['disconnects'] += 1
+        logger.warning("S4 connection lost: %s", error)
+        # the DataLogger keeps serving the last values, flagged stale, until 'reconnected'
+        self.notify_callbacks(build_event('disconnected'))
+        return True
+
+    def link_up(self):
+        with self._link_lock:
+            lost_at = self._lost_at
+            self._lost_at = None
+            self.link_stats['state'] = 'connected'
+            if lost_at is None:
+                return
+            down = int((time.monotonic() - lost_at) * 1000)
+            self.link_stats['reconnects'] += 1
+            self.link_stats['last_downtime_ms'] = down
+            self.link_stats['downtime_ms'] += down
+        logger.info("S4 back after %d ms", down)
+        self.notify_callbacks(build_event('reconnected'))
+
+    def handle_data(self, data):
+        # frame and decode one read worth of bytes and hand the events out as one batch
+        frames = self._framer.feed(data)
+        at = now_ms()
+        events = []
+        for frame in frames:
+            try:
+                event = decode_frame(frame, at)
+            except ValueError as e:
+                logger.error('could not build event for: %s %s', frame, e)
+                continue
+            if event:
+                events.append(event)
+                self._pipeline.on_event(event)
+                self._scheduler.on_event(event)
+        stats = self.capture_stats
+        stats['reads'] += 1
+        stats['bytes'] += len(data)
+        stats['frames'] += len(frames)
+        stats['events'] += len(events)
+        if events:
+            self.notify_batch(events)
+        return events
+
+    def next_read(self):
+        # (address, wait): the address to request now, or None and how long nothing is due.
+        # unanswered reads go first, then whatever the scheduler says is due
+        pipeline = self._pipeline
+        resend = pipeline.expired()
+        if resend:
+            return resend[0], 0
+        if pipeline.is_full():
+            return None, REQUEST_GAP
+        return self._scheduler.next_request(skip=pipeline.outstanding())
+
+    def poll_stats(self):
+        # scheduler view (rates, backoff) merged with the pipeline view (round trip, retries, losses)
+        stats = self._scheduler.stats()
+        pipeline_stats = self._pipeline.stats()
+        for address, entry in stats.items():
+            entry.update(pipeline_stats.get(address, {}))
+        return stats
+
+    @abc.abstractmethod
+    def write(self, raw):
+        '''
+        Sends one S4 packet (raw without the line end). A failed write means the link is gone: the
+        front end logs it and starts its reconnect, it does not raise.
+        '''
+
+    def reset_request(self):
+        self.write(RESET_REQUEST)
+        self.notify_callbacks(build_event('reset'))
+        logger.info("Reset requested")
+
+    def request_info(self):
+        self.write(MODEL_INFORMATION_REQUEST)
+        self.request_address('0A9')
+        self._pipeline.sent('0A9')
+
+    def request_address(self, address):
+        size = MEMORY_MAP[address]['size']
+        cmd = SIZE_MAP[size]
+        self.write(cmd + address)
+
+    def register_callback(self, cb, types=None):
+        # types: the event types cb is interested in, None for every event
+        if types is None:
+            self._callbacks.add(cb)
+            return
+        for type in types:
+            callbacks = self._typed_callbacks.get(type, ())
+            if cb not in callbacks:
+                # replaced, never mutated, so the capture thread can iterate without a lock
+                self._typed_callbacks[type] = callbacks + (cb,)
+
+    def remove_callback(self, cb):
+        found = cb in self._callbacks
+        self._callbacks.discard(cb)
+        for type, callbacks in list(self._typed_callbacks.items()):
+            if cb in callbacks:
+                found = True
+                remaining = tuple(c for c in callbacks if c != cb)
+                if remaining:
+                    self._typed_callbacks[type] = remaining
+                else:
+                    del self._typed_callbacks[type]
+        if not found:
+            raise KeyError(cb)
+
+    def notify_callbacks(self, event):
+        for cb in self._callbacks:
+            cb(event)
+        for cb in self._typed_callbacks.get(event.type, ()):
+            cb(event)
+
+    def notify_batch(self, events):
+        # one snapshot of the callbacks per wakeup instead of per packet
+        callbacks = tuple(self._callbacks)
+        typed = self._typed_callbacks
+        for event in events:
+            for cb in callbacks:
+                cb(event)
+            for cb in typed.get(event.type, ()):
+                cb(event)
+
+
+class Rower(RowerBase):
+    def __init__(self, options=None, inflight_window=INFLIGHT_WINDOW, device=None):
+        RowerBase.__init__(self, options, inflight_window, device)
         self._stop_event = threading.Event()
-        self._demo = False
-        # if options and options.demo:
-        #     from demo import FakeS4
-        #     self._serial = FakeS4()
-        #     self._demo = True
-        # else:
-        self._serial = serial.Serial()
-        self._serial.baudrate = 19200
 
         self._request_thread = build_daemon(target=self.start_requesting)
         self._capture_thread = build_daemon(target=self.start_capturing)
@@ -215,22 +971,24 @@ class Rower(object):
             is_live_thread(self._capture_thread)
 
     def _find_serial(self):
-        if not self._demo:
-            self._serial.port = find_port()
-        try:
-            self._serial.open()
-            #print("serial open")
-            logger.info("serial open")
-        except serial.SerialException as e:
-            print("serial open error waiting")
-            time.sleep(5)
-            self._serial.close()
-            self._find_serial()
+        while True:
+            if not self._demo:
+                self._serial.port = find_port(self.device)
+            try:
+                self._serial.open()
+                logger.info("serial open")
+                return
+            except serial.SerialException as e:
+                logger.warning("serial open error, waiting: %s", e)
+                time.sleep(5)
+                self._serial.close()
 
     def open(self):
         if self._serial and self._serial.isOpen():
             self._serial.close()
         self._find_serial()
+        self._pipeline.clear()
+        self._framer.clear()
         if self._stop_event.is_set():
             #print("reset threads")
             logger.info("reset threads")
@@ -243,6 +1001,43 @@ class Rower(object):
             logger.info("Thread daemon _capture started")
 
         self.write(USB_REQUEST)
+        self.link_up()
+
+    def _connection_lost(self, error):
+        # no blocking reopen from the thread that noticed it: the port is closed, the request and
+        # capture loops idle, and a reconnect thread waits for the S4 to come back
+        if not self.link_lost(error):
+            return
+        try:
+            self._serial.close()
+        except Exception as e:
+            logger.debug("close after connection loss: %s", e)
+        build_daemon(target=self._reconnect).start()
+
+    def _reconnect(self):
+        watcher = PortWatcher(self._serial.port, self.device)
+        try:
+            while not self._stop_event.is_set():
+                if not self._demo:
+                    path = watcher.wait(self._stop_event)
+                    if path is None:
+                        return
+                    self._serial.port = path
+                try:
+                    self._serial.open()
+                except serial.SerialException as e:
+                    logger.info("S4 port back but not usable yet: %s", e)
+                    self._stop_event.wait(RECONNECT_POLL)
+                    continue
+                logger.info("serial reopened")
+                self._pipeline.clear()
+                self._framer.clear()
+                # no reset request: the monitor still holds the session totals
+                self.write(USB_REQUEST)
+                self.link_up()
+                return
+        finally:
+            watcher.close()
 
     def close(self):
         self.notify_callbacks(build_event("exit"))
@@ -252,6 +1047,8 @@ class Rower(object):
             self.write(EXIT_REQUEST)
             time.sleep(0.1)  # time for capture and request loops to stop running
             self._serial.close()
+        if isinstance(self._serial, RecordingSerial):
+            self._serial.close_capture()
 
     def write(self, raw):
         try:
@@ -261,19 +1058,33 @@ class Rower(object):
             print(e)
             #print("Serial error try to reconnect")
             logger.error("Serial error try to reconnect")
-            self.open()
+            self._connection_lost(e)
+
+    def read_available(self):
+        # block for the first byte, then take everything the driver already buffered in one call
+        data = self._serial.read(1)
+        waiting = self._serial.in_waiting
+        if waiting:
+            data += self._serial.read(waiting)
+        return data
 
     def start_capturing(self):
         while not self._stop_event.is_set():
             if self._serial.isOpen():
                 try:
-                    line = self._serial.readline()
-                    event = event_from(line)
-                    if event:
-                        self.notify_callbacks(event)
+                    data = self.read_available()
+                except (serial.SerialException, OSError) as e:
+                    # unplugged or the device reset itself
+                    self._connection_lost(e)
+                    continue
+                if not data:
+                    continue
+                try:
+                    self.handle_data(data)
                 except Exception as e:
                     #print("could not read %s" % e)
                     logger.error("could not read %s" % e)
+                    self._framer.clear()
                     try:
                         self._serial.reset_input_buffer()
                     except Exception as e2:
@@ -284,39 +1095,18 @@ class Rower(object):
                 self._stop_event.wait(0.1)
 
     def start_requesting(self):
+        pipeline = self._pipeline
         while not self._stop_event.is_set():
             if self._serial.isOpen():
-                for address in MEMORY_MAP:
-                    if 'not_in_loop' not in MEMORY_MAP[address]:
-                        self.request_address(address)
-                        self._stop_event.wait(0.025)
+                address, wait = self.next_read()
+                if address is None:
+                    if pipeline.is_full():
+                        pipeline.wait_for_slot(wait)
+                    else:
+                        self._stop_event.wait(min(wait, 0.1))
+                    continue
+                self.request_address(address)
+                pipeline.sent(address)
+                self._stop_event.wait(REQUEST_GAP)
             else:
                 self._stop_event.wait(0.1)
-
-
-    def reset_request(self):
-        self.write(RESET_REQUEST)
-        self.notify_callbacks(build_event('reset'))
-        logger.info("Reset requested")
-
-    def request_info(self):
-        self.write(MODEL_INFORMATION_REQUEST)
-        self.request_address('0A9')
-
-    def request_address(self, address):
-        size = MEMORY_MAP[address]['size']
-        cmd = SIZE_MAP[size]
-        self.write(cmd + address)
-
-    def register_callback(self, cb):
-        self._callbacks.add(cb)
-
-    def remove_callback(self, cb):
-        self._callbacks.remove(cb)
-
-    def notify_callbacks(self, event):
-        for cb in self._callbacks:
-            cb(event)
-
-
-
@@ -3,13 +3,18 @@
 # https://github.com/bfritscher/waterrower
 # ---------------------------------------------------------------------------
 
+import os
 import threading
 import time
-import datetime
 import logging
+from collections import deque
 from copy import deepcopy
+from queue import Empty
 
 from . import waterrowerinterface
+from . import strokeanalytics
+from ..metrics import latency
+from ..metrics import registry
 
 logger = logging.getLogger(__name__)
 '''
@@ -24,19 +29,97 @@ Depeding on thoses cases send to the bluetooth module only the value dict with t
 '''
 
 IGNORE_LIST = ['graph', 'tank_volume', 'display_sec_dec']
+SNAPSHOT_KEYS = ('stroke_rate', 'total_strokes', 'total_distance_m', 'instantaneous pace', 'speed', 'watts',
+                 'total_kcal', 'total_kcal_hour', 'total_kcal_min', 'heart_rate', 'elapsedtime')
+STANDSTILL_ZERO = ('stroke_rate', 'instantaneous pace', 'heart_rate', 'speed', 'watts')
+LINK_EVENTS = ('disconnected', 'reconnected')
 POWER_AVG_STROKES = 4
-ext_hr = 0
-ext_hr_time = -1
+COMMAND_WAIT = 1.0  # seconds the main loop waits for a command before re-checking the external hr
+EXT_HR_TIMEOUT = 30  # seconds an external heart rate is reported after it last changed
+
+class WRSnapshot(object):
+    '''
+    Immutable set of values handed to the consumers (BLE, ANT). Reads like a dict with the
+    SNAPSHOT_KEYS but is a single tuple underneath, so it can be shared between threads without
+    copying. A new snapshot is only built when the values behind it changed. ``stale`` is set
+    while the S4 link is down: the values are the last good ones, not live.
+    '''
+    __slots__ = ('_values', 'stale')
+    _INDEX = {key: i for i, key in enumerate(SNAPSHOT_KEYS)}
+
+    def __init__(self, values, stale=False):
+        object.__setattr__(self, '_values', tuple(values))
+        object.__setattr__(self, 'stale', stale)
+
+    @classmethod
+    def from_dict(cls, values, overrides=None, stale=False):
+        if overrides:
+            return cls((overrides.get(key, values[key]) for key in SNAPSHOT_KEYS), stale)
+        return cls((values[key] for key in SNAPSHOT_KEYS), stale)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('WRSnapshot is read only')
+
+    def __getitem__(self, key):
+        return self._values[self._INDEX[key]]
+
+    def get(self, key, default=None):
+        index = self._INDEX.get(key)
+        return default if index is None else self._values[index]
+
+    def __contains__(self, key):
+        return key in self._INDEX
+
+    def __iter__(self):
+        return iter(SNAPSHOT_KEYS)
+
+    def __len__(self):
+        return len(SNAPSHOT_KEYS)
+
+    def keys(self):
+        return SNAPSHOT_KEYS
+
+    def values(self):
+        return self._values
+
+    def items(self):
+        return zip(SNAPSHOT_KEYS, self._values)
+
+    def as_dict(self):
+        return dict(zip(SNAPSHOT_KEYS, self._values))
+
+    def __eq__(self, other):
+        if isinstance(other, WRSnapshot):
+            return self._values == other._values and self.stale == other.stale
+        if isinstance(other, dict):
+            return self.as_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        return result if result is NotImplemented else not result
+
+    def __hash__(self):
+        return hash((self._values, self.stale))
+
+    def __repr__(self):
+        if self.stale:
+            return repr(self.as_dict()) + ' (stale)'
+        return repr(self.as_dict())
+
 
 class DataLogger(object):
-    def __init__(self, rower_interface):
+    def __init__(self, rower_interface, outputs=(), clock=None):
         self._rower_interface = rower_interface
-        self._rower_interface.register_callback(self.reset_requested)
-        self._rower_interface.register_callback(self.pulse)
-        self._rower_interface.register_callback(self.on_rower_event)
+        # ms clock of the standstill detection; a replay hands in the time of the event being replayed
+        self._clock = clock or waterrowerinterface.now_ms
         self._stop_event = threading.Event()
+        self._outputs = outputs
+        self._publish_lock = threading.Lock()
+        self._published = None
 
         self._InstaPowerStroke = None
+        self.analytics = None
         self.maxpowerStroke = None
         self._StrokeStart = None
         self._StrokeTotal = None
@@ -50,7 +133,6 @@ class DataLogger(object):
         self.rowerreset = None
         self.WRValues_rst = None
         self.WRValues = None
-        self.WRValues_standstill = None
         self.BLEvalues = None
         self.ANTvalues = None
         self.secondsWR = None
@@ -58,11 +140,59 @@ class DataLogger(object):
         self.hoursWR = None
         self.elapsetime = None
         self.elapsetimeprevious = None
+        self._trace = None
+        self.stale = False  # S4 link down, the last values are served as they were
+        # heart rate from a BLE sensor ('hr' command), reported while the monitor has none
+        self.ext_hr = 0
+        self.ext_hr_time = -1
+        # snapshot cache: rebuilt only when _version (bumped on every value change), the
+        # reset/rowing/standstill mode or the external heart rate differ from the cached one
+        self._version = 0
+        self._snapshot = None
+        self._snapshot_key = None
+        self._stats_started = time.monotonic()
+        self.snapshot_stats = {'reads': 0, 'allocations': 0}
+        # per stroke metrics need numpy, without it the watts stay a plain 4 stroke peak average
+        if strokeanalytics.np is not None:
+            self.analytics = strokeanalytics.StrokeAnalytics()
+        else:
+            logger.info("numpy not available, stroke analytics disabled")
+
+        # event type -> handler. Only these types are delivered by the Rower; every delivered event
+        # also keeps the standstill detection in pulse() going.
+        self._handlers = {
+            'reset': self.reset_requested,
+            'pulse': self._on_pulse,
+            'ping': None,
+            'stroke_start': self._on_stroke_start,
+            'stroke_end': self._on_stroke_end,
+            'stroke_rate': self._on_stroke_rate,
+            'total_strokes': self._on_total_strokes,
+            'total_distance_m': self._on_total_distance,
+            'avg_distance_cmps': self._on_avg_distance,
+            'watts': self._on_watts,
+            'total_kcal': self._on_total_kcal,
+            'heart_rate': self._on_heart_rate,
+            'display_sec': self._on_display_sec,
+            'display_min': self._on_display_min,
+            'display_hr': self._on_display_hr,
+            'disconnected': self._on_link,
+            'reconnected': self._on_link,
+        }
+        # replies that carry nothing for us still tell that the S4 is alive
+        for memory in waterrowerinterface.MEMORY_MAP.values():
+            if memory['type'] not in self._handlers and memory['type'] not in IGNORE_LIST:
+                self._handlers[memory['type']] = None
 
         self._reset_state()
+        # one callback so pulse bookkeeping, the value handler and the change check always run in
+        # that order for a given event
+        self._rower_interface.register_callback(self.on_event, types=self._handlers)
 
     def _reset_state(self):
-        self._InstaPowerStroke = []
+        self._InstaPowerStroke = deque(maxlen=POWER_AVG_STROKES)
+        if self.analytics is not None:
+            self.analytics.reset()
         self.maxpowerStroke = 0
         self._StrokeStart = False
         self._StrokeTotal = 0
@@ -88,73 +218,146 @@ class DataLogger(object):
                 'elapsedtime': 0.0,
             }
         self.WRValues = deepcopy(self.WRValues_rst)
-        self.WRValues_standstill = deepcopy(self.WRValues_rst)
-        self.BLEvalues = deepcopy(self.WRValues_rst)
-        self.ANTvalues = deepcopy(self.WRValues_rst)
+        self.BLEvalues = WRSnapshot.from_dict(self.WRValues_rst)
+        self.ANTvalues = self.BLEvalues
+        self._version += 1
         self.secondsWR = 0
         self.minutesWR = 0
         self.hoursWR = 0
         self.elapsetime = 0
         self.elapsetimeprevious = 0
 
+    def resume_from(self, previous):
+        # the DataLogger of a restarted worker: the monitor was not reset, so it goes on from the
+        # values (and the reset / standstill mode) of the previous one instead of zeros
+        self.WRValues = deepcopy(previous.WRValues)
+        self.rowerreset = previous.rowerreset
+        self._StrokeTotal = previous._StrokeTotal
+        self.secondsWR = previous.secondsWR
+        self.minutesWR = previous.minutesWR
+        self.hoursWR = previous.hoursWR
+        self.elapsetime = self.elapsetimeprevious = previous.elapsetime
+        self.stale = previous.stale
+        self.ext_hr = previous.ext_hr
+        self.ext_hr_time = previous.ext_hr_time
+        self._version += 1
+
+    def on_event(self, event):
+        if event.type in LINK_EVENTS:
+            # not a standstill: no pulse bookkeeping, the values stay as they were
+            self._on_link(event)
+        elif event.type == 'reset':
+            # zeroed first, the standstill bookkeeping then runs on the reset state
+            self.reset_requested(event)
+            self.pulse(event)
+        else:
+            self.pulse(event)
+            self.on_rower_event(event)
+        self.publish()
+
+    def _on_link(self, event):
+        stale = event['type'] == 'disconnected'
+        if stale != self.stale:
+            self.stale = stale
+            logger.info("serving %s values", "stale" if stale else "live")
+
     def on_rower_event(self, event):
-        if event['type'] in IGNORE_LIST:
+        handler = self._handlers.get(event['type'])
+        if handler is None:
             return
-        if event['type'] == 'stroke_start':
-            self._StrokeStart = True
-        if event['type'] == 'stroke_end':
-            self._StrokeStart = False
-        if event['type'] == 'stroke_rate':
-            self.WRValues.update({'stroke_rate': (event['value']*2)})
-        if event['type'] == 'total_strokes':
-            self._StrokeTotal = event['value']
-            self.WRValues.update({'total_strokes': event['value']})
-        if event['type'] == 'total_distance_m':
-            self.WRValues.update({'total_distance_m': (event['value'])})
-        if event['type'] == 'avg_distance_cmps':
-            if event['value'] == 0:
-                self.WRValues.update({'instantaneous pace': 0})
-                self.WRValues.update({'speed':0})
-            else:
-                self.InstantaneousPace = (500 * 100) / event['value']
-                #print(self.InstantaneousPace)
-                self.WRValues.update({'instantaneous pace': self.InstantaneousPace})
-                self.WRValues.update({'speed':event['value']})
-        if event['type'] == 'watts':
-            self.Watts = event['value']
+        version = self._version
+        handler(event)
+        if self._trace is None and self._version != version:
+            # oldest value change not yet handed to BLE, this is the one that waited longest. A
+            # reply with the value already known changes nothing and opens no trace
+            self._trace = {'serial': event['at'], 'logger': latency.stamp()}
+
+    def _analyse(self, event):
+        if self.analytics is not None and self.analytics.on_event(event):
+            # a stroke was finished, the reported power is the mean peak of the last strokes
+            avg = self.analytics.rolling_peak_watts(POWER_AVG_STROKES)
+            if avg is not None:
+                self.AvgInstaPower = int(avg)
+                self._set('watts', self.AvgInstaPower)
+
+    def _on_pulse(self, event):
+        if self.analytics is not None:
+            self.analytics.on_event(event)
+
+    def _on_stroke_start(self, event):
+        self._StrokeStart = True
+        self._analyse(event)
+
+    def _on_stroke_end(self, event):
+        self._StrokeStart = False
+        self._analyse(event)
+
+    def _on_stroke_rate(self, event):
+        self._set('stroke_rate', (event['value']*2))
+
+    def _on_total_strokes(self, event):
+        self._StrokeTotal = event['value']
+        self._set('total_strokes', event['value'])
+
+    def _on_total_distance(self, event):
+        self._set('total_distance_m', (event['value']))
+
+    def _on_avg_distance(self, event):
+        if event['value'] == 0:
+            self._set('instantaneous pace', 0)
+            self._set('speed', 0)
+        else:
+            self.InstantaneousPace = (500 * 100) / event['value']
+            self._set('instantaneous pace', self.InstantaneousPace)
+            self._set('speed', event['value'])
+        self._analyse(event)
+
+    def _on_watts(self, event):
+        self.Watts = event['value']
+        if self.analytics is None:
             self.avgInstaPowercalc(self.Watts)
-        if event['type'] == 'total_kcal':
-            self.WRValues.update({'total_kcal': (event['value']/1000)})  # in cal now in kcal
-        if event['type'] == 'total_kcal_h':  # must calclatre it first
-            self.WRValues.update({'total_kcal': 0})
-        if event['type'] == 'total_kcal_min':  # must calclatre it first
-            self.WRValues.update({'total_kcal': 0})
-        if event['type'] == 'heart_rate':
-            self.WRValues.update({'heart_rate': (event['value'])})
-        if event['type'] == 'display_sec':
+        else:
+            self._analyse(event)
+
+    def _on_total_kcal(self, event):
+        self._set('total_kcal', (event['value']/1000))  # in cal now in kcal
+
+    def _on_heart_rate(self, event):
+        self._set('heart_rate', (event['value']))
+
+    # the elapsed time only changes with one of the display registers
+    def _on_display_sec(self, event):
+        if self.secondsWR != event['value']:
             self.secondsWR = event['value']
-        if event['type'] == 'display_min':
+            self.TimeElapsedcreator()
+
+    def _on_display_min(self, event):
+        if self.minutesWR != event['value']:
             self.minutesWR = event['value']
-        if event['type'] == 'display_hr':
-            self.hoursWR = event['value']
-        self.TimeElapsedcreator()
+            self.TimeElapsedcreator()
 
+    def _on_display_hr(self, event):
+        if self.hoursWR != event['value']:
+            self.hoursWR = event['value']
+            self.TimeElapsedcreator()
 
     def pulse(self,event):
-        self.Lastcheckforpulse = int(round(time.time() * 1000))
+        self.Lastcheckforpulse = self._clock()
         if event['type'] == 'pulse':
             self.PulseEventTime = event['at']
             self.rowerreset = False
         self.DeltaPulse = self.Lastcheckforpulse - self.PulseEventTime
         if self.DeltaPulse <= 300:
             self.PaddleTurning = True
-        else:
+        elif self.PaddleTurning or self.PulseEventTime:
+            # just stopped, everything after this is the same until the next pulse
             self.PaddleTurning = False
             self._StrokeStart = False
             self.PulseEventTime = 0
-            self._InstaPowerStroke = []
+            self._InstaPowerStroke.clear()
+            if self.analytics is not None:
+                self.analytics.idle()
             self.AvgInstaPower = 0
-            self.WRValuesStandstill()
 
     def reset_requested(self,event):
         if event['type'] == 'reset':
@@ -162,19 +365,14 @@ class DataLogger(object):
             logger.info("value reseted")
 
     def TimeElapsedcreator(self):
-        self.elapsetime = datetime.timedelta(seconds=self.secondsWR, minutes=self.minutesWR, hours=self.hoursWR)
-        self.elapsetime = int(self.elapsetime.total_seconds())
-        # print('sec:{0};min:{1};hr:{2}'.format(self.secondsWR,self.minutesWR,self.hoursWR))
-        self.WRValues.update({'elapsedtime': self.elapsetime})
+        self.elapsetime = self.hoursWR * 3600 + self.minutesWR * 60 + self.secondsWR
+        self._set('elapsedtime', self.elapsetime)
         self.elapsetimeprevious = self.elapsetime
 
-    def WRValuesStandstill(self):
-        self.WRValues_standstill = deepcopy(self.WRValues)
-        self.WRValues_standstill.update({'stroke_rate': 0})
-        self.WRValues_standstill.update({'instantaneous pace': 0})
-        self.WRValues_standstill.update({'heart_rate': 0})
-        self.WRValues_standstill.update({'speed': 0})
-        self.WRValues_standstill.update({'watts': 0})
+    def _set(self, key, value):
+        if self.WRValues[key] != value:
+            self.WRValues[key] = value
+            self._version += 1
 
     def avgInstaPowercalc(self,watts):
         if self._StrokeStart:
@@ -183,24 +381,61 @@ class DataLogger(object):
             if self.maxpowerStroke:
                 self._InstaPowerStroke.append(self.maxpowerStroke)
                 self.maxpowerStroke = 0
-            while len(self._InstaPowerStroke) > POWER_AVG_STROKES:
-                self._InstaPowerStroke.pop(0)
             if len(self._InstaPowerStroke) == POWER_AVG_STROKES:
                 self.AvgInstaPower = int(sum(self._InstaPowerStroke) / len(self._InstaPowerStroke))
-                self.WRValues.update({'watts': self.AvgInstaPower})
+                self._set('watts', self.AvgInstaPower)
 
 
-    def get_WRValues(self):                
+    def get_WRValues(self):
+        # standstill: the values are kept but all instantaneous ones are reported as 0
         if self.rowerreset:
-            values = deepcopy(self.WRValues_rst)
+            mode = 'reset'
         elif self.PaddleTurning:
-            values = deepcopy(self.WRValues)
+            mode = 'rowing'
         else:
-            values = deepcopy(self.WRValues_standstill)
-        if values['heart_rate'] == 0:
-            if ext_hr != 0 and time.time() - ext_hr_time < 30: # don't report stale values
-                values['heart_rate'] = ext_hr
-        return values
+            mode = 'standstill'
+        hr = 0
+        if self.ext_hr != 0 and time.time() - self.ext_hr_time < EXT_HR_TIMEOUT: # don't report stale values
+            hr = self.ext_hr
+        key = (mode, 0 if mode == 'reset' else self._version, hr, self.stale)
+        self.snapshot_stats['reads'] += 1
+        if key == self._snapshot_key:
+            return self._snapshot
+        if mode == 'reset':
+            base, overrides = self.WRValues_rst, {}
+        elif mode == 'rowing':
+            base, overrides = self.WRValues, {}
+        else:
+            base, overrides = self.WRValues, dict.fromkeys(STANDSTILL_ZERO, 0)
+        if hr and overrides.get('heart_rate', base['heart_rate']) == 0:
+            overrides['heart_rate'] = hr
+        self._snapshot = WRSnapshot.from_dict(base, overrides, self.stale)
+        self._snapshot_key = key
+        self.snapshot_stats['allocations'] += 1
+        return self._snapshot
+
+    def set_external_hr(self, hr):
+        if hr != self.ext_hr:
+            self.ext_hr = hr
+            self.ext_hr_time = time.time()
+            print("ext_hr", self.ext_hr)
+
+    def get_stroke_metrics(self):
+        if self.analytics is None:
+            return None
+        return self.analytics.summary()
+
+    def get_snapshot_stats(self):
+        elapsed = max(time.monotonic() - self._stats_started, 1e-6)
+        stats = dict(self.snapshot_stats)
+        stats['reads_per_s'] = stats['reads'] / elapsed
+        stats['allocations_per_s'] = stats['allocations'] / elapsed
+        return stats
+
+    def take_trace(self):
+        trace = self._trace
+        self._trace = None
+        return trace
 
     def SendToBLE(self):
         self.BLEvalues = self.get_WRValues()
@@ -209,39 +444,196 @@ class DataLogger(object):
     def SendToANT(self):
         self.ANTvalues = self.get_WRValues()
 
-def main(in_q, ble_out_q,ant_out_q):
-    global ext_hr
-    global ext_hr_time
-    S4 = waterrowerinterface.Rower()
+    def publish(self):
+        # push the values to the outputs only when they differ from what was pushed last time
+        if not self._outputs:
+            return False
+        with self._publish_lock:
+            values = self.get_WRValues()
+            if values is self._published or values == self._published:
+                return False
+            self._published = values
+            self.BLEvalues = values
+            self.ANTvalues = values
+            trace = self.take_trace()
+            if trace is not None:
+                trace['queued'] = latency.stamp()
+            for out_q in self._outputs:
+                out_q.append((values, trace))
+            return True
+
+def handle_command(S4, ResetRequest_ble, datalogger):
+    # a command of the BLE side for the rower it serves: S4 and its DataLogger
+    #print(ResetRequest_ble)
+    parts = ResetRequest_ble.split()
+    cmd = parts[0]
+    if cmd == "reset_ble":
+        S4.reset_request()
+    elif cmd == "hr":
+        datalogger.set_external_hr(int(parts[1]))
+
+
+def first_start(state):
+    # the monitor is reset on the first start only; after a restart of the worker it still holds
+    # the session (distance, strokes, time) and the DataLogger picks it up from there
+    if state is None:
+        return True
+    first = not state.get('started')
+    state['started'] = True
+    state['restarts'] = state.get('restarts', -1) + 1
+    return first
+
+
+def resume(datalogger, state):
+    # kept in state for the next start of the worker, which resumes from its values
+    if state is None:
+        return
+    previous = state.get('datalogger')
+    if previous is not None:
+        datalogger.resume_from(previous)
+    state['datalogger'] = datalogger
+
+
+def start_recorder(S4, options=None, state=None, name=None):
+    # --session-dir: every event and published snapshot also goes to the session recorder. The
+    # recorder outlives a restart of the worker (kept in state), so the session goes on. name: a
+    # sub folder of the session dir, one per rower in hub mode
+    directory = getattr(options, 'session_dir', None)
+    if not directory:
+        return None
+    if name:
+        directory = os.path.join(directory, name)
+    recorder = state.get('recorder') if state is not None else None
+    if recorder is None:
+        from ..session import recorder as session_recorder
+        if session_recorder.np is None:
+            logger.warning("numpy not available, sessions are not recorded")
+            return None
+        recorder = session_recorder.SessionRecorder(directory, SNAPSHOT_KEYS)
+        recorder.start()
+        if state is not None:
+            state['recorder'] = recorder
+    # registered before the DataLogger, so a reset reaches the recorder before the zeroed values
+    S4.register_callback(recorder.on_event)
+    return recorder
+
+
+def outputs_for(recorder, queues, outputs=()):
+    # the BLE / ANT queues, the recorder and any further outputs (the live server)
+    return tuple(queues) + ((recorder,) if recorder is not None else ()) + tuple(outputs)
+
+
+def register_metrics(S4, WRtoBLEANT, recorder=None):
+    # counters of this worker for the /metrics page, replaced by the next instance after a restart
+    registry.register('s4', lambda: {'capture': dict(S4.capture_stats),
+                                     'link': dict(S4.link_stats),
+                                     'poll': registry.Labelled('address', S4.poll_stats())})
+    registry.register('datalogger', WRtoBLEANT.get_snapshot_stats)
+    if recorder is not None:
+        registry.register('recorder', lambda: dict(recorder.stats))
+
+
+def main(in_q, ble_out_q,ant_out_q, options=None, state=None, outputs=()):
+    S4 = waterrowerinterface.Rower(options)
+    recorder = start_recorder(S4, options, state)
     S4.open()
-    S4.reset_request()
-    WRtoBLEANT = DataLogger(S4)
+    if first_start(state):
+        S4.reset_request()
+    # values are pushed from the S4 capture thread as soon as they change, this loop only waits for
+    # commands from the BLE side and re-checks the external heart rate once in a while
+    WRtoBLEANT = DataLogger(S4, outputs=outputs_for(recorder, (ble_out_q, ant_out_q), outputs))
+    resume(WRtoBLEANT, state)
+    register_metrics(S4, WRtoBLEANT, recorder)
+    WRtoBLEANT.publish()
     logger.info("Waterrower Ready and sending data to BLE and ANT Thread")
-    while True:
-        if not in_q.empty():
-            ResetRequest_ble = in_q.get()
-            #print(ResetRequest_ble)
-            parts = ResetRequest_ble.split()
-            cmd = parts[0]
-            if cmd == "reset_ble":
-                S4.reset_request()
-            elif cmd == "hr":
-                new_hr = int(parts[1])
-                if new_hr != ext_hr:
-                    ext_hr = new_hr
-                    ext_hr_time = time.time()
-                    print("ext_hr", ext_hr) 
-        else:
-            pass
-        WRtoBLEANT.SendToBLE()
-        WRtoBLEANT.SendToANT()
-        ble_out_q.append(WRtoBLEANT.BLEvalues)
-        ant_out_q.append(WRtoBLEANT.ANTvalues) # here it is a class deque
-        #print(type(ant_out_q))
-        #print(ant_out_q)
-        #logger.info(WRtoBLEANT.BLEvalues)
-        #ant_out_q.append(WRtoBLEANT.ANTvalues)
-        time.sleep(0.1)
+    try:
+        while True:
+            try:
+                ResetRequest_ble = in_q.get(timeout=COMMAND_WAIT)
+            except Empty:
+                ResetRequest_ble = None
+            if ResetRequest_ble:
+                handle_command(S4, ResetRequest_ble, WRtoBLEANT)
+            WRtoBLEANT.publish()
+    finally:
+        # frees the port and stops the capture threads for the next start
+        S4.close()
+
+
+async def next_command(in_q, timeout=COMMAND_WAIT):
+    # the BLE side hands commands over a plain queue.Queue: waited for on a thread of the default
+    # executor, the loop itself sleeps until a command comes or the timeout (None) is up
+    import asyncio
+    try:
+        return await asyncio.get_running_loop().run_in_executor(None, in_q.get, True, timeout)
+    except Empty:
+        return None
+
+
+async def run_async(in_q, ble_out_q, ant_out_q, options=None, state=None, outputs=()):
+    # serial reads, poll requests, DataLogger updates and publishing all run on this one loop
+    from . import asyncrower
+    S4 = asyncrower.AsyncRower(options)
+    recorder = start_recorder(S4, options, state)
+    await S4.open()
+    if first_start(state):
+        S4.reset_request()
+    WRtoBLEANT = DataLogger(S4, outputs=outputs_for(recorder, (ble_out_q, ant_out_q), outputs))
+    resume(WRtoBLEANT, state)
+    register_metrics(S4, WRtoBLEANT, recorder)
+    WRtoBLEANT.publish()
+    logger.info("Waterrower Ready (asyncio) and sending data to BLE and ANT Thread")
+    try:
+        while True:
+            ResetRequest_ble = await next_command(in_q)
+            if ResetRequest_ble:
+                handle_command(S4, ResetRequest_ble, WRtoBLEANT)
+            WRtoBLEANT.publish()
+    finally:
+        S4.close()
+
+
+def main_async(in_q, ble_out_q, ant_out_q, options=None, state=None, outputs=()):
+    import asyncio
+    asyncio.run(run_async(in_q, ble_out_q, ant_out_q, options, state, outputs))
+
+
+class LoopCommands(object):
+    '''
+    Takes the place of the command queue when the S4 runs on the BLE main loop: a command is
+    handled the moment the BLE side puts it.
+    '''
+
+    def __init__(self, S4, datalogger):
+        self.S4 = S4
+        self.datalogger = datalogger
+
+    def put(self, ResetRequest_ble):
+        handle_command(self.S4, ResetRequest_ble, self.datalogger)
+
+
+def start_glib(ble_out_q, ant_out_q, options=None, state=None, outputs=()):
+    # S4 reads, poll requests, DataLogger updates and publishing as sources on the default GLib
+    # main context; the caller runs the main loop. Returns the command sink for the BLE side.
+    from . import glibrower
+    S4 = glibrower.GLibRower(options)
+    recorder = start_recorder(S4, options, state)
+    WRtoBLEANT = DataLogger(S4, outputs=outputs_for(recorder, (ble_out_q, ant_out_q), outputs))
+    resume(WRtoBLEANT, state)
+    register_metrics(S4, WRtoBLEANT, recorder)
+
+    def republish():
+        # the external heart rate expires without an S4 event
+        if S4.is_closed():
+            return False
+        WRtoBLEANT.publish()
+        return True
+
+    glibrower.GLib.timeout_add(int(COMMAND_WAIT * 1000), republish)
+    S4.open(reset=first_start(state))
+    WRtoBLEANT.publish()
+    logger.info("Waterrower Ready (GLib main loop) and sending data to BLE and ANT")
+    return LoopCommands(S4, WRtoBLEANT)
 
 
 # def maintest():
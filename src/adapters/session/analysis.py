@@ -0,0 +1,231 @@
+import logging
+import os
+
+import numpy as np
+
+from ..s4 import waterrowerinterface
+from ..s4 import wrtobleant
+from . import archive
+from .recorder import snapshot_dtype
+
+logger = logging.getLogger(__name__)
+
+'''
+Offline analysis of recorded workouts: S4 captures (--s4-record) and recorded sessions
+(--session-dir).
+
+Both are replayed event by event through the decoding of waterrowerinterface and a DataLogger,
+the same code the service runs, with the standstill detection clocked by the event times instead
+of the wall clock. What the DataLogger publishes is collected into the snapshot records of the
+recorder, so a change to the metric definitions in wrtobleant shows up in every old workout on the
+next run. Sessions can also be taken as recorded (replay_session=False), without the DataLogger.
+
+The metrics are computed vectorized over the whole session from the snapshot columns:
+    splits        time, pace, mean watts and stroke rate of every SPLIT_M metres
+    power_curve   best mean watts over each of POWER_DURATIONS_S (on a per second timeline)
+    stroke_rates  seconds spent at each stroke rate, STROKE_RATE_BINS
+    best_efforts  fastest time over each of BEST_EFFORT_M metres
+and summarize() merges the results of many sessions (best power and efforts, summed histogram).
+'''
+
+SPLIT_M = 500
+POWER_DURATIONS_S = (1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600)
+STROKE_RATE_BINS = np.arange(0, 62, 2)
+BEST_EFFORT_M = (100, 500, 1000, 2000, 5000, 6000, 10000, 21097, 42195)
+MAX_SPEED_MPS = 10.0  # faster than this is the monitor's distance jumping (a capture started mid-workout)
+MAX_STROKES_PER_S = 2.0  # same for the stroke count, 120 strokes a minute
+
+
+class EventSource(object):
+    '''
+    Stands in for the Rower of a DataLogger when the events come from a file: callbacks get the
+    events in the order they are fed.
+    '''
+
+    def __init__(self):
+        self._callbacks = []
+
+    def register_callback(self, cb, types=None):
+        self._callbacks.append((cb, None if types is None else frozenset(types)))
+
+    def feed(self, event):
+        for cb, types in self._callbacks:
+            if types is None or event.type in types:
+                cb(event)
+
+
+class SnapshotSink(object):
+    # DataLogger output, keeps every published snapshot with the time of the event behind it
+    def __init__(self, clock):
+        self.clock = clock
+        self.rows = []
+
+    def append(self, item):
+        values = item[0]
+        self.rows.append((self.clock[0],) + tuple(values.values()) + (values.stale,))
+
+
+def capture_events(path):
+    # the events the Rower would have delivered for a capture file, timed by the capture
+    framer = waterrowerinterface.LineFramer()
+    reset = waterrowerinterface.RESET_REQUEST.encode()
+    for offset_ms, direction, data in waterrowerinterface.read_capture(path):
+        if direction == waterrowerinterface.CAPTURE_TX:
+            if data.strip().upper() == reset:
+                yield waterrowerinterface.S4Event('reset', None, None, offset_ms)
+            continue
+        for frame in framer.feed(data):
+            event = waterrowerinterface.decode_frame(frame, offset_ms)
+            if event is not None:
+                yield event
+
+
+def session_events(session):
+    # the recorded events of a session as S4Events; a pulse gets its packet back from the count
+    types = session.event_types
+    for at, code, value in session.events.tolist():
+        type = types[code] if code < len(types) else None
+        if type is None:
+            continue
+        raw = None
+        if type == 'pulse':
+            raw = b'P%02X' % max(value, 0)
+            value = None
+        elif value == -1:
+            value = None
+        yield waterrowerinterface.S4Event(type, value, raw, at)
+
+
+def replay(events):
+    # runs the events through a DataLogger, returns the published snapshots as records
+    clock = [0]
+    source = EventSource()
+    sink = SnapshotSink(clock)
+    wrtobleant.DataLogger(source, outputs=(sink,), clock=lambda: clock[0])
+    for event in events:
+        clock[0] = event.at
+        source.feed(event)
+    return np.array(sink.rows, dtype=snapshot_dtype(wrtobleant.SNAPSHOT_KEYS))
+
+
+def load(path, replay_session=True):
+    # snapshot records of a capture file or a session directory
+    if os.path.isdir(path):
+        session = archive.Session(path)
+        if not replay_session:
+            return np.array(session.snapshots)
+        return replay(session_events(session))
+    return replay(capture_events(path))
+
+
+def per_second(snapshots, field):
+    # value of a field at every whole second (the last snapshot at or before it)
+    at = snapshots['at'].astype(np.int64)
+    if len(at) == 0:
+        return np.zeros(0)
+    at = at - at[0]
+    seconds = np.arange(0, at[-1] // 1000 + 1, dtype=np.int64) * 1000
+    index = np.searchsorted(at, seconds, side='right') - 1
+    return snapshots[field][index].astype(np.float64)
+
+
+def rowed(distance, seconds, max_rate=MAX_SPEED_MPS):
+    # distance (or strokes) covered in the workout: what the monitor held before it started, going
+    # back (reset) and jumps faster than max_rate per second are not counted
+    distance = np.asarray(distance, dtype=np.float64)
+    if len(distance) == 0:
+        return distance
+    step = np.diff(distance, prepend=distance[0])
+    elapsed = np.maximum(np.diff(seconds, prepend=seconds[0]), 1.0)
+    step[(step < 0) | (step > max_rate * elapsed)] = 0
+    return np.cumsum(step)
+
+
+def splits(snapshots, split_m=SPLIT_M):
+    distance = per_second(snapshots, 'total_distance_m')
+    distance = rowed(distance, np.arange(len(distance)))
+    if len(distance) == 0 or distance[-1] < split_m:
+        return {'distance_m': np.zeros(0), 'time_s': np.zeros(0), 'pace_500m_s': np.zeros(0),
+                'watts': np.zeros(0), 'stroke_rate': np.zeros(0)}
+    marks = np.arange(0, distance[-1] + 1, split_m)
+    # second at which every mark was reached, the first one is the last second before moving off
+    reached = np.searchsorted(distance, marks, side='left')
+    reached[0] = max(np.searchsorted(distance, 0, side='right') - 1, 0)
+    time_s = np.diff(reached).astype(np.float64)
+    sums = {}
+    for field in ('watts', 'stroke_rate'):
+        cumulative = np.concatenate(([0.0], np.cumsum(per_second(snapshots, field))))
+        sums[field] = (cumulative[reached[1:]] - cumulative[reached[:-1]]) / np.maximum(time_s, 1)
+    return {'distance_m': marks[1:],
+            'time_s': time_s,
+            'pace_500m_s': time_s * 500.0 / split_m,
+            'watts': sums['watts'],
+            'stroke_rate': sums['stroke_rate']}
+
+
+def power_curve(snapshots, durations_s=POWER_DURATIONS_S):
+    watts = per_second(snapshots, 'watts')
+    cumulative = np.concatenate(([0.0], np.cumsum(watts)))
+    best = np.full(len(durations_s), np.nan)
+    for i, duration in enumerate(durations_s):
+        if duration <= len(watts):
+            best[i] = (cumulative[duration:] - cumulative[:-duration]).max() / duration
+    return {'duration_s': np.array(durations_s), 'watts': best}
+
+
+def stroke_rates(snapshots, bins=STROKE_RATE_BINS):
+    rate = per_second(snapshots, 'stroke_rate')
+    counts, edges = np.histogram(rate[rate > 0], bins=bins)
+    return {'stroke_rate': edges[:-1], 'seconds': counts}
+
+
+def best_efforts(snapshots, distances_m=BEST_EFFORT_M):
+    # fastest time between two snapshots that are the distance apart
+    at = snapshots['at'].astype(np.int64)
+    distance = rowed(snapshots['total_distance_m'], at / 1000.0)
+    best = np.full(len(distances_m), np.nan)
+    for i, target in enumerate(distances_m):
+        if len(distance) == 0 or distance[-1] < target:
+            continue
+        end = np.searchsorted(distance, distance + target, side='left')
+        valid = end < len(distance)
+        best[i] = (at[end[valid]] - at[valid]).min() / 1000.0
+    return {'distance_m': np.array(distances_m), 'time_s': best}
+
+
+def analyze(path, replay_session=True):
+    # all metrics of one capture or session; runs in a worker process of the CLI
+    snapshots = load(path, replay_session)
+    duration = (int(snapshots['at'][-1]) - int(snapshots['at'][0])) / 1000.0 if len(snapshots) else 0.0
+    # what was rowed in this workout, like the splits: not what the monitor held before it started
+    seconds = snapshots['at'].astype(np.int64) / 1000.0
+    distance = rowed(snapshots['total_distance_m'], seconds)
+    strokes = rowed(snapshots['total_strokes'], seconds, MAX_STROKES_PER_S)
+    return {'path': path,
+            'snapshots': len(snapshots),
+            'duration_s': duration,
+            'distance_m': float(distance[-1]) if len(distance) else 0.0,
+            'strokes': int(strokes[-1]) if len(strokes) else 0,
+            'splits': splits(snapshots),
+            'power_curve': power_curve(snapshots),
+            'stroke_rates': stroke_rates(snapshots),
+            'best_efforts': best_efforts(snapshots)}
+
+
+def summarize(results):
+    # bests over all sessions and the summed stroke rate histogram
+    if not results:
+        return None
+    power = np.vstack([result['power_curve']['watts'] for result in results])
+    efforts = np.vstack([result['best_efforts']['time_s'] for result in results])
+    # fmax / fmin skip the nan of a session too short for a duration or distance
+    best_power = np.fmax.reduce(power, axis=0)
+    best_time = np.fmin.reduce(efforts, axis=0)
+    return {'sessions': len(results),
+            'duration_s': sum(result['duration_s'] for result in results),
+            'distance_m': sum(result['distance_m'] for result in results),
+            'strokes': sum(result['strokes'] for result in results),
+            'power_curve': {'duration_s': results[0]['power_curve']['duration_s'], 'watts': best_power},
+            'stroke_rates': {'stroke_rate': results[0]['stroke_rates']['stroke_rate'],
+                             'seconds': np.sum([result['stroke_rates']['seconds'] for result in results], axis=0)},
+            'best_efforts': {'distance_m': results[0]['best_efforts']['distance_m'], 'time_s': best_time}}
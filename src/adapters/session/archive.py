@@ -0,0 +1,267 @@
+import collections
+import json
+import logging
+import os
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+logger = logging.getLogger(__name__)
+
+'''
+Read side of the recorded sessions (see recorder.py): random access into any session without
+loading it.
+
+The snapshots.bin / events.bin of a session are mapped read only with np.memmap, a query returns
+a slice of the map (a view, nothing is copied or read until it is used). Finding the slice goes
+through a sidecar index next to the records:
+    snapshots.time.idx   offset of the first snapshot of every second of the session
+    events.time.idx      same for the events
+    snapshots.stroke.idx offset of the first snapshot of every stroke (by total_strokes)
+    index.json           the record counts the index was built for
+The .idx files are int32 .npy arrays, mapped as well. A lookup is one index read plus a
+searchsorted within that second, whatever the length of the session. The recorder writes the
+index when a session ends; a session that is still being written or was cut short has its index
+built in memory when it is opened with more records than the index knows of. Opening a session
+never writes to it, so an archive on a read-only copy can be read as well.
+
+Aggregates (per minute means and so on) are reduced bucket by bucket from the mapped column with
+the bucket boundaries taken from the time index, so only the pages of the asked range are touched.
+
+    archive = SessionArchive('~/rowflo-sessions')
+    session = archive.open(archive.sessions()[-1])
+    strokes = session.strokes(1200, 1400)              # snapshot records, a view
+    minutes = session.aggregate('watts', 60000)         # {'start_ms', 'count', 'mean', 'min', 'max'}
+'''
+
+INDEX_STEP_MS = 1000      # time index resolution
+OPEN_SESSIONS = 16        # mapped sessions kept open by an archive
+STROKE_FIELD = 'total_strokes'
+
+
+def index_path(path, name):
+    return os.path.join(path, name + '.idx')
+
+
+def record_count(file, dtype):
+    try:
+        return os.path.getsize(file) // dtype.itemsize  # a torn last record is left out
+    except OSError:
+        return 0
+
+
+def map_records(file, dtype, count):
+    if count == 0:
+        return np.zeros(0, dtype=dtype)  # np.memmap cannot map an empty file
+    return np.memmap(file, dtype=dtype, mode='r', shape=(count,))
+
+
+def time_index(at, step_ms=INDEX_STEP_MS):
+    # offset of the first record at or after every step; at goes up (a clock step back is flattened)
+    if len(at) == 0:
+        return np.zeros(1, dtype=np.int32)
+    at = np.maximum.accumulate(np.asarray(at, dtype=np.int64))
+    steps = np.arange(0, int(at[-1]) // step_ms + 2, dtype=np.int64) * step_ms
+    return np.searchsorted(at, steps, side='left').astype(np.int32)
+
+
+def stroke_index(strokes):
+    # offset of the first record of stroke n, for n from 0 to the last stroke + 1
+    if len(strokes) == 0:
+        return np.zeros(1, dtype=np.int32)
+    strokes = np.maximum.accumulate(np.asarray(strokes, dtype=np.float64))
+    numbers = np.arange(0, int(strokes[-1]) + 2, dtype=np.float64)
+    return np.searchsorted(strokes, numbers, side='left').astype(np.int32)
+
+
+def save_index(path, name, array):
+    tmp = index_path(path, name) + '.tmp'
+    with open(tmp, 'wb') as f:
+        np.save(f, array, allow_pickle=False)
+    os.replace(tmp, index_path(path, name))
+
+
+def build_index(snapshots, events):
+    # the sidecar index of the records, name -> array
+    index = {'snapshots.time': time_index(snapshots['at']),
+             'events.time': time_index(events['at'])}
+    if STROKE_FIELD in snapshots.dtype.names:
+        index['snapshots.stroke'] = stroke_index(snapshots[STROKE_FIELD])
+    return index
+
+
+def write_index(path):
+    # builds the sidecar index of a session directory from its records and saves it (the recorder,
+    # when a session ends), returns the counts
+    session = Session(path, use_index=False)
+    counts = {'snapshots': len(session.snapshots), 'events': len(session.events)}
+    for name, array in build_index(session.snapshots, session.events).items():
+        save_index(path, name, array)
+    tmp = os.path.join(path, 'index.json.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(counts, f)
+    os.replace(tmp, os.path.join(path, 'index.json'))
+    return counts
+
+
+def load_index(path, name):
+    try:
+        return np.load(index_path(path, name), mmap_mode='r', allow_pickle=False)
+    except (OSError, ValueError):
+        return None
+
+
+class Session(object):
+    def __init__(self, path, use_index=True):
+        if np is None:
+            raise RuntimeError('Session needs numpy')
+        self.path = path
+        with open(os.path.join(path, 'session.json')) as f:
+            self.meta = json.load(f)
+        self.name = os.path.basename(path)
+        self.started_ms = self.meta['started_ms']
+        self.event_types = self.meta['event_types']
+        self.sizes = {}
+        arrays = {}
+        for name, descr in (('snapshots', self.meta['snapshot_dtype']), ('events', self.meta['event_dtype'])):
+            dtype = np.dtype([tuple(field) for field in descr])
+            file = os.path.join(path, name + '.bin')
+            count = record_count(file, dtype)
+            self.sizes[name] = count * dtype.itemsize
+            arrays[name] = map_records(file, dtype, count)
+        self.snapshots = arrays['snapshots']
+        self.events = arrays['events']
+        self._index = {}
+        if use_index:
+            self._load_index()
+
+    def _load_index(self):
+        try:
+            with open(os.path.join(self.path, 'index.json')) as f:
+                counts = json.load(f)
+        except (OSError, ValueError):
+            counts = None
+        if counts != {'snapshots': len(self.snapshots), 'events': len(self.events)}:
+            logger.info("indexing session %s in memory", self.name)
+            self._index = build_index(self.snapshots, self.events)
+            return
+        for name in ('snapshots.time', 'events.time', 'snapshots.stroke'):
+            self._index[name] = load_index(self.path, name)
+
+    def is_current(self):
+        # False once the recorder appended to the files, the archive then maps them again
+        for name, size in self.sizes.items():
+            file = os.path.join(self.path, name + '.bin')
+            try:
+                if os.path.getsize(file) - size >= getattr(self, name).dtype.itemsize:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def duration_ms(self):
+        ends = [int(records['at'][-1]) for records in (self.snapshots, self.events) if len(records)]
+        return max(ends) if ends else 0
+
+    def stroke_count(self):
+        index = self._index.get('snapshots.stroke')
+        return 0 if index is None else len(index) - 2
+
+    def _offset(self, records, name, at_ms):
+        # first record at or after at_ms, from the time index and a look within that second
+        index = self._index.get(name)
+        at_ms = max(0, int(at_ms))
+        if index is None:
+            return int(np.searchsorted(records['at'], at_ms, side='left'))
+        step = at_ms // INDEX_STEP_MS
+        if step >= len(index) - 1:
+            return len(records)
+        lo, hi = int(index[step]), int(index[step + 1])
+        return lo + int(np.searchsorted(records['at'][lo:hi], at_ms, side='left'))
+
+    def between(self, start_ms=0, end_ms=None, events=False):
+        # records with start_ms <= at < end_ms (ms since the start of the session), a view
+        records = self.events if events else self.snapshots
+        name = 'events.time' if events else 'snapshots.time'
+        lo = self._offset(records, name, start_ms)
+        hi = len(records) if end_ms is None else self._offset(records, name, end_ms)
+        return records[lo:max(lo, hi)]
+
+    def strokes(self, first, last=None):
+        # snapshots from the start of stroke first to the end of stroke last, a view
+        index = self._index.get('snapshots.stroke')
+        if index is None or len(index) < 2:
+            return self.snapshots[0:0]
+        last = first if last is None else last
+        first = min(max(0, int(first)), len(index) - 1)
+        last = min(max(first, int(last)) + 1, len(index) - 1)
+        return self.snapshots[int(index[first]):int(index[last])]
+
+    def events_of(self, type, start_ms=0, end_ms=None):
+        # events of one type in a time range; this one is a copy (selected by a mask)
+        records = self.between(start_ms, end_ms, events=True)
+        if type not in self.event_types:
+            return records[0:0]
+        return records[records['type'] == self.event_types.index(type)]
+
+    def downsample(self, step, start_ms=0, end_ms=None):
+        # every step-th snapshot of a time range, a strided view
+        return self.between(start_ms, end_ms)[::max(1, int(step))]
+
+    def aggregate(self, field, bucket_ms=60000, start_ms=0, end_ms=None, events=False):
+        # per bucket count / mean / min / max of one field; empty buckets have count 0 and nan
+        records = self.events if events else self.snapshots
+        name = 'events.time' if events else 'snapshots.time'
+        if end_ms is None:
+            end_ms = self.duration_ms() + 1
+        starts = np.arange(int(start_ms), int(end_ms), int(bucket_ms), dtype=np.int64)
+        if len(starts) == 0:
+            empty = np.zeros(0)
+            return {'start_ms': starts, 'count': empty.astype(np.int64), 'mean': empty, 'min': empty, 'max': empty}
+        bounds = np.array([self._offset(records, name, at) for at in starts] +
+                          [self._offset(records, name, end_ms)], dtype=np.int64)
+        lo, hi = int(bounds[0]), int(bounds[-1])
+        column = np.asarray(records[field][lo:hi], dtype=np.float64)
+        counts = np.diff(bounds)
+        filled = counts > 0
+        result = {'start_ms': starts, 'count': counts,
+                  'mean': np.full(len(starts), np.nan), 'min': np.full(len(starts), np.nan),
+                  'max': np.full(len(starts), np.nan)}
+        if len(column):
+            offsets = (bounds[:-1] - lo)[filled]
+            result['mean'][filled] = np.add.reduceat(column, offsets) / counts[filled]
+            result['min'][filled] = np.minimum.reduceat(column, offsets)
+            result['max'][filled] = np.maximum.reduceat(column, offsets)
+        return result
+
+
+class SessionArchive(object):
+    def __init__(self, directory, open_sessions=OPEN_SESSIONS):
+        if np is None:
+            raise RuntimeError('SessionArchive needs numpy')
+        self.directory = os.path.expanduser(directory)
+        self.open_sessions = open_sessions
+        self._open = collections.OrderedDict()  # name -> Session, least recently used first
+
+    def sessions(self):
+        # session names, oldest first (the names are the start times)
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return sorted(name for name in names
+                      if os.path.exists(os.path.join(self.directory, name, 'session.json')))
+
+    def open(self, name):
+        session = self._open.pop(name, None)
+        if session is None or not session.is_current():
+            session = Session(os.path.join(self.directory, name))
+        self._open[name] = session
+        while len(self._open) > self.open_sessions:
+            self._open.popitem(last=False)  # its maps are closed once nothing holds a view
+        return session
+
+    def close(self):
+        self._open.clear()
@@ -0,0 +1,285 @@
+import atexit
+import collections
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from . import archive
+
+logger = logging.getLogger(__name__)
+
+'''
+Background recorder of the workouts, one directory per session:
+    <session dir>/<YYYYmmdd-HHMMSS>/session.json    start time, record layouts, event type codes
+                                    snapshots.bin   one fixed width record per published snapshot
+                                    events.bin      one fixed width record per S4 event
+
+The .bin files are append-only arrays of NumPy structured records (snapshot_dtype / EVENT_DTYPE,
+little endian, no padding), so np.fromfile or np.memmap reads them back as they are, and a
+session cut short by a crash or power loss is still readable up to the last complete record.
+Times are ms since the start of the session. A snapshot is 49 bytes and an event 9 bytes, an hour
+of rowing is about 4 MB.
+
+The recording side only appends a tuple to a deque: the serial capture thread (events) and the
+publishing DataLogger (snapshots) never wait on the disk. A writer thread turns what piled up into
+records every FLUSH_INTERVAL and fsyncs every FSYNC_INTERVAL. Should the disk fall behind by more
+than MAX_PENDING entries, new entries are dropped and counted instead of growing the memory.
+
+A reset of the monitor starts a new session. When a session ends its index is written for
+archive.py, which reads the sessions back memory mapped. Raw serial frames are not kept, a memory
+reply is its address and value and a pulse packet its count; --s4-record is there for the raw bytes.
+'''
+
+FLUSH_INTERVAL = 1.0     # seconds between two writes of the pending records
+FSYNC_INTERVAL = 10.0    # seconds between two fsyncs, at most this much of a session is lost on power loss
+MAX_PENDING = 100000     # entries waiting for the writer, about a minute at the highest event rate
+FORMAT_VERSION = 1
+NO_VALUE = -1            # event value of events without one (stroke_start, ping, ...)
+
+EVENT_DTYPE = None if np is None else np.dtype([('at', '<i4'), ('type', 'u1'), ('value', '<i4')])
+
+
+def snapshot_dtype(keys):
+    return np.dtype([('at', '<i4')] + [(key, '<f4') for key in keys] + [('stale', 'u1')])
+
+
+def session_name(started_ms):
+    return time.strftime('%Y%m%d-%H%M%S', time.localtime(started_ms / 1000.0))
+
+
+def write_json(path, content):
+    # replaced in one step, a reader never sees half a file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(content, f, indent=1)
+    os.replace(tmp, path)
+
+
+def load_session(path):
+    # returns (meta, snapshots, events) of a recorded session directory
+    with open(os.path.join(path, 'session.json')) as f:
+        meta = json.load(f)
+    arrays = []
+    for name, descr in (('snapshots', meta['snapshot_dtype']), ('events', meta['event_dtype'])):
+        dtype = np.dtype([tuple(field) for field in descr])
+        file = os.path.join(path, name + '.bin')
+        if not os.path.exists(file):
+            arrays.append(np.zeros(0, dtype=dtype))
+            continue
+        count = os.path.getsize(file) // dtype.itemsize  # a torn last record is left out
+        arrays.append(np.fromfile(file, dtype=dtype, count=count))
+    return meta, arrays[0], arrays[1]
+
+
+class SessionFiles(object):
+    def __init__(self, directory, started_ms, snapshot_dtype, event_types):
+        self.started_ms = started_ms
+        self.path = os.path.join(directory, session_name(started_ms))
+        suffix = 1
+        while os.path.exists(self.path):
+            suffix += 1
+            self.path = os.path.join(directory, '%s-%d' % (session_name(started_ms), suffix))
+        os.makedirs(self.path)
+        self.snapshot_dtype = snapshot_dtype
+        self.event_types = event_types  # the recorder's list, grows as new types show up
+        self.snapshots = open(os.path.join(self.path, 'snapshots.bin'), 'ab')
+        self.events = open(os.path.join(self.path, 'events.bin'), 'ab')
+        self.counts = {'snapshots': 0, 'events': 0}
+        self.known_types = 0
+        self.write_meta()
+
+    def write_meta(self, ended_ms=None):
+        self.known_types = len(self.event_types)
+        write_json(os.path.join(self.path, 'session.json'),
+                   {'version': FORMAT_VERSION,
+                    'started_ms': self.started_ms,
+                    'ended_ms': ended_ms,
+                    'snapshot_dtype': self.snapshot_dtype.descr,
+                    'event_dtype': EVENT_DTYPE.descr,
+                    'event_types': list(self.event_types),
+                    'counts': self.counts})
+
+    def is_empty(self):
+        return not self.counts['snapshots'] and not self.counts['events']
+
+    def write(self, snapshots, events):
+        written = 0
+        if len(snapshots):
+            self.snapshots.write(snapshots.tobytes())
+            self.counts['snapshots'] += len(snapshots)
+            written += snapshots.nbytes
+        if len(events):
+            self.events.write(events.tobytes())
+            self.counts['events'] += len(events)
+            written += events.nbytes
+        if self.known_types != len(self.event_types):
+            self.write_meta()
+        return written
+
+    def sync(self):
+        for f in (self.snapshots, self.events):
+            f.flush()
+            os.fsync(f.fileno())
+
+    def close(self, ended_ms):
+        self.sync()
+        self.snapshots.close()
+        self.events.close()
+        self.write_meta(ended_ms)
+
+
+class SessionRecorder(object):
+    def __init__(self, directory, keys, flush_interval=FLUSH_INTERVAL, fsync_interval=FSYNC_INTERVAL,
+                 max_pending=MAX_PENDING):
+        if np is None:
+            raise RuntimeError('SessionRecorder needs numpy')
+        self.directory = directory
+        self.keys = tuple(keys)
+        self.snapshot_dtype = snapshot_dtype(self.keys)
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.max_pending = max_pending
+        self.event_types = []
+        self._codes = {}
+        self._pending = collections.deque()
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._session = None
+        self._last_sync = 0.0
+        self.stats = {'sessions': 0, 'snapshots': 0, 'events': 0, 'bytes': 0, 'dropped': 0,
+                      'fsyncs': 0, 'fsync_ms': 0.0, 'errors': 0}
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run, name='session-recorder', daemon=True)
+        self._thread.start()
+        # the workers are daemon threads, the last second is written when the interpreter exits
+        atexit.register(self.close)
+        logger.info("recording sessions to %s", self.directory)
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    # the two entry points below run on the serial and publishing paths: one append, nothing else
+
+    def on_event(self, event):
+        # Rower callback, every event
+        if len(self._pending) >= self.max_pending:
+            self.stats['dropped'] += 1
+            return
+        self._pending.append((event.type, event.at, event.value, event.raw))
+
+    def append(self, item):
+        # DataLogger output, (snapshot, trace) once per published change
+        if len(self._pending) >= self.max_pending:
+            self.stats['dropped'] += 1
+            return
+        self._pending.append((None, int(time.time() * 1000), item[0], None))
+
+    def _run(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self._flush()
+        self._flush()
+        self._close_session()
+
+    def _code(self, type):
+        code = self._codes.get(type)
+        if code is None:
+            code = len(self.event_types)
+            if code > 255:
+                return 255
+            self._codes[type] = code
+            self.event_types.append(type)
+        return code
+
+    def _flush(self):
+        try:
+            self._write_pending()
+            if self._session is not None and time.monotonic() - self._last_sync >= self.fsync_interval:
+                self._sync()
+        except (OSError, ValueError) as e:
+            # a full or gone disk must not take the rower down, what is pending is given up
+            self.stats['errors'] += 1
+            self._pending.clear()
+            logger.error("session recording failed: %s", e)
+
+    def _write_pending(self):
+        snapshots = []
+        events = []
+        pending = self._pending
+        while pending:
+            type, at, value, raw = pending.popleft()
+            if type == 'reset':
+                # a new workout; the records so far belong to the session before
+                self._write(snapshots, events)
+                snapshots, events = [], []
+                if self._session is not None and not self._session.is_empty():
+                    self._close_session()
+            if self._session is None:
+                self._open_session(at)
+            at -= self._session.started_ms
+            if type is None:
+                snapshots.append((at,) + tuple(value.values()) + (value.stale,))
+                continue
+            if type == 'pulse':
+                try:
+                    value = int(raw[1:], 16)
+                except (TypeError, ValueError):
+                    value = None
+            elif not isinstance(value, int):
+                value = None
+            events.append((at, self._code(type), NO_VALUE if value is None else value))
+        self._write(snapshots, events)
+
+    def _write(self, snapshots, events):
+        if not snapshots and not events:
+            return
+        snapshots = np.array(snapshots, dtype=self.snapshot_dtype)
+        events = np.array(events, dtype=EVENT_DTYPE)
+        self.stats['bytes'] += self._session.write(snapshots, events)
+        self.stats['snapshots'] += len(snapshots)
+        self.stats['events'] += len(events)
+
+    def _open_session(self, started_ms):
+        self._session = SessionFiles(self.directory, started_ms, self.snapshot_dtype, self.event_types)
+        self._last_sync = time.monotonic()
+        self.stats['sessions'] += 1
+        logger.info("session %s started", self._session.path)
+
+    def _sync(self):
+        began = time.monotonic()
+        self._session.sync()
+        self._last_sync = time.monotonic()
+        self.stats['fsyncs'] += 1
+        self.stats['fsync_ms'] = round((self._last_sync - began) * 1000, 2)
+
+    def _close_session(self):
+        if self._session is None:
+            return
+        session = self._session
+        self._session = None
+        session.close(int(time.time() * 1000))
+        try:
+            archive.write_index(session.path)
+        except (OSError, ValueError) as e:
+            logger.error("could not index session %s: %s", session.path, e)
+        logger.info("session %s: %d snapshots, %d events", session.path,
+                    session.counts['snapshots'], session.counts['events'])
+
+    def close(self):
+        # writes what is pending, fsyncs and closes the session; safe to call more than once
+        if self._thread is None:
+            return
+        self._stop_event.set()
+        self._thread.join()
+        self._thread = None
+        atexit.unregister(self.close)
+        logger.info("session recorder: %s", self.stats)
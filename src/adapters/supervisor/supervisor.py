@@ -0,0 +1,124 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+'''
+In-process supervisor for the worker threads (S4 reader, BLE server).
+
+A worker that dies - returns or raises - is restarted on its own, the other workers keep running.
+Restarts back off exponentially (BACKOFF_START doubled per failure up to BACKOFF_MAX) so a worker
+that fails right away, e.g. the adapter is gone, does not spin. A worker that stayed up for
+STABLE_AFTER seconds starts over at the shortest delay.
+
+Whatever has to survive a restart lives outside the worker and is handed in again: the queues
+between the workers and a per component state dict the worker may keep things in.
+
+stats() has per component: starts, restarts, downtime (total and current), uptime of the running
+instance and the last error.
+'''
+
+BACKOFF_START = 1.0    # seconds before the first restart
+BACKOFF_MAX = 60.0     # longest wait between two restarts
+STABLE_AFTER = 60.0    # seconds up after which a failure counts as the first one again
+CHECK_INTERVAL = 1.0   # seconds between two looks at the workers
+
+
+class Component(object):
+    def __init__(self, name, target, args=()):
+        self.name = name
+        self.target = target
+        self.args = args
+        self.state = {}  # kept across restarts, the worker gets it as keyword argument 'state'
+        self.thread = None
+        self.starts = 0
+        self.failures = 0  # in a row, for the backoff
+        self.started_at = None
+        self.down_since = None
+        self.restart_at = None
+        self.downtime = 0.0
+        self.last_error = None
+
+    def start(self, now=None):
+        now = time.monotonic() if now is None else now
+        if self.down_since is not None:
+            self.downtime += now - self.down_since
+            self.down_since = None
+        self.starts += 1
+        self.started_at = now
+        self.restart_at = None
+        self.thread = threading.Thread(target=self._run, name=self.name, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            self.target(*self.args, state=self.state)
+            self.last_error = "returned"
+            logger.error("%s returned", self.name)
+        except Exception as e:
+            self.last_error = repr(e)
+            logger.exception("%s crashed", self.name)
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stats(self, now=None):
+        now = time.monotonic() if now is None else now
+        down = now - self.down_since if self.down_since is not None else 0.0
+        return {'up': self.is_alive(),
+                'starts': self.starts,
+                'restarts': max(0, self.starts - 1),
+                'downtime_s': round(self.downtime + down, 3),
+                'down_for_s': round(down, 3),
+                'uptime_s': round(now - self.started_at, 3) if self.is_alive() else 0.0,
+                'last_error': self.last_error}
+
+
+class Supervisor(object):
+    def __init__(self, backoff_start=BACKOFF_START, backoff_max=BACKOFF_MAX, stable_after=STABLE_AFTER):
+        self.backoff_start = backoff_start
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.components = []
+
+    def add(self, name, target, args=()):
+        component = Component(name, target, args)
+        self.components.append(component)
+        return component
+
+    def start(self):
+        for component in self.components:
+            component.start()
+            logger.info("%s started", component.name)
+
+    def check(self, now=None):
+        now = time.monotonic() if now is None else now
+        for component in self.components:
+            if component.is_alive():
+                continue
+            if component.down_since is None:
+                component.down_since = now
+                ran = now - component.started_at
+                component.failures = 1 if ran >= self.stable_after else component.failures + 1
+                delay = min(self.backoff_start * 2 ** (component.failures - 1), self.backoff_max)
+                component.restart_at = now + delay
+                logger.warning("%s stopped after %.1fs (%s), restarting in %.1fs",
+                               component.name, ran, component.last_error, delay)
+            elif now >= component.restart_at:
+                component.start(now)
+                logger.info("%s restarted (restart %d)", component.name, component.starts - 1)
+
+    def run(self, keep_running, interval=CHECK_INTERVAL):
+        # keep_running: called once per check, the supervisor returns when it is False
+        while keep_running():
+            self.check()
+            time.sleep(interval)
+
+    def stats(self):
+        now = time.monotonic()
+        return {component.name: component.stats(now) for component in self.components}
+
+    def log_stats(self):
+        for name, entry in self.stats().items():
+            logger.info("worker %s: %s", name, entry)
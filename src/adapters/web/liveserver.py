@@ -0,0 +1,279 @@
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import struct
+import threading
+
+from ..metrics import registry
+
+logger = logging.getLogger(__name__)
+
+'''
+Read-only HTTP and WebSocket server of the live values, for dashboards next to the rowers.
+
+    GET /          small page showing the values, fed by the WebSocket
+    GET /snapshot  the current snapshot as JSON
+    GET /ws        WebSocket, one text message with the snapshot JSON per change
+    GET /metrics   counters of the pipeline in the Prometheus text format (metrics/registry.py)
+    GET /rowers    names of the rowers of a hub (--hub), each served like the above under
+                   /rowers/<name>/ (page), /rowers/<name>/snapshot and /rowers/<name>/ws
+
+Every rower is a LiveChannel, a DataLogger output like the BLE channel: append() only keeps the
+newest snapshot and wakes the server loop (once, however many snapshots arrive before it runs).
+The loop encodes the JSON and the WebSocket frame once and writes the same bytes to every client,
+so a client costs a socket write per change and nothing on the serial or BLE side. A client that
+does not read is skipped (its frames are dropped) until its socket buffer drained, it never holds
+up the others.
+
+Plain asyncio streams, no dependency beyond the standard library.
+'''
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+MAX_CLIENT_BUFFER = 64 * 1024   # bytes queued for a client before its frames are dropped
+MAX_REQUEST_BYTES = 8192        # request line plus headers
+REQUEST_TIMEOUT = 10            # seconds a client gets to send its request
+DEFAULT_CHANNEL = 'default'     # the rower of a single rower setup, or the one on BLE in hub mode
+
+PAGE = b'''<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>RowFlo</title></head>
+<body style="font-family:sans-serif"><h1>RowFlo</h1><table id="values"></table>
+<script>
+const table = document.getElementById('values');
+const ws = new WebSocket((location.protocol == 'https:' ? 'wss://' : 'ws://') + location.host +
+                         location.pathname.replace(/\/?$/, '/') + 'ws');
+ws.onmessage = (message) => {
+  const values = JSON.parse(message.data);
+  table.innerHTML = Object.entries(values).map(([key, value]) => `<tr><td>${key}</td><td>${value}</td></tr>`).join('');
+};
+</script></body></html>
+'''
+
+
+def ws_frame(payload, opcode=0x1):
+    # unmasked server frame, FIN set
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', 0x80 | opcode, length)
+    elif length < 1 << 16:
+        header = struct.pack('!BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('!BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def ws_accept(key):
+    # Sec-WebSocket-Accept of a Sec-WebSocket-Key
+    return base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+
+
+def http_response(status, content_type, body, extra=b''):
+    return (b'HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nCache-Control: no-store\r\n'
+            b'Connection: close\r\n%s\r\n' % (status, content_type, len(body), extra)) + body
+
+
+class LiveChannel(object):
+    '''
+    The values of one rower: the newest snapshot, its encoded forms and the WebSocket clients
+    following it. A DataLogger output.
+    '''
+
+    def __init__(self, server, name):
+        self.server = server
+        self.name = name
+        self._latest = None
+        self._wakeup_pending = False
+        self._lock = threading.Lock()
+        self.clients = set()
+        self._seq = 0
+        self.snapshot_response = http_response(b'200 OK', b'application/json', b'{}')
+        self.frame = None
+        self.stats = {'changes': 0, 'broadcasts': 0, 'frames': 0, 'dropped': 0, 'bytes': 0}
+
+    def bind(self):
+        # called on a new loop (the HTTP worker restarted): a wakeup posted to the old loop never
+        # ran, and its clients went with it
+        with self._lock:
+            self._wakeup_pending = False
+        self.clients.clear()
+
+    # called on the publishing thread
+
+    def append(self, item):
+        with self._lock:
+            self._latest = item[0]
+            loop = self.server.loop
+            if self._wakeup_pending or loop is None:
+                return
+            self._wakeup_pending = True
+        loop.call_soon_threadsafe(self.broadcast)
+
+    def broadcast(self):
+        with self._lock:
+            values = self._latest
+            self._wakeup_pending = False
+        if values is None:
+            return
+        self._seq += 1
+        self.stats['changes'] += 1
+        content = values.as_dict()
+        content['stale'] = values.stale
+        content['seq'] = self._seq
+        body = json.dumps(content).encode()
+        self.snapshot_response = http_response(b'200 OK', b'application/json', body)
+        self.frame = ws_frame(body)
+        if not self.clients:
+            return
+        self.stats['broadcasts'] += 1
+        for writer in list(self.clients):
+            self.send(writer, self.frame)
+
+    def send(self, writer, frame):
+        transport = writer.transport
+        if transport.is_closing():
+            self.clients.discard(writer)
+            return
+        if transport.get_write_buffer_size() > MAX_CLIENT_BUFFER:
+            self.stats['dropped'] += 1
+            return
+        writer.write(frame)
+        self.stats['frames'] += 1
+        self.stats['bytes'] += len(frame)
+
+    def metrics(self):
+        stats = dict(self.stats)
+        stats['clients'] = len(self.clients)
+        return stats
+
+
+class LiveServer(object):
+    def __init__(self, host='127.0.0.1', port=8080):
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.channels = {}
+        self.default = self.channel(DEFAULT_CHANNEL)
+        self.stats = {'connections': 0, 'requests': 0}
+
+    def channel(self, name):
+        # the channel of one rower (hub mode), served under /rowers/<name>/
+        channel = self.channels.get(name)
+        if channel is None:
+            channel = self.channels[name] = LiveChannel(self, name)
+        return channel
+
+    def append(self, item):
+        # DataLogger output of a single rower: the default channel, / /snapshot /ws
+        self.default.append(item)
+
+    def metrics(self):
+        stats = dict(self.stats)
+        stats['clients'] = sum(len(channel.clients) for channel in self.channels.values())
+        stats['channel'] = registry.Labelled('channel', {name: channel.metrics()
+                                                          for name, channel in list(self.channels.items())})
+        return stats
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        for channel in list(self.channels.values()):
+            channel.bind()
+        registry.register('http', self.metrics)
+        server = await asyncio.start_server(self._handle, self.host, self.port)
+        logger.info("live values on http://%s:%d/", self.host, self.port)
+        for channel in list(self.channels.values()):
+            channel.broadcast()  # what was published before the loop ran
+        async with server:
+            await server.serve_forever()
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def _handle(self, reader, writer):
+        self.stats['connections'] += 1
+        try:
+            head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), REQUEST_TIMEOUT)
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            writer.close()
+            return
+        self.stats['requests'] += 1
+        lines = head[:MAX_REQUEST_BYTES].decode('latin-1').split('\r\n')
+        parts = lines[0].split()
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if len(parts) < 2 or parts[0] != 'GET':
+            writer.write(http_response(b'405 Method Not Allowed', b'text/plain', b'read only\n'))
+        else:
+            path = parts[1].split('?', 1)[0]
+            channel, path = self._route(path)
+            if channel is None:
+                writer.write(http_response(b'404 Not Found', b'text/plain', b'not found\n'))
+            elif path == '/ws' and headers.get('upgrade', '').lower() == 'websocket':
+                await self._websocket(reader, writer, headers, channel)
+                return
+            elif path == '/snapshot':
+                writer.write(channel.snapshot_response)
+            elif path == '/metrics':
+                body = registry.prometheus().encode()
+                writer.write(http_response(b'200 OK', b'text/plain; version=0.0.4', body))
+            elif path == '/rowers':
+                body = json.dumps(sorted(name for name in list(self.channels) if name != DEFAULT_CHANNEL)).encode()
+                writer.write(http_response(b'200 OK', b'application/json', body))
+            elif path == '/':
+                writer.write(http_response(b'200 OK', b'text/html; charset=utf-8', PAGE))
+            else:
+                writer.write(http_response(b'404 Not Found', b'text/plain', b'not found\n'))
+        try:
+            await writer.drain()
+        except ConnectionError:
+            pass
+        writer.close()
+
+    def _route(self, path):
+        # (channel, path within it); /rowers/<name>/... is the channel of that rower
+        if not path.startswith('/rowers/'):
+            return self.default, path
+        name, _, rest = path[len('/rowers/'):].partition('/')
+        return self.channels.get(name), '/' + rest
+
+    async def _websocket(self, reader, writer, headers, channel):
+        key = headers.get('sec-websocket-key', '').encode()
+        if not key:
+            writer.write(http_response(b'400 Bad Request', b'text/plain', b'no websocket key\n'))
+            writer.close()
+            return
+        accept = ws_accept(key)
+        writer.write(b'HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                     b'Sec-WebSocket-Accept: %s\r\n\r\n' % accept)
+        if channel.frame is not None:
+            channel.send(writer, channel.frame)
+        channel.clients.add(writer)
+        try:
+            await self._read_frames(reader, writer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            channel.clients.discard(writer)
+            writer.close()
+
+    async def _read_frames(self, reader, writer):
+        # the clients only send control frames we have to answer: ping and close
+        while True:
+            first, second = await reader.readexactly(2)
+            opcode = first & 0x0f
+            length = second & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', await reader.readexactly(8))[0]
+            if length > MAX_REQUEST_BYTES:
+                return
+            mask = await reader.readexactly(4) if second & 0x80 else b'\0\0\0\0'
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(await reader.readexactly(length)))
+            if opcode == 0x8:
+                writer.write(ws_frame(payload[:2], 0x8))
+                return
+            if opcode == 0x9:
+                writer.write(ws_frame(payload, 0xA))
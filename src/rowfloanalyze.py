@@ -0,0 +1,143 @@
+"""
+rowflo-analyze: split tables, power curves, stroke rate histograms and best efforts of recorded
+workouts.
+
+Takes S4 captures (waterrowerthreads.py --s4-record) and recorded sessions (a session directory,
+or the --session-dir folder for all sessions in it) and replays every one of them through the S4
+decoding and DataLogger of the service, so the numbers follow the current metric definitions.
+The workouts are processed in parallel, one per worker process.
+
+Example:
+python3 rowfloanalyze.py ~/rowflo-sessions
+python3 rowfloanalyze.py /tmp/session.s4cap --splits
+python3 rowfloanalyze.py ~/rowflo-sessions --jobs 4 --json /tmp/season.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from adapters.session import analysis
+
+logger = logging.getLogger(__name__)
+
+
+def find_workouts(paths):
+    # a session directory, a folder of sessions or a capture file
+    found = []
+    for path in paths:
+        path = os.path.expanduser(path)
+        if os.path.isfile(os.path.join(path, 'session.json')) or os.path.isfile(path):
+            found.append(path)
+        elif os.path.isdir(path):
+            found.extend(os.path.join(path, name) for name in sorted(os.listdir(path))
+                         if os.path.isfile(os.path.join(path, name, 'session.json')))
+    return found
+
+
+def analyze_one(path, replay_session):
+    try:
+        return analysis.analyze(path, replay_session)
+    except Exception as e:
+        return {'path': path, 'error': repr(e)}
+
+
+def format_time(seconds):
+    if seconds is None or np.isnan(seconds):
+        return "-"
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    if hours:
+        return "%d:%02d:%04.1f" % (hours, minutes, seconds)
+    return "%d:%04.1f" % (minutes, seconds)
+
+
+def print_splits(result):
+    splits = result['splits']
+    print("  split      time    /500m   watts   spm")
+    for i in range(len(splits['time_s'])):
+        print("  %6dm %8s %8s %7.0f %5.1f" % (splits['distance_m'][i], format_time(splits['time_s'][i]),
+                                             format_time(splits['pace_500m_s'][i]), splits['watts'][i],
+                                             splits['stroke_rate'][i]))
+
+
+def print_report(result, with_splits):
+    print("%s: %s, %.0f m, %d strokes" % (result.get('path', 'all sessions'), format_time(result['duration_s']),
+                                         result['distance_m'], result['strokes']))
+    if with_splits and 'splits' in result:
+        print_splits(result)
+    curve = result['power_curve']
+    print("  power  " + "  ".join("%ds %s" % (duration, "-" if np.isnan(watts) else "%.0fW" % watts)
+                                  for duration, watts in zip(curve['duration_s'], curve['watts'])))
+    efforts = result['best_efforts']
+    print("  best   " + "  ".join("%dm %s" % (distance, format_time(seconds))
+                                  for distance, seconds in zip(efforts['distance_m'], efforts['time_s'])
+                                  if not np.isnan(seconds)))
+    rates = result['stroke_rates']
+    total = max(int(rates['seconds'].sum()), 1)
+    print("  spm    " + "  ".join("%d-%d %.0f%%" % (rate, rate + 2, 100.0 * seconds / total)
+                                  for rate, seconds in zip(rates['stroke_rate'], rates['seconds']) if seconds))
+
+
+def as_json(value):
+    if isinstance(value, dict):
+        return {key: as_json(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [as_json(item) for item in value]
+    if isinstance(value, np.ndarray):
+        return [None if isinstance(item, float) and np.isnan(item) else item for item in value.tolist()]
+    return value
+
+
+def main():
+    parser = argparse.ArgumentParser(prog='rowflo-analyze', description=__doc__,
+                                     formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("paths", nargs="+", help="capture files, session directories or a folder of sessions")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--recorded", action="store_true",
+                        help="take the snapshots of a session as recorded instead of replaying its events")
+    parser.add_argument("--splits", action="store_true", help="print the split table of every workout")
+    parser.add_argument("--json", metavar="FILE", help="write all results as JSON")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    workouts = find_workouts(args.paths)
+    if not workouts:
+        print("no captures or sessions found")
+        sys.exit(1)
+    started = time.monotonic()
+    replay_session = not args.recorded
+    if args.jobs > 1 and len(workouts) > 1:
+        with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+            results = list(pool.map(analyze_one, workouts, [replay_session] * len(workouts)))
+    else:
+        results = [analyze_one(path, replay_session) for path in workouts]
+    elapsed = time.monotonic() - started
+
+    failed = [result for result in results if 'error' in result]
+    results = [result for result in results if 'error' not in result]
+    for result in results:
+        print_report(result, args.splits)
+    for result in failed:
+        print("%s: could not be analysed: %s" % (result['path'], result['error']))
+    summary = analysis.summarize(results)
+    if summary is not None and len(results) > 1:
+        print()
+        print_report(summary, False)
+    print("%d workouts in %.1fs" % (len(results), elapsed))
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(as_json({'workouts': results, 'summary': summary}), f, indent=1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""
+Microbenchmark of the BLE rower data encoding.
+
+Compares RowerDataEncoder (one precompiled struct packed into a reused buffer, bytes compare, one
+D-Bus value per change) against the previous Convert_Waterrower_raw_to_byte path (18 struct.pack
+calls, list compare, a dbus.Byte per field on change), kept here verbatim as legacy_*.
+
+The values are a rowing sequence where about one tick in three changes something, like the
+200ms notify timer sees while rowing. Without dbus-python installed the D-Bus wrapping is skipped
+on both sides.
+
+Run from the src folder:
+python3 testing/bench_bleencoder.py
+"""
+
+import argparse
+import pathlib
+import random
+import struct
+import sys
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from adapters.ble.rowerdata import RowerDataEncoder
+
+try:
+    import dbus
+except ImportError:
+    dbus = None
+
+
+def legacy_convert(WaterrowerValuesRaw):
+    WRBytearray = []
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['stroke_rate'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_strokes'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_strokes'] & 0xff00) >> 8))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_distance_m'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_distance_m'] & 0xff00) >> 8))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_distance_m'] & 0xff0000) >> 16))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['instantaneous pace'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['instantaneous pace'] & 0xff00) >> 8))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['watts'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['watts'] & 0xff00) >> 8))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal'] & 0xff00) >> 8))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal_hour'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal_hour'] & 0xff00) >> 8))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['total_kcal_min'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['heart_rate'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['elapsedtime'] & 0xff)))
+    WRBytearray.append(struct.pack("B", (WaterrowerValuesRaw['elapsedtime'] & 0xff00) >> 8))
+    return WRBytearray
+
+
+def legacy_wrap(byte_values):
+    return [dbus.Byte(0x2C), dbus.Byte(0x0B)] + [dbus.Byte(b) for b in byte_values]
+
+
+def build_values(count):
+    random.seed(1)
+    values = []
+    current = {'stroke_rate': 26, 'total_strokes': 100, 'total_distance_m': 500, 'instantaneous pace': 120,
+               'speed': 400, 'watts': 150, 'total_kcal': 40, 'total_kcal_hour': 0, 'total_kcal_min': 0,
+               'heart_rate': 140, 'elapsedtime': 120}
+    for i in range(count):
+        if i % 3 == 0:
+            current = dict(current)
+            current['watts'] = random.randint(100, 250)
+            current['total_distance_m'] += 1
+            current['elapsedtime'] = 120 + i // 5
+        values.append(current)
+    return values
+
+
+def check_same_output(values):
+    encoder = RowerDataEncoder()
+    for v in values:
+        payload = encoder.encode(v) or encoder.payload
+        assert payload == bytes([0x2C, 0x0B]) + b''.join(legacy_convert(v)), v
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-n", "--number", type=int, default=20, help="passes over the values per run")
+    args = parser.parse_args()
+
+    values = build_values(3000)
+    check_same_output(values)
+
+    def run_legacy():
+        last = {}
+        for v in values:
+            byte_values = legacy_convert(v)
+            if last != byte_values:
+                last = byte_values
+                if dbus:
+                    legacy_wrap(byte_values)
+
+    def run_struct():
+        encoder = RowerDataEncoder()
+        for v in values:
+            payload = encoder.encode(v)
+            if payload is not None and dbus:
+                dbus.ByteArray(payload)
+
+    total = len(values) * args.number
+    legacy = min(timeit.repeat(run_legacy, number=args.number, repeat=5))
+    packed = min(timeit.repeat(run_struct, number=args.number, repeat=5))
+    print("ticks per run: %d (dbus wrapping %s)" % (total, "on" if dbus else "off, dbus-python missing"))
+    print("legacy convert   : %7.3f us/tick" % (legacy / total * 1e6))
+    print("RowerDataEncoder : %7.3f us/tick" % (packed / total * 1e6))
+    print("speedup          : %7.2fx" % (legacy / packed))
+
+
+if __name__ == '__main__':
+    main()
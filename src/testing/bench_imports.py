@@ -0,0 +1,113 @@
+"""
+Import time profile of the service entry point and its stacks.
+
+Every target is imported in a fresh interpreter with -X importtime, the way systemd starts the
+service after a crash, and the cumulative time of the target plus the heaviest imports under it
+are reported. The best of --repeat runs is kept, the first run also warms the bytecode cache.
+
+With --save the results are written to a JSON file; with --baseline a previous file is compared
+against and a target that got slower by more than --tolerance percent makes the exit code 1, so
+the report can be tracked like the other benchmarks.
+
+Run from the src folder:
+python3 testing/bench_imports.py
+python3 testing/bench_imports.py --save /tmp/imports.json
+python3 testing/bench_imports.py --baseline /tmp/imports.json
+"""
+
+import argparse
+import json
+import pathlib
+import re
+import subprocess
+import sys
+
+SRC = pathlib.Path(__file__).parent.parent.absolute()
+
+# entry point first: without -b it must not pull in dbus / GLib
+TARGETS = ('waterrowerthreads',
+           'adapters.s4.wrtobleant',
+           'adapters.s4.waterrowerinterface',
+           'adapters.ble.waterrowerble')
+HEAVY_MODULES = ('dbus', 'gi', 'serial', 'numpy', 'asyncio')
+
+IMPORTTIME_LINE = re.compile(r'^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)')
+
+
+def profile(target):
+    # returns {module: (self us, cumulative us, depth)} of one cold interpreter, or the error text
+    code = "import sys; import %s; print(','.join(sorted(sys.modules)))" % target
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=str(SRC),
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        return None, result.stderr.strip().splitlines()[-1]
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match:
+            self_us, cumulative_us, indent, name = match.groups()
+            modules[name] = (int(self_us), int(cumulative_us), len(indent) // 2)
+    loaded = set(result.stdout.strip().split(','))
+    return modules, loaded
+
+
+def measure(target, repeat):
+    best = None
+    for _ in range(repeat):
+        modules, loaded = profile(target)
+        if modules is None:
+            return {'error': loaded}
+        total = modules.get(target, (0, 0, 0))[1]
+        if best is None or total < best['total_us']:
+            depth = modules.get(target, (0, 0, 0))[2]
+            top_level = sorted(((cumulative, name) for name, (self_us, cumulative, d) in modules.items()
+                                if d == depth + 1), reverse=True)
+            best = {'total_us': total,
+                    'modules': len(modules),
+                    'heaviest': [(name, cumulative) for cumulative, name in top_level[:8]],
+                    'stacks': sorted(name for name in HEAVY_MODULES if name in loaded)}
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("targets", nargs="*", default=TARGETS, help="modules to import")
+    parser.add_argument("-r", "--repeat", type=int, default=5, help="cold imports per target, best is kept")
+    parser.add_argument("--save", metavar="FILE", help="write the results as JSON")
+    parser.add_argument("--baseline", metavar="FILE", help="compare against results saved before")
+    parser.add_argument("--tolerance", type=float, default=20.0, help="percent slower that still passes")
+    args = parser.parse_args()
+
+    results = {target: measure(target, args.repeat) for target in args.targets}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    regressions = []
+    for target, result in results.items():
+        if 'error' in result:
+            print("%-36s could not be imported: %s" % (target, result['error']))
+            continue
+        line = "%-36s %8.1f ms  %4d modules  stacks: %s" % (
+            target, result['total_us'] / 1000.0, result['modules'], ", ".join(result['stacks']) or "-")
+        before = baseline.get(target, {}).get('total_us')
+        if before:
+            change = 100.0 * (result['total_us'] - before) / before
+            line += "  (%+.0f%% vs baseline)" % change
+            if change > args.tolerance:
+                regressions.append(target)
+        print(line)
+        for name, cumulative in result['heaviest']:
+            print("    %-32s %8.1f ms" % (name, cumulative / 1000.0))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print("slower than the baseline: %s" % ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
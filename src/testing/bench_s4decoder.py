@@ -0,0 +1,119 @@
+"""
+Microbenchmark of the S4 packet decoder.
+
+Compares the table driven decode_frame() against the previous str based event_from() (kept here
+verbatim as legacy_event_from) on a stream of S4 packets. By default the packets come from
+s4traffic.txt next to this script: ~3000 lines laid out like a rowing session (a pulse packet every
+25ms, memory replies round robin, stroke start/end). Any other dump with one packet per line can be
+passed with -f.
+
+Run from the src folder:
+python3 testing/bench_s4decoder.py
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+import timeit
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from adapters.s4 import waterrowerinterface as wr
+
+DEFAULT_TRAFFIC = pathlib.Path(__file__).parent.absolute() / "s4traffic.txt"
+
+LEGACY_SIZE_PARSE_MAP = {'single': lambda cmd: cmd[6:8],
+                         'double': lambda cmd: cmd[6:10],
+                         'triple': lambda cmd: cmd[6:12]}
+
+
+def legacy_build_event(type, value=None, raw=None):
+    return {"type": type,
+            "value": value,
+            "raw": raw,
+            "at": int(round(time.time() * 1000))}
+
+
+def legacy_read_reply(cmd):
+    address = cmd[3:6]
+    memory = wr.MEMORY_MAP.get(address)
+    if memory:
+        size = memory['size']
+        value_fn = LEGACY_SIZE_PARSE_MAP.get(size, lambda cmd: None)
+        value = value_fn(cmd)
+        if value is not None:
+            return legacy_build_event(memory['type'], int(value, base=memory['base']), cmd)
+
+
+def legacy_event_from(line):
+    try:
+        cmd = line.strip()
+        cmd = cmd.decode('utf8')
+        if cmd == wr.STROKE_START_RESPONSE:
+            return legacy_build_event(type='stroke_start', raw=cmd)
+        elif cmd == wr.STROKE_END_RESPONSE:
+            return legacy_build_event(type='stroke_end', raw=cmd)
+        elif cmd == wr.OK_RESPONSE:
+            return None
+        elif cmd[:2] == wr.MODEL_INFORMATION_RESPONSE:
+            return legacy_build_event(type='model', raw=cmd)
+        elif cmd[:2] == wr.READ_MEMORY_RESPONSE:
+            return legacy_read_reply(cmd)
+        elif cmd[:4] == wr.PING_RESPONSE:
+            return legacy_build_event(type='ping', raw=cmd)
+        elif cmd[:1] == wr.PULSE_COUNT_RESPONSE:
+            return legacy_build_event(type='pulse', raw=cmd)
+        elif cmd == wr.ERROR_RESPONSE:
+            return legacy_build_event(type='error', raw=cmd)
+        else:
+            return None
+    except Exception:
+        return None
+
+
+def load_traffic(path):
+    with open(path, 'rb') as f:
+        return [line.rstrip(b'\r\n') for line in f if line.strip()]
+
+
+def check_same_output(frames):
+    for frame in frames:
+        old = legacy_event_from(frame + b'\r\n')
+        new = wr.decode_frame(frame)
+        if old is None or new is None:
+            assert old is None and new is None, frame
+            continue
+        assert old['type'] == new['type'] and old['value'] == new['value'], frame
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("-f", "--file", default=str(DEFAULT_TRAFFIC), help="S4 dump, one packet per line")
+    parser.add_argument("-n", "--number", type=int, default=20, help="passes over the dump per run")
+    args = parser.parse_args()
+
+    frames = load_traffic(args.file)
+    lines = [frame + b'\r\n' for frame in frames]
+    check_same_output(frames)
+
+    def run_legacy():
+        for line in lines:
+            legacy_event_from(line)
+
+    def run_table():
+        at = wr.now_ms()
+        for frame in frames:
+            wr.decode_frame(frame, at)
+
+    total = len(frames) * args.number
+    legacy = min(timeit.repeat(run_legacy, number=args.number, repeat=5))
+    table = min(timeit.repeat(run_table, number=args.number, repeat=5))
+    print("packets per run: %d" % total)
+    print("legacy event_from : %7.3f us/packet" % (legacy / total * 1e6))
+    print("table decode_frame: %7.3f us/packet" % (table / total * 1e6))
+    print("speedup           : %7.2fx" % (legacy / table))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""
+Check of the workout totals of adapters/session/analysis.py.
+
+The capture starts in the middle of a workout: the S4 reports 1362 m and 500 strokes from before,
+then 480 m and 48 strokes are rowed. The analysis has to count what was rowed in the capture, not
+what the monitor held when it started.
+
+Run from the src folder:
+python3 testing/check_analysis.py
+"""
+
+import os
+import pathlib
+import sys
+import tempfile
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from adapters.s4 import waterrowerinterface
+from adapters.session import analysis
+
+START_DISTANCE_M = 1362  # what the monitor holds when the capture starts
+START_STROKES = 500
+ROWED_S = 120  # seconds rowed in the capture, 2 m every 0.5 s, one stroke every 2.5 s
+
+
+def write_capture(path):
+    records = []
+    for tick in range(ROWED_S * 2 + 1):
+        at = tick * 500
+        distance = START_DISTANCE_M + 2 * tick
+        strokes = START_STROKES + tick // 5
+        records.append((at, b'P05\r\n'))
+        records.append((at, b'IDD055%04X\r\n' % distance))
+        records.append((at, b'IDD140%04X\r\n' % strokes))
+    with open(path, 'wb') as f:
+        f.write(waterrowerinterface.CAPTURE_MAGIC)
+        for at, data in records:
+            f.write(waterrowerinterface.CAPTURE_RECORD.pack(at, waterrowerinterface.CAPTURE_RX, len(data)))
+            f.write(data)
+
+
+def main():
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'midworkout.s4cap')
+        write_capture(path)
+        result = analysis.analyze(path)
+    assert result['distance_m'] == 2 * ROWED_S * 2, result['distance_m']
+    assert result['strokes'] == ROWED_S * 2 // 5, result['strokes']
+    print("ok: %.0f m and %d strokes rowed" % (result['distance_m'], result['strokes']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Check of the serial -> BLE latency traces opened by the DataLogger.
+
+A trace has to start at the S4 event that changed a value. A reply that repeats a known value
+comes first here, the real change follows 299s later; the published trace must carry the time of
+the change, not of the repeated reply, or the serial->logger latency is off by minutes.
+
+Run from the src folder:
+python3 testing/check_latency_trace.py
+"""
+
+import pathlib
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from adapters.metrics import latency
+from adapters.s4 import waterrowerinterface
+from adapters.s4 import wrtobleant
+from adapters.session.analysis import EventSource
+
+
+class Published(object):
+    # DataLogger output, keeps what was handed over
+    def __init__(self):
+        self.items = []
+
+    def append(self, item):
+        self.items.append(item)
+
+
+def main():
+    source = EventSource()
+    out = Published()
+    datalogger = wrtobleant.DataLogger(source, outputs=(out,))
+    now = latency.stamp()
+    # a pulse long ago: out of the reset state, the rower stands still
+    source.feed(waterrowerinterface.S4Event('pulse', None, b'P01', now - 300000))
+    del out.items[:]
+
+    # the distance is 0 already: nothing changes, nothing is published, no trace
+    source.feed(waterrowerinterface.S4Event('total_distance_m', 0, None, now - 299000))
+    assert not out.items, out.items
+    assert datalogger._trace is None, datalogger._trace
+
+    source.feed(waterrowerinterface.S4Event('total_distance_m', 120, None, now))
+    assert len(out.items) == 1, out.items
+    values, trace = out.items[0]
+    assert values['total_distance_m'] == 120, values
+    assert trace is not None
+    assert trace['serial'] == now, trace
+    serial_to_logger = trace['logger'] - trace['serial']
+    assert 0 <= serial_to_logger < 1000, serial_to_logger
+    print("ok: trace starts at the change, serial->logger %.1f ms" % serial_to_logger)
+
+
+if __name__ == '__main__':
+    main()
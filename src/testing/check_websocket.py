@@ -0,0 +1,95 @@
+"""
+Check of the WebSocket side of adapters/web/liveserver.py.
+
+The Sec-WebSocket-Accept of the handshake example in RFC 6455 section 1.3, then a real handshake
+against a LiveServer on a local port. The channel starts as a restart of the HTTP worker leaves it:
+a wakeup pending that the old loop never ran and a client of the old loop. The new loop has to
+deliver the next value and forget that client.
+
+Run from the src folder:
+python3 testing/check_websocket.py
+"""
+
+import asyncio
+import json
+import pathlib
+import socket
+import sys
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from adapters.web import liveserver
+
+# the handshake example of RFC 6455 section 1.3
+SAMPLE_KEY = b'dGhlIHNhbXBsZSBub25jZQ=='
+SAMPLE_ACCEPT = b's3pPLMBiTxaQ9kYGzzhZRbK+xOo='
+
+
+class Values(object):
+    # what the DataLogger publishes, as far as the live server looks at it
+    def __init__(self, **values):
+        self.values = values
+        self.stale = False
+
+    def as_dict(self):
+        return dict(self.values)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def connect(port):
+    for _ in range(100):
+        try:
+            return await asyncio.open_connection('127.0.0.1', port)
+        except ConnectionError:
+            await asyncio.sleep(0.02)
+    raise AssertionError('live server does not listen on %d' % port)
+
+
+async def read_frame(reader):
+    first, second = await asyncio.wait_for(reader.readexactly(2), 2)
+    assert first == 0x81, first  # FIN, text
+    length = second & 0x7f
+    if length == 126:
+        length = int.from_bytes(await reader.readexactly(2), 'big')
+    return json.loads(await reader.readexactly(length))
+
+
+async def handshake(server):
+    serve = asyncio.ensure_future(server.serve())
+    reader, writer = await connect(server.port)
+    writer.write(b'GET /ws HTTP/1.1\r\nHost: localhost\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 b'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n' % SAMPLE_KEY)
+    head = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), 2)
+    assert head.startswith(b'HTTP/1.1 101 '), head
+    assert b'Sec-WebSocket-Accept: %s\r\n' % SAMPLE_ACCEPT in head, head
+
+    server.append((Values(total_distance_m=120), None))
+    values = await read_frame(reader)
+    assert values['total_distance_m'] == 120, values
+    assert all(isinstance(client, asyncio.StreamWriter) for client in server.default.clients), server.default.clients
+
+    writer.close()
+    serve.cancel()
+    try:
+        await serve
+    except asyncio.CancelledError:
+        pass
+
+
+def main():
+    assert liveserver.ws_accept(SAMPLE_KEY) == SAMPLE_ACCEPT
+    server = liveserver.LiveServer('127.0.0.1', free_port())
+    # left by the loop of the worker before the restart
+    server.default._wakeup_pending = True
+    server.default.clients.add(object())
+    asyncio.run(handshake(server))
+    print("ok: RFC 6455 handshake, first value delivered after a restart")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Load test of the S4 pipeline without a rower attached.
+
+Replays a capture file (recorded with waterrowerthreads.py --s4-record) through the same Rower and
+DataLogger that the service uses and reports throughput and CPU time. With -b the BLE rower data
+encoding is run on every snapshot as well.
+
+A plain text dump with one S4 packet per line (like testing/s4traffic.txt) can be turned into a
+capture file first, the packets are spaced 25ms apart:
+python3 testing/s4replay.py --from-text testing/s4traffic.txt /tmp/s4traffic.s4cap
+
+Run from the src folder:
+python3 testing/s4replay.py /tmp/s4traffic.s4cap --speed 0
+"""
+
+import argparse
+import pathlib
+import sys
+import time
+
+sys.path.insert(0, str(pathlib.Path(__file__).parent.parent.absolute()))
+
+from adapters.s4 import waterrowerinterface
+from adapters.s4 import wrtobleant
+
+
+def capture_from_text(text_path, capture_path, spacing_ms=25):
+    with open(text_path, 'rb') as src, open(capture_path, 'wb') as dst:
+        dst.write(waterrowerinterface.CAPTURE_MAGIC)
+        offset_ms = 0
+        for line in src:
+            data = line.rstrip(b'\r\n') + b'\r\n'
+            dst.write(waterrowerinterface.CAPTURE_RECORD.pack(offset_ms, waterrowerinterface.CAPTURE_RX, len(data)))
+            dst.write(data)
+            offset_ms += spacing_ms
+
+
+def replay(capture_path, speed, ble):
+    options = argparse.Namespace(s4_replay=capture_path, replay_speed=speed, replay_loop=False)
+    encoder = None
+    if ble:
+        from adapters.ble.rowerdata import RowerDataEncoder
+        encoder = RowerDataEncoder()
+
+    rower = waterrowerinterface.Rower(options)
+    logger = wrtobleant.DataLogger(rower)
+    events = [0]
+    rower.register_callback(lambda event: events.__setitem__(0, events[0] + 1))
+
+    wall = time.monotonic()
+    cpu = time.process_time()
+    rower.open()
+    snapshots = 0
+    while not rower._serial.finished.is_set():
+        values = logger.get_WRValues()
+        snapshots += 1
+        if encoder:
+            encoder.encode({key: int(value) for key, value in values.items()})
+        time.sleep(0.01)
+    wall = time.monotonic() - wall
+    cpu = time.process_time() - cpu
+
+    print("replayed        : %s at speed %s" % (capture_path, speed or "max"))
+    print("wall time       : %.3f s" % wall)
+    print("cpu time        : %.3f s (%.1f%%)" % (cpu, 100 * cpu / wall if wall else 0))
+    print("events          : %d (%.0f/s)" % (events[0], events[0] / wall if wall else 0))
+    print("snapshots       : %d" % snapshots)
+    if encoder:
+        print("ble payloads    : %d encoded, %d changed" % (encoder.encoded, encoder.changed))
+    print("capture stats   : %s" % rower.capture_stats)
+    print("last values     : %s" % logger.get_WRValues())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("capture", nargs="?", help="S4 capture file to replay")
+    parser.add_argument("--from-text", nargs=2, metavar=("TEXT", "CAPTURE"),
+                        help="convert a text dump into a capture file and exit")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 0 = as fast as possible")
+    parser.add_argument("-b", "--ble", action="store_true", help="also run the BLE rower data encoder")
+    args = parser.parse_args()
+
+    if args.from_text:
+        capture_from_text(*args.from_text)
+        return
+    if not args.capture:
+        parser.error("a capture file is needed")
+    replay(args.capture, args.speed, args.ble)
+
+
+if __name__ == '__main__':
+    main()
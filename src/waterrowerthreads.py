@@ -11,6 +11,22 @@ SmartRow support is intentionally disabled in RowFlo.
 
 Example:
 python3 waterrowerthreads.py -i s4 -b -a
+
+Record the S4 traffic of a session, then replay it later without a rower attached:
+python3 waterrowerthreads.py -i s4 -b --s4-record /tmp/session.s4cap
+python3 waterrowerthreads.py -i s4 -b --s4-replay /tmp/session.s4cap --replay-speed 4
+
+Run the S4 reader and the BLE server on one GLib main loop (one worker thread, for single core boards):
+python3 waterrowerthreads.py -i s4 -b --single-loop
+
+Record every workout (snapshots and S4 events) to ~/rowflo-sessions, one directory per session:
+python3 waterrowerthreads.py -i s4 -b --session-dir ~/rowflo-sessions
+
+Serve the live values (page, JSON, WebSocket) and the /metrics counters on port 8080 of every interface:
+python3 waterrowerthreads.py -i s4 -b --http 8080 --http-host 0.0.0.0
+
+Hub: every S4 plugged in gets its own rower at /rowers/<device>/, the first one found is also on BLE:
+python3 waterrowerthreads.py -i s4 -b --hub --http 8080 --http-host 0.0.0.0
 """
 
 import logging
@@ -21,13 +37,20 @@ from queue import Queue
 from collections import deque
 import pathlib
 import signal
+import sys
 
-from adapters.ble import waterrowerble
+# the BLE (dbus, GLib) and S4 (serial) stacks are imported by the worker that needs them, so a
+# run without -b never loads dbus; see testing/bench_imports.py
+from adapters.metrics import latency
+from adapters.metrics import registry
+from adapters.channel.valuechannel import ValueChannel, LocalValue
+from adapters.supervisor.supervisor import Supervisor
 
 loggerconfigpath = str(pathlib.Path(__file__).parent.absolute()) + "/logging.conf"
 
 logger = logging.getLogger(__name__)
 Mainlock = threading.Lock()
+supervisor = None  # Supervisor of the worker threads, set in main
 
 
 class Graceful:
@@ -35,36 +58,102 @@ class Graceful:
         self.run = True
         signal.signal(signal.SIGINT, self.exit_gracefully)
         signal.signal(signal.SIGTERM, self.exit_gracefully)
+        signal.signal(signal.SIGUSR1, self.report_latency)
 
     def exit_gracefully(self, signum, frame):
         with Mainlock:
             self.run = False
             logger.info("Graceful shutdown requested")
 
+    def report_latency(self, signum, frame):
+        # kill -USR1 <pid> writes the serial to BLE latency percentiles, the notify stats and the
+        # worker restarts to the log
+        latency.tracer.log_report()
+        waterrowerble = sys.modules.get("adapters.ble.waterrowerble")
+        if waterrowerble is not None:
+            waterrowerble.log_notify_stats()
+        if supervisor is not None:
+            supervisor.log_stats()
+
 
 def main(args):
     logging.config.fileConfig(loggerconfigpath, disable_existing_loggers=False)
     grace = Graceful()
     
-    def BleService(out_q, ble_in_q):
+    def BleService(out_q, ble_in_q, state):
         logger.info("Starting BLE advertise and GATT server")
-        service = waterrowerble.main(out_q, ble_in_q)
-        service()
+        from adapters.ble import waterrowerble
+        waterrowerble.main(out_q, ble_in_q, args.ble_notify_interval)
     
-    def Waterrower(in_q, ble_out_q):
+    def Waterrower(in_q, ble_out_q, state):
         logger.info("Starting S4 WaterRower interface")
-        service = waterrowerble.main(in_q, ble_out_q)
-        service()
-    ble_q = deque(maxlen=1)
-    q = deque(maxlen=1)
-    threads = []
+        from adapters.s4 import wrtobleant
+        # ANT+ is not part of RowFlo, its queue is only there to satisfy wrtobleant
+        if args.asyncio:
+            wrtobleant.main_async(in_q, ble_out_q, deque(maxlen=1), args, state, outputs)
+        else:
+            wrtobleant.main(in_q, ble_out_q, deque(maxlen=1), args, state, outputs)
+
+    def SingleLoop(state):
+        logger.info("Starting S4 WaterRower interface and BLE on one main loop")
+        from adapters.s4 import wrtobleant
+        ble_q = LocalValue()
+        commands = wrtobleant.start_glib(ble_q, deque(maxlen=1), args, state, outputs)
+        try:
+            if args.blue:
+                from adapters.ble import waterrowerble
+                waterrowerble.main(commands, ble_q, args.ble_notify_interval)
+            else:
+                from gi.repository import GLib
+                GLib.MainLoop().run()
+        finally:
+            commands.S4.close()
+
+    def Hub(in_q, ble_out_q, state):
+        logger.info("Starting S4 hub")
+        from adapters.s4 import hub
+
+        def outputs_for(device, on_ble):
+            # the rower on BLE is also the default channel of the live server; without --http the
+            # rowers are only recorded (--hub needs one of the two, see below)
+            if live is None:
+                return ()
+            return (live.channel(device), live.default) if on_ble else (live.channel(device),)
+
+        hub.main(in_q, ble_out_q if args.blue else None, args, state, outputs_for)
+
+    def HttpServer(state):
+        live.run()
+
+    # the queues outlive the workers, so a restarted worker picks up where the old one was
+    ble_q = ValueChannel()
+    q = Queue()
+    global supervisor
+    supervisor = Supervisor()
+    registry.register('latency', lambda: registry.Labelled('stage', latency.tracer.report()))
+    registry.register('workers', lambda: registry.Labelled('worker', supervisor.stats()))
+
+    # live values over HTTP / WebSocket, one more output of the DataLogger
+    outputs = ()
+    live = None
+    if args.http:
+        from adapters.web.liveserver import LiveServer
+        live = LiveServer(args.http_host, args.http)
+        outputs = (live,)
+        supervisor.add("http", HttpServer)
     
     # main Waterrower interface
-    if args.interface == "s4":
+    if args.interface == "s4" and args.hub:
+        logger.info("Interface selected: S4 hub (every S4 plugged in)")
+        supervisor.add("s4-hub", Hub, args=(q, ble_q))
+
+    elif args.interface == "s4" and args.single_loop:
+        logger.info("Interface selected: S4 monitor (single main loop)")
+        supervisor.add("s4+ble", SingleLoop)
+
+    elif args.interface == "s4":
         logger.info("Interface selected: S4 monitor")
-        t = threading.Thread(target=Waterrower, args=(q, ble_q), daemon=True)
-        t.start()
-        threads.append(t)
+        supervisor.add("s4", Waterrower, args=(q, ble_q))
 
     elif args.interface == "sr":
         logger.error("SmartRow support is disabled in RowFlo")
@@ -75,20 +164,17 @@ def main(args):
         return
 
     # BLE service
-    if args.blue:
-        t = threading.Thread(target=BleService, args=(q, ble_q), daemon=True)
-        t.start()
-        threads.append(t)
+    if args.single_loop and not args.hub:
+        pass  # already running on the S4 main loop
+    elif args.blue:
+        supervisor.add("ble", BleService, args=(q, ble_q))
     else:
         logger.info("BLE service not enabled")
 
-    # Main loop
-    while grace.run:
-        for thread in threads:
-            thread.join(timeout=10)
-            if not thread.is_alive():
-                logger.error("A worker thread exited unexpectedly")
-                return
+    # Main loop: a worker that dies is restarted on its own, the others keep running
+    supervisor.start()
+    supervisor.run(lambda: grace.run)
+    supervisor.log_stats()
 
 
 if __name__ == "__main__":
@@ -109,8 +195,77 @@ if __name__ == "__main__":
         action="store_true",
         help="Broadcast WaterRower data over Bluetooth Low Energy",
     )
+    parser.add_argument(
+        "--ble-notify-interval",
+        type=float,
+        metavar="MS",
+        help="Minimum time between two BLE notifications, default the connection interval of the controller",
+    )
+    parser.add_argument(
+        "--s4-record",
+        metavar="FILE",
+        help="Record the raw S4 serial traffic to a capture file (FILE.<device id> per S4 with --hub)",
+    )
+    parser.add_argument(
+        "--s4-replay",
+        metavar="FILE",
+        help="Replay a recorded S4 capture file instead of opening the serial port",
+    )
+    parser.add_argument(
+        "--replay-speed",
+        type=float,
+        default=1.0,
+        help="Replay speed factor for --s4-replay (1 = real time, 0 = as fast as possible)",
+    )
+    parser.add_argument(
+        "--replay-loop",
+        action="store_true",
+        help="Start the replay over when the capture file ends",
+    )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        help="Run the S4 interface on one asyncio event loop instead of two worker threads",
+    )
+    parser.add_argument(
+        "--single-loop",
+        action="store_true",
+        help="Run the S4 interface inside the BLE GLib main loop, no worker threads or queues in between",
+    )
+
+    parser.add_argument(
+        "--session-dir",
+        metavar="DIR",
+        help="Record the workouts to DIR, one directory per session (needs numpy)",
+    )
+
+    parser.add_argument(
+        "--http",
+        type=int,
+        metavar="PORT",
+        help="Serve the live values (page, /snapshot, /ws WebSocket) and /metrics over HTTP on PORT",
+    )
+    parser.add_argument(
+        "--http-host",
+        default="127.0.0.1",
+        help="Address the HTTP server listens on (default 127.0.0.1, 0.0.0.0 for every interface)",
+    )
+
+    parser.add_argument(
+        "--hub",
+        action="store_true",
+        help="Serve every S4 plugged in, each as its own rower on one event loop (needs --http or --session-dir, see --hub-ble)",
+    )
+    parser.add_argument(
+        "--hub-ble",
+        metavar="DEVICE",
+        help="Device id (USB serial number) of the hub rower served over BLE, default the first one found",
+    )
 
     args = parser.parse_args()
+    if args.hub and not (args.http or args.session_dir):
+        # BLE serves one rower only, the values of the others would go nowhere
+        parser.error("--hub needs --http or --session-dir")
     logger.info(args)
 
     try: